@@ -11,8 +11,33 @@ WORKING_DATASET = "WORKING_DATASET"
 DIURNAL_COMPUTED = "DIURNAL_COMPUTED"
 SURVEY_DATA_END_IDX = "SURVEY_DATA_START_IDX"
 POINTS_TO_CLIP = "POINTS_TO_CLIP"
+CLIP_SELECTION_MAX_POINTS = 200000
 DISABLED_TABS = False
 PROJECT_ROOT = os.getcwd()
 NOTIFICATION_MESSAGE = "NOTIFICATION_MESSAGE"
 ANNOTATION = "ANNOTATION"
 ANNOTATION_SELECTED_POINTS = "ANNOTATION_SELECTED_POINTS"
+RESIDUAL_CHUNK_SIZE = 500000
+DIURNAL_ALIGNMENT_TOLERANCE = '60s'
+INTERPOLATION_MASK_DISTANCE = 400
+INTERPOLATION_PREVIEW_FACTOR = 8
+INTERPOLATION_PREVIEW_MIN_NODES = 10
+INTERPOLATION_CANCEL_TIMEOUT = 3600
+RASTER_CACHE_DIR = os.path.join(PROJECT_ROOT, 'data', 'raster_cache')
+RASTER_CACHE_MAX_BYTES = 2 * 1024 ** 3
+RENDER_CACHE_DIR = os.path.join(PROJECT_ROOT, 'data', 'render_cache')
+RENDER_CACHE_MAX_BYTES = 256 * 1024 ** 2
+TILE_SOURCE_DIR = os.path.join(PROJECT_ROOT, 'data', 'tile_sources')
+TILE_SOURCE_MAX_BYTES = 2 * 1024 ** 3
+EXPORT_CACHE_DIR = os.path.join(PROJECT_ROOT, 'data', 'export_cache')
+EXPORT_CACHE_MAX_BYTES = 5 * 1024 ** 3
+EXPORT_LOCK_TIMEOUT = 3600
+BLOB_BACKEND = 'azure'
+LOCAL_BLOB_ROOT = os.path.join(PROJECT_ROOT, 'data', 'blob_store')
+UPLOAD_BLOCK_SIZE = 8 * 1024 ** 2
+UPLOAD_MAX_FILES = 2
+UPLOAD_MAX_WORKERS = 8
+DOWNLOAD_RANGE_SIZE = 8 * 1024 ** 2
+DOWNLOAD_MAX_WORKERS = 8
+DOWNLOAD_CACHE_MAX_BYTES = 20 * 1024 ** 3
+DOWNLOAD_CACHE_GRACE = 3600
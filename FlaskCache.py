@@ -1,4 +1,41 @@
+import functools
+import hashlib
+import inspect
+
 from flask_caching import Cache
 
+from utils.DatasetFingerprint import DatasetFingerprint
+
+
+cache = Cache()
+
+
+def memoize_frames(timeout=None, args_to_ignore=None):
+    """
+    Like cache.memoize, but DataFrame, Series and array arguments are keyed on a content fingerprint rather than
+    ignored or a truncated repr, so results stay valid across datasets without having to call cache.delete_memoized
+    """
+    args_to_ignore = set(args_to_ignore or []) | {'cls', 'self'}
+
+    def decorator(f):
+        signature = inspect.signature(f)
+
+        @functools.wraps(f)
+        def decorated_function(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+
+            key_parts = [f'{name}={DatasetFingerprint.of_value(value)}'
+                         for name, value in bound.arguments.items() if name not in args_to_ignore]
+            cache_key = hashlib.md5(f'{f.__module__}.{f.__qualname__}({";".join(key_parts)})'
+                                    .encode('utf-8')).hexdigest()
+
+            result = cache.get(cache_key)
+            if result is None:
+                result = f(*args, **kwargs)
+                cache.set(cache_key, result, timeout=timeout)
+            return result
+
+        return decorated_function
 
-cache = Cache()
\ No newline at end of file
+    return decorator
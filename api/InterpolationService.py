@@ -1,177 +1,314 @@
-import math
 import os
 import time
 
 import pandas as pd
-import rasterio
 import verde as vd
 import numpy as np
-from joblib import Parallel, delayed
-import rasterio as rio
-from matplotlib import pyplot as plt
+from rasterio.io import MemoryFile
+from rasterio.shutil import copy as rio_copy
 from rasterio.transform import from_origin
-from rasterio.plot import show
 
 import AppConfig
-from FlaskCache import cache
+from FlaskCache import memoize_frames
+from dataservices.RedisFlag import RedisFlag
 from dataservices.RedisQueue import RedisQueue
 from utils.Consts import Consts
-
-
-@cache.memoize(timeout=5000)
-def verde_interpolate(df, col_to_interpolate, interpolation_type, spacing, tiff_name):
+from utils.DatasetFingerprint import DatasetFingerprint
+from utils.DiskCache import DiskCache
+from utils.FastGridders import InverseDistance, MinimumCurvature, NearestNeighbour
+from utils.GridMasking import GridMasking
+from utils.GridResult import GridResult
+from utils.RasterRenderer import RasterRenderer
+from utils.TiledGridding import TiledGridding
+
+# Bumped whenever the raster or grid CSV layout or the gridding itself changes, so older cache entries are never served
+RASTER_FORMAT_VERSION = 5
+COG_BLOCK_SIZE = 256
+CSV_CHUNK_ROWS = 256
+UTM_LATITUDE_BANDS = 'CDEFGHJKLMNPQRSTUVWX'
+
+
+def verde_interpolate(df, col_to_interpolate, interpolation_type, spacing, tiff_name, tiled=False, preview=False,
+                      is_cancelled=None):
     redis_queue = RedisQueue(name='app-notifications')
     start_time = time.time()
 
+    # A preview gets its own raster so the one behind the export button is only ever the final grid
+    tiff_name = f'{tiff_name}-preview' if preview else tiff_name
+    tiff_path, df_save_path = get_output_paths(tiff_name)
+    title = f'{col_to_interpolate} Raster (Preview at {spacing}m)' if preview else f'{col_to_interpolate} Raster'
+
+    raster_cache = get_raster_cache()
+    cache_key = get_raster_cache_key(df, tiff_name, col_to_interpolate, interpolation_type, spacing, tiled)
+    cached_files = {'raster.tiff': tiff_path} if preview else {'raster.tiff': tiff_path, 'grid.csv': df_save_path}
+
+    if raster_cache.fetch(cache_key, cached_files):
+        print(f'Serving {tiff_name} from the raster cache')
+        redis_queue.put(
+            f'interpolation;show__{Consts.FINISHED_DISPLAY_STATE}; Done;Grid served from an earlier interpolation')
+        return RasterRenderer.render(tiff_path, title)
+
     coordinates = (np.array(df['Easting']), np.array(df['Northing']))
     region = vd.get_region((df.Easting, df.Northing))
 
     redis_queue.put(f'interpolation;show__{Consts.LOADING_DISPLAY_STATE};Fitting;Fitting Interpolator to Data!')
 
-    fitted_interpolator = fit_interpolator(interpolation_type=interpolation_type,
-                                           spacing=spacing,
-                                           coordinates=coordinates,
-                                           interpolation_values=df[col_to_interpolate])
+    # Trend and block reduction only depend on the data and spacing, so they're shared across interpolator types
+    points = df[['Easting', 'Northing', col_to_interpolate]]
+    trend = fit_trend(points, col_to_interpolate)
+    reduced_coordinates, reduced_residuals = reduce_points(points, col_to_interpolate, spacing)
+
+    if is_cancelled is not None and is_cancelled():
+        return None
+
+    if tiled:
+        redis_queue.put(
+            f'interpolation;update__{Consts.LOADING_DISPLAY_STATE};Generating Grid;Gridding tiles with spacing {spacing} in parallel!')
+
+        grid = TiledGridding.grid(get_interpolator(interpolation_type, spacing),
+                                  coordinates=reduced_coordinates,
+                                  values=reduced_residuals,
+                                  region=region,
+                                  spacing=spacing,
+                                  data_name=col_to_interpolate,
+                                  is_cancelled=is_cancelled)
+        if grid is None:
+            return None
+    else:
+        interpolator = get_interpolator(interpolation_type, spacing).fit(reduced_coordinates, reduced_residuals)
 
-    redis_queue.put(
-        f'interpolation;update__{Consts.LOADING_DISPLAY_STATE};Generating Grid;Generating Interpolation Grid with spacing {spacing}!')
+        redis_queue.put(
+            f'interpolation;update__{Consts.LOADING_DISPLAY_STATE};Generating Grid;Generating Interpolation Grid with spacing {spacing}!')
 
-    time.sleep(2)
+        grid = interpolator.grid(spacing=spacing,
+                                 region=region,
+                                 dims=["Northing", "Easting"],
+                                 data_names=col_to_interpolate)
 
-    grid = extract_grid(col_to_interpolate, fitted_interpolator, region, spacing)
+        if is_cancelled is not None and is_cancelled():
+            return None
 
     redis_queue.put(
         f'interpolation;update__{Consts.LOADING_DISPLAY_STATE};Masking;Generating Convex Hull to mask points!')
 
-    grid = vd.convexhull_mask(coordinates, grid=grid)
-
-    df_convex_hulled = grid.to_dataframe()
-    df_convex_hulled = df_convex_hulled.dropna(subset=[col_to_interpolate])
+    result = add_trend(GridResult.from_xarray(grid, col_to_interpolate), trend)
+    del grid
 
-    df_splits = split_dataframe(df_convex_hulled)
+    result.restrict(GridMasking.convexhull_mask(coordinates,
+                                                easting=result.easting,
+                                                northing=result.northing,
+                                                candidates=result.mask))
 
     redis_queue.put(
         f'interpolation;update__{Consts.LOADING_DISPLAY_STATE}; Masking; Masking extrapolated points with a distance filter')
 
-    grid_list = Parallel(n_jobs=6, backend="threading")(
-        delayed(process_sub_grid)(df_i, coordinates, 400) for df_i in df_splits)
+    result.restrict(GridMasking.distance_mask(coordinates,
+                                              easting=result.easting,
+                                              northing=result.northing,
+                                              max_distance=AppConfig.INTERPOLATION_MASK_DISTANCE,
+                                              candidates=result.mask))
 
-    total_grid_df = pd.concat([grid.to_dataframe().dropna() for grid in grid_list])
-    uq, lq = df[col_to_interpolate].max(), df[col_to_interpolate].min()
-    total_grid_df_filtered = total_grid_df[(total_grid_df[col_to_interpolate] >= lq) & \
-                                           (total_grid_df[col_to_interpolate] <= uq)]
-
-    total_grid = total_grid_df_filtered.to_xarray()
+    result.clamp(df[col_to_interpolate].min(), df[col_to_interpolate].max())
 
     end_time = time.time()
 
     diff = end_time - start_time
 
     redis_queue.put(
-        f'interpolation;update__{Consts.LOADING_DISPLAY_STATE}; Grid Generated; Interpolated {len(total_grid_df_filtered)} points in  {diff} seconds')
+        f'interpolation;update__{Consts.LOADING_DISPLAY_STATE}; Grid Generated; Interpolated {result.count()} points in  {diff} seconds')
 
     save_path = export_to_tiff(region=region, spacing=spacing,
-                               grid=total_grid[col_to_interpolate], tiff_name=tiff_name)
+                               grid=result, tiff_name=tiff_name, crs=get_grid_crs(df),
+                               version=cache_key)
+
+    src = RasterRenderer.render(save_path, title)
 
-    plt.style.use('dark_background')
-    fig = plt.figure()
-    ax = fig.gca()
+    if preview:
+        raster_cache.put(cache_key, {'raster.tiff': save_path})
+        redis_queue.put(
+            f'interpolation;update__{Consts.LOADING_DISPLAY_STATE}; Preview Ready;Refining the grid to the requested spacing')
+        return src
 
-    fig_raster = show(rasterio.open(save_path), with_bounds=True, contour=False, title=f'{col_to_interpolate} Raster',
-                      ax=ax, cmap='RdBu_r')
-    im = fig_raster.get_images()[0]
-    fig_raster.set_ylabel('Northing')
-    fig_raster.set_xlabel('Easting')
-    fig.colorbar(im, ax=ax)
+    redis_queue.put(
+        f'interpolation;update__{Consts.FINISHED_DISPLAY_STATE}; Done;Grid Generated')
+
+    export_to_csv(result, col_to_interpolate, df_save_path)
+    raster_cache.put(cache_key, {'raster.tiff': save_path, 'grid.csv': df_save_path})
+    return src
 
-    df_save_path = os.path.join(
+
+def get_output_paths(tiff_name):
+    tiff_name = tiff_name.split('----')
+    save_path = os.path.join(
         AppConfig.PROJECT_ROOT,
-        "data",
-        tiff_name.split('----')[1],
-        "downloads",
-        f"{tiff_name.split('----')[0]}-{tiff_name.split('----')[2]}.csv"
+        'data',
+        tiff_name[1],
+        'downloads',
+        f'{tiff_name[0]}-{tiff_name[2]}'
     )
+    return f'{save_path}.tiff', f'{save_path}.csv'
 
-    redis_queue.put(
-        f'interpolation;update__{Consts.FINISHED_DISPLAY_STATE}; Done;Grid Generated')
 
-    total_grid_df_filtered.reset_index().to_csv(df_save_path)
-    return fig
+def get_raster_cache():
+    return DiskCache(AppConfig.RASTER_CACHE_DIR, AppConfig.RASTER_CACHE_MAX_BYTES)
 
 
-@cache.memoize(timeout=5000)
-def extract_grid(col_to_interpolate, fitted_interpolator, region, spacing):
-    grid = fitted_interpolator.grid(spacing=spacing,
-                                    region=region,
-                                    dims=["Northing", "Easting"],
-                                    data_names=col_to_interpolate)
-    return grid
+def get_raster_cache_key(df, tiff_name, col_to_interpolate, interpolation_type, spacing, tiled):
+    # The dataset id alone isn't enough, the same dataset is re-processed in place between interpolations
+    dataset_id = tiff_name.split('----')[2]
+    dataset_version = DatasetFingerprint.of_frame(df[['Easting', 'Northing', col_to_interpolate]])
 
+    return DiskCache.make_key('raster', RASTER_FORMAT_VERSION, dataset_id, dataset_version, col_to_interpolate,
+                              interpolation_type, float(spacing), AppConfig.INTERPOLATION_MASK_DISTANCE, bool(tiled))
 
-@cache.memoize(timeout=5000)
-def split_dataframe(df):
-    MAX_INDICES_SINGLE_LOOP = 500000
-    split_dfs = []
-    for i in range(math.ceil(df.shape[0] / MAX_INDICES_SINGLE_LOOP)):
-        start = i * MAX_INDICES_SINGLE_LOOP
-        end = min(start + MAX_INDICES_SINGLE_LOOP, df.shape[0])
-        split_dfs.append(df.iloc[start:end])
-    return split_dfs
 
+def get_cancel_flag(tiff_name):
+    # Watched by the running interpolation between its stages and tiles
+    return RedisFlag(name=f'interpolation-cancel:{tiff_name}', timeout=AppConfig.INTERPOLATION_CANCEL_TIMEOUT)
 
-@cache.memoize(timeout=5000)
-def process_sub_grid(grid_df, coordinates, max_distance=400):
-    grid = grid_df.to_xarray()
-    grid = vd.distance_mask(coordinates, maxdist=max_distance, grid=grid)
-    return grid
 
+def progressive_interpolate(df, col_to_interpolate, interpolation_type, spacing, tiff_name, tiled=False,
+                            on_preview=None, is_cancelled=None):
+    """
+    Grids at a coarse spacing first and hands that rendered image to on_preview, then grids at the requested spacing.
+    None once is_cancelled turns true, checked between the two grids and between the stages and tiles of each.
+    """
+    preview_spacing = spacing * AppConfig.INTERPOLATION_PREVIEW_FACTOR
+    region = vd.get_region((df.Easting, df.Northing))
 
-@cache.memoize(timeout=5000)
-def fit_interpolator(interpolation_type, spacing, coordinates, interpolation_values):
-    interpolator = get_interpolator(interpolation_type, spacing)
-    interpolator.fit(coordinates, interpolation_values)
-    return interpolator
+    # Not worth a preview when the coarse grid would only be a handful of nodes across
+    if on_preview is not None and \
+            min(region[1] - region[0], region[3] - region[2]) / preview_spacing >= AppConfig.INTERPOLATION_PREVIEW_MIN_NODES:
+        preview_src = verde_interpolate(df=df,
+                                        col_to_interpolate=col_to_interpolate,
+                                        interpolation_type=interpolation_type,
+                                        spacing=preview_spacing,
+                                        tiff_name=tiff_name,
+                                        tiled=tiled,
+                                        preview=True,
+                                        is_cancelled=is_cancelled)
+        if preview_src is not None:
+            on_preview(preview_src)
+
+    src = None
+    if is_cancelled is None or not is_cancelled():
+        src = verde_interpolate(df=df,
+                                col_to_interpolate=col_to_interpolate,
+                                interpolation_type=interpolation_type,
+                                spacing=spacing,
+                                tiff_name=tiff_name,
+                                tiled=tiled,
+                                is_cancelled=is_cancelled)
+
+    if src is None:
+        RedisQueue(name='app-notifications').put(
+            f'interpolation;update__{Consts.FINISHED_DISPLAY_STATE};Cancelled;Interpolation cancelled')
+    return src
+
+
+@memoize_frames(timeout=5000)
+def fit_trend(points, col_to_interpolate):
+    """Second degree trend of the column, fitted once per dataset version"""
+    coordinates = (points['Easting'].to_numpy(), points['Northing'].to_numpy())
+    return vd.Trend(degree=2).fit(coordinates, points[col_to_interpolate].to_numpy(dtype=np.float64))
+
+
+@memoize_frames(timeout=5000)
+def reduce_points(points, col_to_interpolate, spacing):
+    """Block means of the detrended column at the grid spacing, the points every interpolator type is fitted on"""
+    coordinates = (points['Easting'].to_numpy(), points['Northing'].to_numpy())
+    residuals = points[col_to_interpolate].to_numpy(dtype=np.float64) - \
+        fit_trend(points, col_to_interpolate).predict(coordinates)
+
+    return vd.BlockReduce(np.mean, spacing=spacing).filter(coordinates, residuals)
+
+
+def add_trend(grid: GridResult, trend):
+    # Broadcast views of the axes rather than a meshgrid, the trend is added to the grid in place
+    grid_easting, grid_northing = np.broadcast_arrays(grid.easting[np.newaxis, :], grid.northing[:, np.newaxis])
+    grid.values += trend.predict((grid_easting, grid_northing))
+    return grid
 
 
-@cache.memoize(timeout=5000)
 def get_interpolator(interpolation_type, spacing):
     if interpolation_type == 'Linear':
-        interpolator = vd.Chain([
-            ("trend", vd.Trend(degree=2)),
-            ("reduce", vd.BlockReduce(np.mean, spacing=spacing)),
-            ("interpolation", vd.Linear())
-        ])
+        return vd.Linear()
+    if interpolation_type == 'Nearest Neighbour':
+        return NearestNeighbour()
+    if interpolation_type == 'Inverse Distance':
+        return InverseDistance()
+    if interpolation_type == 'Minimum Curvature':
+        return MinimumCurvature(spacing=spacing)
+    return vd.Cubic()
+
+
+def get_grid_crs(df):
+    """UTM CRS of the survey's Easting/Northing, from its Zone column and which side of the equator it lies"""
+    if 'Zone' not in df.columns or df['Zone'].dropna().empty:
+        return None
+
+    zone = str(df['Zone'].dropna().iloc[0]).strip().upper()
+    zone_number = ''.join(ch for ch in zone if ch.isdigit())
+    suffix = ''.join(ch for ch in zone if ch.isalpha())
+
+    if not zone_number or not 1 <= int(zone_number) <= 60:
+        return None
+
+    latitude = pd.to_numeric(df['Latitude'], errors='coerce').dropna() if 'Latitude' in df.columns else None
+    if latitude is not None and not latitude.empty:
+        northern = latitude.median() >= 0
+    elif suffix in ('NORTH', 'SOUTH'):
+        northern = suffix == 'NORTH'
+    elif len(suffix) == 1 and suffix in UTM_LATITUDE_BANDS:
+        # Latitude bands N to X are north of the equator, 'S' is a band too, not south
+        northern = suffix >= 'N'
     else:
-        interpolator = vd.Chain([
-            ("trend", vd.Trend(degree=2)),
-            ("reduce", vd.BlockReduce(np.mean, spacing=spacing)),
-            ("interpolation", vd.Cubic())
-        ])
-    return interpolator
+        northern = True
 
+    return f'EPSG:{32600 + int(zone_number) if northern else 32700 + int(zone_number)}'
 
-def export_to_tiff(region, spacing, grid, tiff_name):
-    tiff_name = tiff_name.split('----')
-    save_path = os.path.join(
-        AppConfig.PROJECT_ROOT,
-        'data',
-        tiff_name[1],
-        'downloads',
-        f'{tiff_name[0]}-{tiff_name[2]}'
-    )
+
+def export_to_csv(grid: GridResult, col_to_interpolate, save_path, chunk_rows=CSV_CHUNK_ROWS):
+    """Unmasked nodes written a band of grid rows at a time, so only one band is ever held as a DataFrame"""
+    written = 0
+    with open(save_path, 'w', newline='') as f:
+        for start in range(0, grid.shape[0], chunk_rows):
+            northing, easting, values = grid.get_nodes(slice(start, start + chunk_rows))
+            chunk = pd.DataFrame({'Northing': northing, 'Easting': easting, col_to_interpolate: values},
+                                 index=pd.RangeIndex(written, written + len(values)))
+            chunk.to_csv(f, header=start == 0)
+            written += len(values)
+
+    return save_path
+
+
+def export_to_tiff(region, spacing, grid: GridResult, tiff_name, crs=None, version=None):
+    save_path, _ = get_output_paths(tiff_name)
 
     meta = {
+        "driver": "GTiff",
         "count": 1,
         "dtype": "float32",
         "height": grid.shape[0],
         "width": grid.shape[1],
+        "nodata": np.nan,
+        "crs": crs,
         "transform": from_origin(
             region[0], region[3], spacing, spacing
         ),
     }
 
-    # Save the interpolated points to a GeoTIFF file
-    with rio.open(f'{save_path}.tiff', "w", **meta) as dst:
-        dst.write(np.flip(grid, 0), 1)
+    # Written as a cloud-optimized GeoTIFF: tiled, compressed and with internal overviews, so previews and
+    # GIS tools can read just the window and resolution they need
+    with MemoryFile() as memfile:
+        with memfile.open(**meta) as dst:
+            dst.write(grid.get_raster().astype(np.float32), 1)
+            if version is not None:
+                # Renders of the raster are cached under this tag rather than the file's path and mtime
+                dst.update_tags(**{RasterRenderer.VERSION_TAG: version})
+
+        with memfile.open() as src:
+            rio_copy(src, save_path, driver='COG', blocksize=COG_BLOCK_SIZE, compress='DEFLATE', predictor='YES',
+                     overview_resampling='average', overviews='AUTO')
 
-    return f'{save_path}.tiff'
+    return save_path
@@ -1,27 +1,337 @@
 import os.path
+import threading
 import uuid
+from collections import OrderedDict
 
 import numpy as np
 import pandas as pd
 from flask import session
 
 import AppConfig
-from FlaskCache import cache
+from FlaskCache import memoize_frames
 from auth import AppIDAuthProvider
+from utils.AlignmentUtils import AlignmentUtils
+from utils.ColumnarCache import ColumnarCache
+from utils.DatasetFingerprint import DatasetFingerprint
+from utils.DatetimeUtils import DatetimeUtils
+from utils.SmoothingUtils import SmoothingUtils
+from utils.StreamingUtils import BoxcarStream, LinearGapStream
 
 
 class ResidualService:
+    # Last residual arrays per dataset in this worker, patched when only new clips are added. A stored state is
+    # never changed, patches go to a copy that replaces it, so request threads never see one half patched
+    INCREMENTAL_STATE = OrderedDict()
+    INCREMENTAL_LOCK = threading.Lock()
+    INCREMENTAL_STATE_SIZE = 4
+    INCREMENTAL_MAX_FRACTION = 0.2
+
+    @classmethod
+    @memoize_frames(timeout=50000)
+    def get_cleaned_frame(cls, df, dataset_key):
+        print('Cleaning residual input')
+
+        df = df.set_index('Datetime')
+        df = df[~df.index.duplicated(keep='first')]
+        df = df.sort_index().reset_index()
+
+        df['id'] = [str(uuid.uuid4()) for _ in range(len(df.index))]
+
+        return df
+
+    @classmethod
+    @memoize_frames(timeout=50000)
+    def get_clip_mask(cls, field: pd.Series, points_to_clip=(), min_val=None, max_val=None):
+        clip_mask = np.zeros(len(field), dtype=bool)
+
+        if min_val is not None and max_val is not None:
+            clip_mask |= (field.le(min_val) | field.ge(max_val)).to_numpy()
+
+        if len(points_to_clip) > 0:
+            clip_mask[[p for p in points_to_clip if 0 <= p < len(field)]] = True
+
+        return clip_mask
+
+    @classmethod
+    @memoize_frames(timeout=50000)
+    def get_clipped_field(cls, df, dataset_key, points_to_clip=(), min_val=None, max_val=None):
+        field = cls.get_cleaned_frame(df, dataset_key)['Magnetic_Field']
+
+        clip_mask = cls.get_clip_mask(field, points_to_clip, min_val, max_val)
+
+        if clip_mask.any():
+            field = field.mask(clip_mask).interpolate(method='linear')
+
+        return field.to_numpy(dtype=np.float64)
+
+    @classmethod
+    @memoize_frames(timeout=50000)
+    def get_observed_smoothed(cls, df, dataset_key, points_to_clip, min_val, max_val, observed_smoothing_constant):
+        return SmoothingUtils.boxcar_mean(cls.get_clipped_field(df, dataset_key, points_to_clip, min_val, max_val),
+                                          window=observed_smoothing_constant,
+                                          center=True, min_periods=1)
+
+    @classmethod
+    @memoize_frames(timeout=50000)
+    def get_ambient(cls, df, dataset_key, points_to_clip, min_val, max_val,
+                    observed_smoothing_constant, ambient_smoothing_constant):
+        return SmoothingUtils.boxcar_mean(cls.get_observed_smoothed(df, dataset_key, points_to_clip, min_val, max_val,
+                                                                    observed_smoothing_constant),
+                                          window=ambient_smoothing_constant,
+                                          center=False, min_periods=1)
+
+    @classmethod
+    def patch_residual_state(cls, state, clip_mask):
+        raw, field, smoothed, ambient = state['raw'], state['field'], state['smoothed'], state['ambient']
+        n = len(raw)
+
+        new_points = np.flatnonzero(clip_mask & ~state['clip_mask'])
+        valid_idx = np.flatnonzero(~clip_mask & ~np.isnan(raw))
+
+        if len(new_points) == 0 or len(valid_idx) == 0:
+            return len(new_points) == 0
+
+        # Every new point sits in a gap between two valid readings, only those gaps are re-interpolated
+        gap_pos = np.searchsorted(valid_idx, new_points)
+        gap_lo = np.where(gap_pos > 0, valid_idx[np.maximum(gap_pos - 1, 0)], -1)
+        gap_hi = np.where(gap_pos < len(valid_idx), valid_idx[np.minimum(gap_pos, len(valid_idx) - 1)], n)
+        gaps = sorted(set(zip(gap_lo.tolist(), gap_hi.tolist())))
+
+        obs_behind, obs_ahead = SmoothingUtils.get_window_offsets(state['observed_smoothing_constant'], center=True)
+        amb_behind, _ = SmoothingUtils.get_window_offsets(state['ambient_smoothing_constant'], center=False)
+
+        # A changed field value moves the centred mean around it and the trailing mean after it
+        ranges = []
+        for lo, hi in gaps:
+            start = max(lo + 1 - obs_ahead, 0)
+            end = min(hi - 1 + obs_behind + amb_behind, n - 1)
+            if ranges and start <= ranges[-1][1] + 1:
+                ranges[-1][1] = max(ranges[-1][1], end)
+            else:
+                ranges.append([start, end])
+
+        if sum(end - start + 1 for start, end in ranges) > cls.INCREMENTAL_MAX_FRACTION * n:
+            return False
+
+        for lo, hi in gaps:
+            gap = np.arange(lo + 1, hi)
+            if lo < 0:
+                field[gap] = np.nan
+            elif hi >= n:
+                field[gap] = raw[lo]
+            else:
+                field[gap] = np.interp(gap, [lo, hi], [raw[lo], raw[hi]])
+
+        for start, end in ranges:
+            seg_start, seg_end = max(start - obs_behind, 0), min(end + obs_ahead, n - 1)
+            smoothed[start:end + 1] = SmoothingUtils.boxcar_mean(
+                field[seg_start:seg_end + 1], window=state['observed_smoothing_constant'],
+                center=True, min_periods=1)[start - seg_start:end - seg_start + 1]
+
+            seg_start = max(start - amb_behind, 0)
+            ambient[start:end + 1] = SmoothingUtils.boxcar_mean(
+                smoothed[seg_start:end + 1], window=state['ambient_smoothing_constant'],
+                center=False, min_periods=1)[start - seg_start:]
+
+        state['clip_mask'] = clip_mask
+        return True
+
+    @classmethod
+    def get_incremental_arrays(cls, df, raw: pd.Series, dataset_key, points_to_clip, min_val, max_val,
+                               observed_smoothing_constant, ambient_smoothing_constant):
+        params = (DatasetFingerprint.of_frame(df), min_val, max_val,
+                  observed_smoothing_constant, ambient_smoothing_constant)
+        clip_mask = cls.get_clip_mask(raw, points_to_clip, min_val, max_val)
+
+        with cls.INCREMENTAL_LOCK:
+            state = cls.INCREMENTAL_STATE.get(dataset_key)
+
+        # Patching only works forward from a field whose own gaps are already interpolated
+        patchable = state is not None and state['params'] == params \
+            and (state['clip_mask'].any() or not np.isnan(state['raw']).any()) \
+            and not (state['clip_mask'] & ~clip_mask).any()
+        new_clips = int((clip_mask & ~state['clip_mask']).sum()) if patchable else 0
+
+        if patchable:
+            state = dict(state, field=state['field'].copy(), smoothed=state['smoothed'].copy(),
+                         ambient=state['ambient'].copy())
+
+        if patchable and cls.patch_residual_state(state, clip_mask):
+            print(f'Patched residuals for {new_clips} new clipped points')
+        else:
+            clip_args = (dataset_key, points_to_clip, min_val, max_val)
+            state = {
+                'params': params,
+                'clip_mask': clip_mask,
+                'raw': raw.to_numpy(dtype=np.float64),
+                'field': cls.get_clipped_field(df, *clip_args),
+                'smoothed': cls.get_observed_smoothed(df, *clip_args, observed_smoothing_constant),
+                'ambient': cls.get_ambient(df, *clip_args, observed_smoothing_constant, ambient_smoothing_constant),
+                'observed_smoothing_constant': observed_smoothing_constant,
+                'ambient_smoothing_constant': ambient_smoothing_constant
+            }
+
+        with cls.INCREMENTAL_LOCK:
+            cls.INCREMENTAL_STATE[dataset_key] = state
+            cls.INCREMENTAL_STATE.move_to_end(dataset_key)
+            while len(cls.INCREMENTAL_STATE) > cls.INCREMENTAL_STATE_SIZE:
+                cls.INCREMENTAL_STATE.popitem(last=False)
+
+        return state['field'].copy(), state['smoothed'].copy(), state['ambient'].copy()
+
+    @classmethod
+    def normalize_clip_args(cls, points_to_clip=None, min_val=None, max_val=None):
+        points_to_clip = tuple(sorted(set(int(p) for p in points_to_clip))) if points_to_clip else ()
+        min_val, max_val = (float(min_val), float(max_val)) if min_val and max_val else (None, None)
+        return points_to_clip, min_val, max_val
+
+    @classmethod
+    def get_field_column(cls, columns):
+        return 'Magnetic_Field_Corrected' if 'Magnetic_Field_Corrected' in columns else 'Magnetic_Field'
+
+    @classmethod
+    def get_first_occurrences(cls, datetimes, last_datetime=None):
+        # Rows are sorted, so a duplicate timestamp always follows the reading it repeats
+        kept = np.ones(len(datetimes), dtype=bool)
+        kept[1:] = datetimes[1:] != datetimes[:-1]
+        if last_datetime is not None and len(datetimes) > 0:
+            kept[0] = datetimes[0] != last_datetime
+        return kept
+
+    @classmethod
+    def scan_survey(cls, source_path, points_to_clip, min_val, max_val, chunk_size):
+        field_col = cls.get_field_column(ColumnarCache.get_columns(source_path))
+
+        last_datetime = None
+        n = 0
+        any_clipped = False
+
+        for chunk in ColumnarCache.iter_chunks(source_path, columns=['Datetime', field_col], chunk_size=chunk_size):
+            datetimes = chunk['Datetime'].to_numpy()
+
+            if len(datetimes) == 0:
+                continue
+            if np.isnat(datetimes).any() or (datetimes[1:] < datetimes[:-1]).any() \
+                    or (last_datetime is not None and datetimes[0] < last_datetime):
+                return None, False
+
+            kept = cls.get_first_occurrences(datetimes, last_datetime)
+            field = chunk[field_col].to_numpy(dtype=np.float64)[kept]
+
+            if min_val is not None and max_val is not None:
+                any_clipped |= bool(((field <= min_val) | (field >= max_val)).any())
+
+            n += int(kept.sum())
+            last_datetime = datetimes[-1]
+
+        any_clipped |= any(0 <= p < n for p in points_to_clip)
+
+        return n, any_clipped
+
+    @classmethod
+    def calculate_residuals_streaming(cls, source_path,
+                                      observed_smoothing_constant=100,
+                                      ambient_smoothing_constant=500,
+                                      points_to_clip=None,
+                                      session_store=None,
+                                      min_val=None,
+                                      max_val=None,
+                                      chunk_size=AppConfig.RESIDUAL_CHUNK_SIZE):
+
+        extracted_path = os.path.join(AppConfig.PROJECT_ROOT, "data",
+                                      session_store[AppIDAuthProvider.APPID_USER_NAME], "processed",
+                                      f'{session_store[AppConfig.WORKING_DATASET]}_resid.csv')
+
+        points_to_clip, min_val, max_val = cls.normalize_clip_args(points_to_clip, min_val, max_val)
+
+        # Chunks can only be smoothed in order when the survey is already sorted by time,
+        # otherwise the caller falls back to the in-memory path
+        n, any_clipped = cls.scan_survey(source_path, points_to_clip, min_val, max_val, chunk_size)
+        if not n:
+            print('Survey is empty or not sorted by time, streaming residuals skipped')
+            return None
+
+        print('Calculate Residuals (streaming) got called')
+
+        clip_points = np.asarray(points_to_clip, dtype=np.int64)
+        field_col = cls.get_field_column(ColumnarCache.get_columns(source_path))
+
+        gap_stream = LinearGapStream(interpolate=any_clipped)
+        observed_stream = BoxcarStream(observed_smoothing_constant, center=True, min_periods=1)
+        ambient_stream = BoxcarStream(ambient_smoothing_constant, center=False, min_periods=1)
+
+        pending_rows = []
+        field_buffer, smoothed_buffer = np.array([]), np.array([])
+        last_datetime = None
+        position = 0
+        written = 0
+
+        def write_rows(field, smoothed, ambient):
+            nonlocal pending_rows, field_buffer, smoothed_buffer, written
+
+            field_buffer = np.concatenate((field_buffer, field))
+            smoothed_buffer = np.concatenate((smoothed_buffer, smoothed))
+
+            count = len(ambient)
+            if count == 0:
+                return
+
+            rows = pd.concat(pending_rows, ignore_index=True) if len(pending_rows) > 1 else pending_rows[0]
+            out = rows.iloc[:count].copy()
+            pending_rows = [rows.iloc[count:].reset_index(drop=True)]
+
+            out['Magnetic_Field'] = field_buffer[:count]
+            out['Magnetic_Field_Smoothed'] = smoothed_buffer[:count]
+            out['Magnetic_Field_Ambient'] = ambient
+            out['Baseline'] = out['Magnetic_Field_Smoothed'] - out['Magnetic_Field_Ambient']
+            out.index = pd.RangeIndex(written, written + count)
+
+            out.to_csv(extracted_path, mode='w' if written == 0 else 'a', header=written == 0)
+
+            field_buffer, smoothed_buffer = field_buffer[count:], smoothed_buffer[count:]
+            written += count
+
+        for chunk in ColumnarCache.iter_chunks(source_path, chunk_size=chunk_size):
+            datetimes = chunk['Datetime'].to_numpy()
+            if len(datetimes) == 0:
+                continue
+
+            chunk = chunk[cls.get_first_occurrences(datetimes, last_datetime)].reset_index(drop=True)
+            last_datetime = datetimes[-1]
+
+            if field_col != 'Magnetic_Field':
+                chunk['Magnetic_Field'] = chunk[field_col]
+            chunk = chunk[['Datetime'] + [col for col in chunk.columns if col != 'Datetime']]
+            chunk['id'] = [str(uuid.uuid4()) for _ in range(len(chunk.index))]
+
+            raw = chunk['Magnetic_Field'].to_numpy(dtype=np.float64)
+            clip_mask = np.isin(np.arange(position, position + len(raw)), clip_points)
+            if min_val is not None and max_val is not None:
+                clip_mask |= (raw <= min_val) | (raw >= max_val)
+            position += len(raw)
+
+            pending_rows.append(chunk)
+
+            field = gap_stream.push(np.where(clip_mask, np.nan, raw))
+            smoothed = observed_stream.push(field)
+            write_rows(field, smoothed, ambient_stream.push(smoothed))
+
+        field = gap_stream.finish()
+        smoothed = np.concatenate((observed_stream.push(field), observed_stream.finish()))
+        write_rows(field, smoothed, np.concatenate((ambient_stream.push(smoothed), ambient_stream.finish())))
+
+        return extracted_path
 
     @classmethod
-    @cache.memoize(timeout=50000,
-                   args_to_ignore=['df', 'session_store'])
     def calculate_residuals(cls, df,
                             df_name,
                             observed_smoothing_constant=100,
                             ambient_smoothing_constant=500,
                             points_to_clip=None,
                             session_store=None,
-                            purpose='display'):
+                            purpose='display',
+                            min_val=None,
+                            max_val=None):
 
         extracted_path = None
         if session_store:
@@ -31,32 +341,28 @@ class ResidualService:
 
         print('Calculate Residuals got called')
 
-        df['id'] = [uuid.uuid4() for _ in range(len(df.index))]
+        # Each stage is cached on the dataset and only the parameters it depends on, so moving the
+        # ambient slider reuses the cleaned, clipped and observed-smoothed arrays
+        dataset_key = df_name if df_name else session_store[AppConfig.WORKING_DATASET] if session_store else None
+        points_to_clip, min_val, max_val = cls.normalize_clip_args(points_to_clip, min_val, max_val)
 
-        df.set_index('Datetime', inplace=True)
-        df = df[~df.index.duplicated(keep='first')]
-        df = df.sort_index().reset_index()
-
-        df['Magnetic_Field_Smoothed'] = df['Magnetic_Field'].rolling(window=observed_smoothing_constant,
-                                                                     win_type='boxcar', center=True,
-                                                                     min_periods=1).mean()
+        resid_df = cls.get_cleaned_frame(df, dataset_key)
 
-        df['Magnetic_Field_Ambient'] = df['Magnetic_Field_Smoothed'] \
-            .rolling(window=ambient_smoothing_constant,
-                     win_type='boxcar',
-                     center=False,
-                     min_periods=1).mean()
+        field, smoothed, ambient = cls.get_incremental_arrays(df, resid_df['Magnetic_Field'], dataset_key,
+                                                              points_to_clip, min_val, max_val,
+                                                              observed_smoothing_constant, ambient_smoothing_constant)
+        resid_df['Magnetic_Field'] = field
+        resid_df['Magnetic_Field_Smoothed'] = smoothed
+        resid_df['Magnetic_Field_Ambient'] = ambient
 
-        df['Baseline'] = df['Magnetic_Field_Smoothed'] - df['Magnetic_Field_Ambient']
+        resid_df['Baseline'] = resid_df['Magnetic_Field_Smoothed'] - resid_df['Magnetic_Field_Ambient']
 
         if purpose == 'save':
-            df.to_csv(extracted_path)
+            resid_df.to_csv(extracted_path)
 
-        return df if purpose != 'save' else extracted_path
+        return resid_df if purpose != 'save' else extracted_path
 
     @classmethod
-    @cache.memoize(timeout=50000,
-                   args_to_ignore=['df', 'session_store'])
     def calculate_residuals_with_clip(cls, df,
                                       df_name,
                                       observed_smoothing_constant=100,
@@ -67,79 +373,49 @@ class ResidualService:
                                       max_val=None,
                                       purpose='save'):
 
-        if min_val and max_val:
-            df['Magnetic_Field'] = df['Magnetic_Field'].mask(df['Magnetic_Field'].le(float(min_val)))
-
-            df['Magnetic_Field'] = df['Magnetic_Field'].mask(df['Magnetic_Field'].ge(float(max_val)))
-
-            df['Magnetic_Field'] = df['Magnetic_Field'].interpolate(method='linear')
-
-        if len(points_to_clip) > 0:
-            df.loc[points_to_clip, 'Magnetic_Field'] = np.nan
-            df['Magnetic_Field'] = df['Magnetic_Field'].interpolate(method='linear')
-
-        return cls.calculate_residuals(df, df_name=None,
+        return cls.calculate_residuals(df, df_name=df_name,
                                        ambient_smoothing_constant=ambient_smoothing_constant,
                                        observed_smoothing_constant=observed_smoothing_constant,
                                        points_to_clip=points_to_clip,
                                        purpose=purpose,
-                                       session_store=session)
+                                       session_store=session_store if session_store else session,
+                                       min_val=min_val,
+                                       max_val=max_val)
 
     @classmethod
-    @cache.memoize(timeout=50000, args_to_ignore=['df'])
+    @memoize_frames(timeout=50000)
     def calculate_diurnal_correction(cls,
                                      df_surf: pd.DataFrame,
-                                     df_obs: pd.DataFrame, session_store):
-
-        obs_ids = ';'.join(session_store[AppConfig.OBS_DATA_SELECTED])
-
-        extracted_path = os.path.join(AppConfig.PROJECT_ROOT, "data",
-                                      session_store[AppIDAuthProvider.APPID_USER_NAME], "processed",
-                                      f'{session_store[AppConfig.SURVEY_DATA_SELECTED]}_{obs_ids}_durn.csv')
-
-        if os.path.exists(extracted_path):
-            return pd.read_csv(extracted_path)
+                                     df_obs):
 
         print('Calculate Diurnal got called')
 
-        min_survey_date = df_surf['Datetime'].min()
-        max_survey_date = df_surf['Datetime'].max()
+        obs_frames = df_obs if isinstance(df_obs, (list, tuple)) else [df_obs]
 
-        df_obs = df_obs[(df_obs['Datetime'] >= min_survey_date) & (df_obs['Datetime'] <= max_survey_date)]
+        df_surf = DatetimeUtils.restore(df_surf)
+        df_surf = df_surf.sort_values('Datetime', kind='stable').set_index('Datetime')
 
-        df_surf['Datetime'] = pd.to_datetime(df_surf['Datetime'], format='mixed')
-        df_obs['Datetime'] = pd.to_datetime(df_obs['Datetime'], format='mixed')
+        survey_times = AlignmentUtils.to_nanoseconds(df_surf.index)
+        tolerance = pd.Timedelta(AppConfig.DIURNAL_ALIGNMENT_TOLERANCE).value
 
-        df_surf.set_index('Datetime', inplace=True)
-        df_obs.set_index('Datetime', inplace=True)
+        obs_times, obs_values = AlignmentUtils.merge_sources(
+            obs_frames,
+            start=survey_times[0] - tolerance if len(survey_times) else None,
+            end=survey_times[-1] + tolerance if len(survey_times) else None)
 
-        survey_sampling_rate = df_surf.head(10000).index.to_series().diff().median().total_seconds()
-        observatory_sampling_rate = df_obs.head(10000).index.to_series().diff().median().total_seconds()
+        # Observatory readings interpolated onto every survey timestamp, instead of resampling the observatory
+        # and keeping only the timestamps that happen to match exactly
+        aligned = AlignmentUtils.interpolate_at(survey_times, obs_times, obs_values,
+                                                tolerance=AppConfig.DIURNAL_ALIGNMENT_TOLERANCE)
+        matched = ~np.isnan(aligned)
 
-        if observatory_sampling_rate != survey_sampling_rate:
+        print(f'Aligned {matched.sum()} of {len(matched)} survey readings to the observatory')
 
-            if 0 < survey_sampling_rate < 1:
-                sample_rate = f'{str(survey_sampling_rate).split(".")[-1].ljust(3, "0")}ms'
-            else:
-                sample_rate = f'{survey_sampling_rate}s'
-
-            df_obs = df_obs[~df_obs.index.duplicated(keep='first')]
-            df_obs = df_obs.resample(sample_rate).interpolate(method='linear', limit=5, limit_direction='both')
-
-        df_obs = df_obs[(df_obs.index >= df_surf.index.min()) & (df_obs.index <= df_surf.index.max())]
+        smoothed = SmoothingUtils.boxcar_mean(aligned[matched], window=100, center=True, min_periods=1)
+        smoothed = smoothed - smoothed.mean() if len(smoothed) > 0 else smoothed
 
-        df_obs = df_obs[df_obs.index.isin(df_surf.index)].sort_index()
-        df_obs['Magnetic_Field_Smoothed'] = df_obs['Magnetic_Field'] \
-            .rolling(window=100, min_periods=1, win_type='boxcar', center=True).mean()
-        df_obs['Magnetic_Field_Smoothed'] = df_obs['Magnetic_Field_Smoothed'] - df_obs['Magnetic_Field_Smoothed'].mean()
-
-        df_surf = df_surf[df_surf.index.isin(df_obs.index)].sort_index()
-
-        df_surf['Magnetic_Field_Corrected'] = df_surf['Magnetic_Field'] - df_obs['Magnetic_Field_Smoothed'].abs()
+        df_surf = df_surf[matched].assign(Magnetic_Field_Corrected=lambda d: d['Magnetic_Field'] - np.abs(smoothed))
 
         df_surf['Magnetic_Field_Corrected'] = df_surf['Magnetic_Field_Corrected'].fillna(df_surf['Magnetic_Field'])
 
-        df_to_return = df_surf.dropna(subset=['Magnetic_Field_Corrected']).reset_index()
-        df_to_return.to_csv(extracted_path)
-
-        return df_to_return
+        return df_surf.dropna(subset=['Magnetic_Field_Corrected']).reset_index()
@@ -0,0 +1,184 @@
+import io
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+import datashader as ds
+import datashader.transfer_functions as tf
+import numpy as np
+import plotly.colors
+import pyarrow as pa
+from PIL import Image
+from datashader.utils import lnglat_to_meters
+from flask import has_request_context, request
+
+import AppConfig
+from utils.DatasetFingerprint import DatasetFingerprint
+from utils.DiskCache import DiskCache
+
+
+class TileService:
+    """
+    XYZ map tiles rendered with datashader from every reading of a survey. Sources are registered by the
+    figure that shows them and tiles are kept in an LRU, so panning back and forth never re-renders.
+    The projected points of a source are written to an on-disk cache shared by every process, a figure built in a
+    background worker gets its tiles from the web process.
+    """
+
+    TILE_SIZE = 256
+    WEB_MERCATOR_HALF_EXTENT = 20037508.342789244
+
+    POINTS_FILE = 'points.arrow'
+
+    # Sources opened by this process. They're memory-mapped, their pages are shared with every other process
+    SOURCES = OrderedDict()
+    SOURCES_SIZE = 8
+
+    TILE_CACHE = OrderedDict()
+    TILE_CACHE_SIZE = 2048
+
+    LOCK = threading.Lock()
+
+    @classmethod
+    def get_cache(cls):
+        return DiskCache(AppConfig.TILE_SOURCE_DIR, AppConfig.TILE_SOURCE_MAX_BYTES)
+
+    @classmethod
+    def register_source(cls, df, col_to_plot, latitude_col='Latitude', longitude_col='Longitude',
+                        color_scale='icefire'):
+        source_key = DiskCache.make_key('tile-source', DatasetFingerprint.of_frame(
+            df[[latitude_col, longitude_col, col_to_plot]]), color_scale)
+
+        cache = cls.get_cache()
+        if cache.get(source_key) is not None:
+            return source_key
+
+        x, y = lnglat_to_meters(df[longitude_col].to_numpy(dtype=np.float64, na_value=np.nan),
+                                df[latitude_col].to_numpy(dtype=np.float64, na_value=np.nan))
+        values = df[col_to_plot].to_numpy(dtype=np.float64, na_value=np.nan)
+
+        keep = ~(np.isnan(x) | np.isnan(y))
+        # Sorted by x so a tile only hands datashader the points inside its column of the map
+        order = np.argsort(x[keep], kind='stable')
+        points = pa.table({'x': x[keep][order], 'y': y[keep][order], 'value': values[keep][order]})
+
+        # One colour span for the whole survey, otherwise neighbouring tiles would not agree
+        span = (float(np.nanmin(values)), float(np.nanmax(values))) if np.isfinite(values).any() else (0.0, 1.0)
+        points = points.replace_schema_metadata({'span': json.dumps(span), 'color_scale': color_scale})
+
+        tmp_path = os.path.join(cache.root, f'{source_key}.{uuid.uuid4().hex}.tmp')
+        try:
+            with pa.OSFile(tmp_path, 'wb') as f, pa.ipc.new_file(f, points.schema) as writer:
+                writer.write_table(points)
+            cache.put(source_key, {cls.POINTS_FILE: tmp_path})
+        finally:
+            os.remove(tmp_path)
+
+        return source_key
+
+    @classmethod
+    def get_source(cls, source_key):
+        if not DiskCache.is_key(source_key):
+            return None
+
+        with cls.LOCK:
+            if source_key in cls.SOURCES:
+                cls.SOURCES.move_to_end(source_key)
+                return cls.SOURCES[source_key]
+
+        cached = cls.get_cache().get(source_key)
+        if cached is None or cls.POINTS_FILE not in cached:
+            return None
+
+        try:
+            points = pa.ipc.open_file(pa.memory_map(cached[cls.POINTS_FILE])).read_all()
+        except FileNotFoundError:
+            # Evicted by another process in the meantime
+            return None
+
+        metadata = points.schema.metadata
+        source = {
+            'points': points,
+            'x': points.column('x').to_numpy(),
+            'span': tuple(json.loads(metadata[b'span'])),
+            'cmap': cls.get_palette(metadata[b'color_scale'].decode())
+        }
+
+        with cls.LOCK:
+            cls.SOURCES[source_key] = source
+            cls.SOURCES.move_to_end(source_key)
+            while len(cls.SOURCES) > cls.SOURCES_SIZE:
+                cls.SOURCES.popitem(last=False)
+
+        return source
+
+    @classmethod
+    def get_palette(cls, color_scale):
+        colors = [color for _, color in plotly.colors.get_colorscale(color_scale)]
+        return [f'#{int(r):02x}{int(g):02x}{int(b):02x}'
+                for r, g, b in (plotly.colors.unlabel_rgb(c) for c in plotly.colors.convert_colors_to_same_type(
+                    colors, colortype='rgb')[0])]
+
+    @classmethod
+    def get_tile_url(cls, source_key):
+        root = request.host_url.rstrip('/') if has_request_context() else ''
+        return f'{root}/tiles/{source_key}/{{z}}/{{x}}/{{y}}.png'
+
+    @classmethod
+    def get_tile_bounds(cls, z, x, y):
+        tile_extent = 2 * cls.WEB_MERCATOR_HALF_EXTENT / (2 ** z)
+        x_min = -cls.WEB_MERCATOR_HALF_EXTENT + x * tile_extent
+        y_max = cls.WEB_MERCATOR_HALF_EXTENT - y * tile_extent
+        return (x_min, x_min + tile_extent), (y_max - tile_extent, y_max)
+
+    @classmethod
+    def get_blank_tile(cls):
+        buffer = io.BytesIO()
+        Image.new('RGBA', (cls.TILE_SIZE, cls.TILE_SIZE), (0, 0, 0, 0)).save(buffer, format='PNG')
+        return buffer.getvalue()
+
+    @classmethod
+    def render_tile(cls, source_key, z, x, y):
+        tile_key = (source_key, z, x, y)
+
+        with cls.LOCK:
+            if tile_key in cls.TILE_CACHE:
+                cls.TILE_CACHE.move_to_end(tile_key)
+                return cls.TILE_CACHE[tile_key]
+
+        source = cls.get_source(source_key)
+        if source is None or z < 0 or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            return None
+
+        x_range, y_range = cls.get_tile_bounds(z, x, y)
+
+        # Survey lines are a pixel wide when zoomed out and are spread to stay visible. The tile is rendered
+        # with a border of that width and cropped, so spread points don't stop at the tile edge
+        spread = 1 if z >= 14 else 2
+        margin = spread * (x_range[1] - x_range[0]) / cls.TILE_SIZE
+        x_range = (x_range[0] - margin, x_range[1] + margin)
+        y_range = (y_range[0] - margin, y_range[1] + margin)
+
+        # Only the tile's column of the map is copied out of the mapped file
+        lo, hi = np.searchsorted(source['x'], x_range)
+        points = source['points'].slice(lo, hi - lo).to_pandas()
+        points = points[(points['y'] >= y_range[0]) & (points['y'] <= y_range[1])]
+
+        if len(points) == 0:
+            png = cls.get_blank_tile()
+        else:
+            canvas = ds.Canvas(plot_width=cls.TILE_SIZE + 2 * spread, plot_height=cls.TILE_SIZE + 2 * spread,
+                               x_range=x_range, y_range=y_range)
+            agg = canvas.points(points, 'x', 'y', agg=ds.mean('value'))
+            img = tf.spread(tf.shade(agg, cmap=source['cmap'], span=source['span'], how='linear'), px=spread)
+            png = img[spread:-spread, spread:-spread].to_bytesio(format='png').getvalue()
+
+        with cls.LOCK:
+            cls.TILE_CACHE[tile_key] = png
+            cls.TILE_CACHE.move_to_end(tile_key)
+            while len(cls.TILE_CACHE) > cls.TILE_CACHE_SIZE:
+                cls.TILE_CACHE.popitem(last=False)
+
+        return png
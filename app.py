@@ -8,14 +8,16 @@ import dash_uploader as du
 from dash import dcc, html, Patch, callback_context, no_update
 from dash.dependencies import Output, Input
 from dash.exceptions import PreventUpdate
-from flask import send_from_directory
+from flask import send_from_directory, abort, Response
 from flask import session
 
 from api.DatasetService import DatasetService
+from api.TileService import TileService
 from auth import AppIDAuthProvider
 from components import FileUploadTabs, Sidebar, Settings, Workspaces, Toast, \
     ModalComponent, NotificationProvider, AnnotationComponent
 from dataservices import InMermoryDataService
+from utils.DiskCache import DiskCache
 
 DASH_URL_BASE_PATHNAME = "/dashboard/"
 
@@ -56,6 +58,22 @@ def download(path):
     return send_from_directory(dir, data_path, as_attachment=True)
 
 
+@auth.flask.route("/tiles/<source_key>/<int:z>/<int:x>/<int:y>.png")
+@auth.check
+def survey_tile(source_key, z, x, y):
+    """Serve one map tile of a survey plotted by any worker."""
+    # The key names a directory of the tile source cache, anything but a cache key could point outside it
+    if not DiskCache.is_key(source_key):
+        abort(404)
+
+    png = TileService.render_tile(source_key, z, x, y)
+
+    if png is None:
+        abort(404)
+
+    return Response(png, mimetype='image/png', headers={'Cache-Control': 'private, max-age=3600'})
+
+
 app.layout = dmc.MantineProvider(
     children=dmc.NotificationsProvider(html.Div([
         dcc.Location(id="url"),
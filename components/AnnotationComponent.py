@@ -1,6 +1,5 @@
 import os
 import shutil
-import threading
 import time
 import uuid
 from typing import List
@@ -29,9 +28,10 @@ from api.DatasetTypeService import DatasetTypeService
 from api.dto import DatasetFilterDTO, DatasetsWithDatasetTypeDTO, DatasetUpdateDTO, CreateNewDatasetDTO, \
     CreateDatasetDTO
 from auth import AppIDAuthProvider
-from components import Toast, MapboxScatterPlot, DashUploader
+from components import Toast, MapboxScatterPlot, DashUploader, DecimatedLinePlot
 from dataservices.RedisQueue import RedisQueue
-from utils.AzureContainerHelper import BlobConnector
+from utils.UploadManager import UploadManager
+from utils.ColumnarCache import ColumnarCache
 from utils.Consts import Consts
 from utils.ExportUtils import ExportUtils
 
@@ -176,12 +176,12 @@ def manage_load_data_btn_state(project, dataset):
 
 
 @cache.memoize(timeout=50000)
-def get_or_download_dataframe(dataset_id, session_store):
+def get_or_download_dataframe(dataset_id, session_store, columns=None):
     dataset = DatasetService.get_dataset_by_id(dataset_id=dataset_id, session_store=session_store)
 
     if 'local_path' in dataset.tags and dataset_id in dataset.tags['local_path'] \
             and os.path.exists(dataset.tags['local_path'][dataset.id]):
-        ret_df = pd.read_csv(dataset.tags['local_path'][dataset.id])
+        ret_df = ColumnarCache.read(dataset.tags['local_path'][dataset.id], columns=columns)
 
         unnamed_cols = [col for col in ret_df.columns if 'unnamed' in col.lower()]
         ret_df = ret_df.drop(columns=unnamed_cols)
@@ -203,7 +203,7 @@ def get_or_download_dataframe(dataset_id, session_store):
     updated_dataset = DatasetService.update_dataset(dataset_id=dataset.id,
                                                     session_store=session_store,
                                                     dataset_update_dto=DatasetUpdateDTO(tags=dataset_tags))
-    ret_df = pd.read_csv(download_path)
+    ret_df = ColumnarCache.read(download_path, columns=columns)
     unnamed_cols = [col for col in ret_df.columns if 'unnamed' in col.lower()]
     ret_df = ret_df.drop(columns=unnamed_cols)
 
@@ -743,22 +743,41 @@ def get_residual_scatter_plot(df_id, session_store, col_to_plot):
 
     df = get_or_download_dataframe(dataset_id=df_id, session_store=session_store)
 
-    fig_residual = px.scatter(df.reset_index().iloc[0:50000], x='index', y=col_to_plot,
+    plot_points, pyramid_key = DecimatedLinePlot.get_plot_points(df[col_to_plot])
+
+    fig_residual = px.scatter(plot_points, x='index', y=col_to_plot,
                               labels={
                                   "index": "Index",
                                   col_to_plot: col_to_plot.replace('_', ' '),
                               }, title="Residuals vs Recording Index"
                               )
-    colors = df.reset_index().loc[0:50000, 'Residuals']
+    colors = plot_points[col_to_plot]
 
-    fig_residual.data[0].update(mode='lines+markers')
-    fig_residual.update_layout(template='plotly_dark')
+    fig_residual.data[0].update(mode='lines+markers',
+                                meta={'pyramid': pyramid_key, 'color_by_value': col_to_plot == 'Residuals'})
+    fig_residual.update_layout(template='plotly_dark', uirevision=f'{df_id}_{col_to_plot}')
     fig_residual.update_traces(marker={'size': 2, 'color': colors, 'showscale': True, 'colorscale': 'Viridis'})
 
     return dcc.Graph(figure=fig_residual, style={'width': '100%'},
                      id={'type': 'plotly', 'index': 'annotate-residual-plot'})
 
 
+@callback(
+    Output({'type': 'plotly', 'index': 'annotate-residual-plot'}, "figure", allow_duplicate=True),
+    Input({'type': 'plotly', 'index': 'annotate-residual-plot'}, "relayoutData"),
+    State({'type': 'plotly', 'index': 'annotate-residual-plot'}, "figure"),
+    prevent_initial_call=True
+)
+def load_annotation_plot_range(relayout_data, figure):
+    plot_range = DecimatedLinePlot.get_relayout_range(relayout_data)
+    patch = DecimatedLinePlot.patch_figure_range(figure, *plot_range) if plot_range else None
+
+    if patch is None:
+        raise PreventUpdate
+
+    return patch
+
+
 @callback(
     Output("jump-plot-side-panel-btn-anno", "disabled"),
     Output("jump-plot-side-panel-anno", "color"),
@@ -821,10 +840,14 @@ def patch_figure(clicked, selected_points, dataset_selected, session_store):
         min_index = max(0, sorted_dict[0] - 25000)
         max_index = min(len(df_resid), min_index + 50000)
 
-        patch['data'][0]['x'] = df_resid.reset_index().loc[min_index:max_index, 'index'].to_numpy()
-        patch['data'][0]['y'] = df_resid.reset_index().loc[min_index:max_index, 'Residuals'].to_numpy()
-        patch['data'][0]['marker']['color'] = df_resid.reset_index().loc[min_index:max_index, 'Residuals'].to_numpy()
+        plot_points, pyramid_key = DecimatedLinePlot.get_plot_points(df_resid['Residuals'], min_index, max_index + 1)
+
+        patch['data'][0]['x'] = plot_points['index'].to_numpy()
+        patch['data'][0]['y'] = plot_points['Residuals'].to_numpy()
+        patch['data'][0]['meta'] = {'pyramid': pyramid_key, 'color_by_value': True}
+        patch['data'][0]['marker']['color'] = plot_points['Residuals'].to_numpy()
         patch['data'][0]['marker']['showscale'] = True
+        patch['layout']['xaxis']['range'] = [min_index, max_index]
 
         patch['layout']['annotations'] = [dict(
             x=sorted_dict[0],
@@ -947,14 +970,10 @@ def save_annotated_dataset(save_button, project_id, local_storage):
                                                             dataset_update_dto=DatasetUpdateDTO(
                                                                 tags=existing_tags))
 
-        uploader_thread = threading.Thread(
-            target=BlobConnector.upload_blob, kwargs={
-                'blob_name': azr_path,
-                'user_id': local_storage[AppIDAuthProvider.APPID_USER_BACKEND_ID],
-                'local_file_path': save_location,
-                'linked': False
-            })
-        uploader_thread.start()
+        UploadManager.submit(dataset_id=new_dataset_id,
+                             blob_name=azr_path,
+                             user_id=local_storage[AppIDAuthProvider.APPID_USER_BACKEND_ID],
+                             local_file_path=save_location)
 
         cache.delete_memoized(DatasetService.get_dataset_by_id)
         cache.delete_memoized(ProjectsService.ProjectService.get_project_by_id)
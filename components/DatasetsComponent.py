@@ -1,11 +1,9 @@
 import copy
 import os
-import time
 from typing import List
 
 import dash_bootstrap_components as dbc
 import dash_mantine_components as dmc
-import pandas as pd
 from dash import State, html, Input, Output, ALL, callback, clientside_callback, MATCH, callback_context, \
     no_update
 from dash import dcc
@@ -22,6 +20,7 @@ from auth import AppIDAuthProvider
 from components import Toast
 from dataservices.RedisQueue import RedisQueue
 from utils.Consts import Consts
+from utils.ExportJobs import ExportJobs
 from utils.ExportUtils import ExportUtils
 
 
@@ -109,6 +108,20 @@ def get_single_menu_item(dataset, dataset_format):
                                  icon=DashIconify(icon="gis:shape-file", color="lime"),
                                  id=menu_item_id
                                  )
+    elif dataset_format == 'GPKG':
+        menu_item_id = {'subset': 'gpkg-export-item', 'action': 'export', 'type': 'btn', 'dataset_id': dataset.id}
+
+        menu_item = dmc.MenuItem("GeoPackage",
+                                 icon=DashIconify(icon="gis:layer-stack", color="lime"),
+                                 id=menu_item_id
+                                 )
+    elif dataset_format == 'FGB':
+        menu_item_id = {'subset': 'fgb-export-item', 'action': 'export', 'type': 'btn', 'dataset_id': dataset.id}
+
+        menu_item = dmc.MenuItem("FlatGeobuf",
+                                 icon=DashIconify(icon="gis:layer-stack", color="lime"),
+                                 id=menu_item_id
+                                 )
     else:
         menu_item_id = {'subset': 'raster-export-item', 'action': 'export', 'type': 'btn', 'dataset_id': dataset.id}
 
@@ -127,6 +140,8 @@ def get_menu_items_for_dataset(dataset, session_store):
         menu_items.append(get_single_menu_item(dataset, 'TIFF'))
     if dataset.dataset_type.name != 'OBSERVATORY_DATA':
         menu_items.append(get_single_menu_item(dataset, 'SHP'))
+        menu_items.append(get_single_menu_item(dataset, 'GPKG'))
+        menu_items.append(get_single_menu_item(dataset, 'FGB'))
 
     menu_dropdown = dmc.MenuDropdown(
         children=
@@ -553,11 +568,7 @@ def configure_export(trigger, local_storage):
                                                             dataset_id=dataset.id,
                                                             session=local_storage)
 
-    df = pd.read_csv(download_path)
-
-    unnamed_cols = [col for col in df.columns if 'unnamed' in col.lower()]
-
-    df = df.drop(columns=unnamed_cols)
+    export_columns = ExportUtils.get_export_columns(download_path)
 
     if triggered_id['subset'] == 'csv-export-item':
         modal_title = 'CSV Export'
@@ -565,6 +576,12 @@ def configure_export(trigger, local_storage):
     elif triggered_id['subset'] == 'shp-export-item':
         modal_title = 'Shape File Export'
         export_format = 'shp'
+    elif triggered_id['subset'] == 'gpkg-export-item':
+        modal_title = 'GeoPackage Export'
+        export_format = 'gpkg'
+    elif triggered_id['subset'] == 'fgb-export-item':
+        modal_title = 'FlatGeobuf Export'
+        export_format = 'fgb'
     else:
         modal_title = 'Raster Export'
         export_format = 'tiff'
@@ -586,12 +603,12 @@ def configure_export(trigger, local_storage):
             dmc.MultiSelect(
                 label='Columns to Export',
                 value=['Easting', 'Northing'],
-                data=df.columns,
+                data=export_columns,
                 placeholder='Select columns to export',
                 id={'type': 'multi-select', 'action': 'export-dataset-columns', 'subset': 'export-dataset'}
             ) if 'modal_title' != 'Raster Export' else dmc.Select(
                 label='Column to Interpolate',
-                data=df.columns,
+                data=export_columns,
                 placeholder='Select column to interpolate',
                 id='export-dataset-column-raster'
             ),
@@ -652,44 +669,26 @@ def process_export_request(set_progress, btn_clicked, export_dataset_columns, lo
 
         redis_queue = RedisQueue(name='app-notifications')
 
-        if export_format == 'csv':
+        redis_queue.put(f'data-export;show__{Consts.LOADING_DISPLAY_STATE};Processing;Preparing Export!')
 
-            redis_queue.put(f'data-export;show__{Consts.LOADING_DISPLAY_STATE};Processing;Loading CSV File!')
+        # Raster requests have always fallen through to a shapefile of the points
+        if export_format != 'csv' and export_format not in ExportUtils.VECTOR_FORMATS:
+            export_format = 'shp'
 
-            exported_file_path = ExportUtils.export_csv(
-                dataset_id=dataset_id,
-                session=local_storage,
-                cols_to_export=export_dataset_columns
-            )
-            time.sleep(1)
-
-            redis_queue.put(f'data-export;update__{Consts.LOADING_DISPLAY_STATE};Processing;Loaded CSV File!')
-
-            time.sleep(1)
-
-            existing_tags = dataset.tags
-            if 'export' not in existing_tags:
-                existing_tags['export'] = {'CSV': exported_file_path}
-            else:
-                existing_tags['export']['CSV'] = exported_file_path
+        exported_file_path = ExportJobs.submit(
+            dataset_id=dataset_id,
+            session=local_storage,
+            export_format=export_format,
+            columns=export_dataset_columns,
+            redis_queue=redis_queue
+        )
 
+        export_tag = {'csv': 'CSV', 'shp': 'ShapeFile', 'gpkg': 'GeoPackage', 'fgb': 'FlatGeobuf'}[export_format]
+        existing_tags = dataset.tags
+        if 'export' not in existing_tags:
+            existing_tags['export'] = {export_tag: exported_file_path}
         else:
-
-            redis_queue.put(f'data-export;show__{Consts.LOADING_DISPLAY_STATE};Processing;Loading Data File!')
-
-            time.sleep(1)
-
-            exported_file_path = ExportUtils.export_shp_file(
-                dataset_id=dataset_id,
-                session=local_storage,
-                cols_to_export=export_dataset_columns,
-                redis_queue=redis_queue
-            )
-            existing_tags = dataset.tags
-            if 'export' not in existing_tags:
-                existing_tags['export'] = {'ShapeFile': exported_file_path}
-            else:
-                existing_tags['export']['ShapeFile'] = exported_file_path
+            existing_tags['export'][export_tag] = exported_file_path
 
         update_dataset_dto: DatasetUpdateDTO = DatasetUpdateDTO(
             tags=existing_tags
@@ -0,0 +1,86 @@
+import math
+
+import pandas as pd
+from dash import Patch
+
+from utils.DecimationPyramid import DecimationPyramid
+
+
+def get_plot_points(series: pd.Series, start=0, end=None, x_col='index'):
+    """Representative points of a series for an index range, plus the pyramid key to fetch other ranges with"""
+    pyramid_key, pyramid = DecimationPyramid.for_series(series)
+    idx, val = pyramid.get_range(start, end)
+
+    return pd.DataFrame({x_col: idx, series.name: val}), pyramid_key
+
+
+def get_relayout_range(relayout_data):
+    if not relayout_data:
+        return None
+
+    if relayout_data.get('xaxis.autorange'):
+        return 0, None
+
+    if 'xaxis.range[0]' in relayout_data and 'xaxis.range[1]' in relayout_data:
+        return int(float(relayout_data['xaxis.range[0]'])), int(float(relayout_data['xaxis.range[1]'])) + 1
+
+    if 'xaxis.range' in relayout_data:
+        return int(float(relayout_data['xaxis.range'][0])), int(float(relayout_data['xaxis.range'][1])) + 1
+
+    return None
+
+
+def get_selected_indices(selected_data, max_points=None):
+    """
+    Index of every reading under a selection, not only the decimated points drawn there. A box takes its whole
+    x interval, a lasso the runs between neighbouring drawn points it selected both of. None when that's more
+    than max_points readings.
+    """
+    if not selected_data:
+        return []
+
+    x_range = (selected_data.get('range') or {}).get('x')
+    if x_range:
+        start, end = math.ceil(min(x_range)), math.floor(max(x_range)) + 1
+        if max_points is not None and end - start > max_points:
+            return None
+        return list(range(start, end))
+
+    traces = {}
+    for point in selected_data.get('points', []):
+        traces.setdefault(point.get('curveNumber'), []).append(point)
+
+    runs = []
+    for points in traces.values():
+        points.sort(key=lambda point: point['pointIndex'])
+        for point, next_point in zip(points, points[1:] + [None]):
+            start = end = int(point['x'])
+            if next_point is not None and next_point['pointIndex'] == point['pointIndex'] + 1:
+                end = int(next_point['x'])
+            runs.append((start, end + 1))
+
+    if max_points is not None and sum(end - start for start, end in runs) > max_points:
+        return None
+    return sorted(set(index for start, end in runs for index in range(start, end)))
+
+
+def patch_figure_range(figure, start, end=None):
+    """Swap every decimated trace of the figure for the points of the given index range"""
+    patch = Patch()
+    updated = False
+
+    for i, trace in enumerate(figure['data'] if figure else []):
+        meta = trace.get('meta')
+        pyramid = DecimationPyramid.get_cached(meta.get('pyramid')) if isinstance(meta, dict) else None
+
+        if pyramid is None:
+            continue
+
+        idx, val = pyramid.get_range(start, end)
+        patch['data'][i]['x'] = idx
+        patch['data'][i]['y'] = val
+        if meta.get('color_by_value'):
+            patch['data'][i]['marker']['color'] = val
+        updated = True
+
+    return patch if updated else None
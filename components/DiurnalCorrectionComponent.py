@@ -1,13 +1,9 @@
-import datetime
-import shutil
-import threading
 import time
 import os.path
 import uuid
 
 import dash_mantine_components as dmc
 import numpy as np
-import pandas as pd
 import plotly.express as px
 from dash import dcc, Patch, MATCH, ALL, clientside_callback
 from dash import html, no_update, callback, callback_context, Output, Input, State
@@ -24,9 +20,12 @@ from api.ResidualService import ResidualService
 from api.dto import ProjectsOutput, UpdateProjectTagsDTO, DatasetResponse, DatasetUpdateDTO, CreateNewDatasetDTO, \
     CreateDatasetDTO
 from auth import AppIDAuthProvider
-from components import ResidualComponent, MapboxScatterPlot
-from utils.AzureContainerHelper import BlobConnector
+from components import ResidualComponent, MapboxScatterPlot, DecimatedLinePlot
+from utils.UploadManager import UploadManager
+from utils.ColumnarCache import ColumnarCache
+from utils.DatetimeUtils import DatetimeUtils
 from utils.ExportUtils import ExportUtils
+from utils.ObservatoryStore import ObservatoryStore
 
 
 def get_datasets(typ, session_store):
@@ -38,12 +37,6 @@ def get_datasets(typ, session_store):
 
 @cache.memoize(args_to_ignore=['session_store'])
 def get_survey_plot(session_store, col_to_plot, dataset_id):
-    start_index = session_store[
-        AppConfig.SURVEY_DATA_START_IDX] if AppConfig.SURVEY_DATA_START_IDX in session_store else 0
-
-    start = start_index
-    end = start_index + 50000
-
     active_project = ProjectService.get_project_by_id(
         project_id=session_store[AppIDAuthProvider.CURRENT_ACTIVE_PROJECT],
         session=session_store)
@@ -52,16 +45,16 @@ def get_survey_plot(session_store, col_to_plot, dataset_id):
 
     df = df.set_index('Datetime').sort_index().reset_index().reset_index()
 
-    custom_data = 'index' if 'index' in df.columns else 'Datetime'
+    plot_points, pyramid_key = DecimatedLinePlot.get_plot_points(df[col_to_plot])
 
-    fig_residual = px.scatter(df.iloc[start:end], x='index', y=col_to_plot, custom_data=custom_data,
+    fig_residual = px.scatter(plot_points, x='index', y=col_to_plot,
                               labels={
                                   "index": "Index",
                                   "Magnetic_Field": "Magnetic Field",
                               }, title="Magnetic Field vs Recording Index"
                               )
-    fig_residual.data[0].update(mode='lines+markers')
-    fig_residual.update_layout(template='plotly_dark')
+    fig_residual.data[0].update(mode='lines+markers', meta={'pyramid': pyramid_key})
+    fig_residual.update_layout(template='plotly_dark', uirevision=f'{dataset_id}_{col_to_plot}')
     fig_residual.update_traces(marker={'size': 2})
 
     ret_div = dmc.LoadingOverlay(children=
@@ -198,36 +191,12 @@ def update_datasets_in_session(survey_data_selected, observatory_data_selected,
     return patch
 
 
-@cache.memoize(timeout=50000)
-def get_or_download_dataframe(project: ProjectsOutput, session_store, dataset_type,
-                              dataset_id, start_idx=None, end_idx=None):
-    if not dataset_id:
-        dataset_id = session_store[AppConfig.SURVEY_DATA_SELECTED] if dataset_type == 'SURVEY_DATA' else session_store[
-            AppConfig.OBS_DATA_SELECTED]
-
+def get_local_path(project: ProjectsOutput, session_store, dataset_id):
     dataset: DatasetResponse = [d.dataset for d in project.datasets if d.dataset.id == dataset_id][0]
 
     if 'local_path' in dataset.tags and dataset_id in dataset.tags['local_path'] \
             and os.path.exists(dataset.tags['local_path'][dataset.id]):
-        if start_idx is not None and end_idx is not None:
-
-            ret_df = pd.read_csv(dataset.tags['local_path'][dataset.id],
-                                 skiprows=lambda x: x > end_idx or x < start_idx)
-        else:
-            ret_df = pd.read_csv(dataset.tags['local_path'][dataset.id])
-
-        ret_df['Datetime'] = pd.to_datetime(ret_df['Datetime'], format='mixed')
-
-        if 'Observation Dates' not in dataset.tags:
-            min_date = ret_df['Datetime'].min().strftime("%m/%d/%Y")
-            max_date = ret_df['Datetime'].max().strftime("%m/%d/%Y")
-
-            dataset_tags = dataset.tags or {}
-            dataset_tags['Observation Dates'] = f'{min_date} - {max_date}'
-            DatasetService.update_dataset(dataset_id=dataset.id,
-                                          session_store=session_store,
-                                          dataset_update_dto=DatasetUpdateDTO(tags=dataset_tags))
-        return ret_df
+        return dataset, dataset.tags['local_path'][dataset.id]
 
     download_path = ExportUtils.download_data_if_not_exists(dataset_path=dataset.path,
                                                             dataset_id=dataset.id,
@@ -243,17 +212,26 @@ def get_or_download_dataframe(project: ProjectsOutput, session_store, dataset_ty
                                                     session_store=session_store,
                                                     dataset_update_dto=DatasetUpdateDTO(tags=dataset_tags))
 
-    if start_idx is not None and end_idx is not None:
-        ret_df = pd.read_csv(download_path, skiprows=lambda x: x > end_idx or x < start_idx)
-    else:
-        ret_df = pd.read_csv(download_path)
-        ret_df['Datetime'] = pd.to_datetime(ret_df['Datetime'], format='mixed')
+    return updated_dataset, download_path
+
+
+@cache.memoize(timeout=50000)
+def get_or_download_dataframe(project: ProjectsOutput, session_store, dataset_type,
+                              dataset_id, start_idx=None, end_idx=None, columns=None):
+    if not dataset_id:
+        dataset_id = session_store[AppConfig.SURVEY_DATA_SELECTED] if dataset_type == 'SURVEY_DATA' else session_store[
+            AppConfig.OBS_DATA_SELECTED]
 
-    if 'Observation Dates' not in updated_dataset.tags:
+    dataset, local_path = get_local_path(project, session_store, dataset_id)
+
+    ret_df = ColumnarCache.read(local_path, columns=columns, start_idx=start_idx, end_idx=end_idx)
+    ret_df = DatetimeUtils.restore(ret_df)
+
+    if 'Observation Dates' not in dataset.tags:
         min_date = ret_df['Datetime'].min().strftime("%m/%d/%Y")
         max_date = ret_df['Datetime'].max().strftime("%m/%d/%Y")
 
-        dataset_tags = updated_dataset.tags or {}
+        dataset_tags = dataset.tags or {}
         dataset_tags['Observation Dates'] = f'{min_date} - {max_date}'
         DatasetService.update_dataset(dataset_id=dataset.id,
                                       session_store=session_store,
@@ -262,21 +240,15 @@ def get_or_download_dataframe(project: ProjectsOutput, session_store, dataset_ty
     return ret_df
 
 
-@cache.memoize(timeout=5000)
-def concat_dfs(dfs):
-    return pd.concat(dfs)
+def get_observatory_paths(project: ProjectsOutput, session_store, dataset_ids):
+    return [get_local_path(project, session_store, d_id)[1] for d_id in dataset_ids]
 
 
 @cache.memoize(timeout=50000, args_to_ignore=['session_store'])
 def get_observatory_plot(session_store, dataset_id=None):
     project = ProjectService.get_project_by_id(session=session_store,
                                                project_id=session_store[AppIDAuthProvider.CURRENT_ACTIVE_PROJECT])
-    dfs = []
-    for d_id in dataset_id:
-        df = get_or_download_dataframe(project, session_store, dataset_type='OBSERVATORY_DATA', dataset_id=d_id)
-        dfs.append(df)
-
-    df = concat_dfs(dfs)
+    min_date, max_date = ObservatoryStore.get_date_range(get_observatory_paths(project, session_store, dataset_id))
 
     return dmc.Stack(
         children=[
@@ -293,11 +265,11 @@ def get_observatory_plot(session_store, dataset_id=None):
                         label="Observation Date",
                         # disabledDates=df['Date'].unique(),
                         description="Provide the observation date that you want to plot",
-                        minDate=pd.to_datetime(df['Datetime'].min(), format='%Y-%m-%d %H:%M:%S').date(),
-                        maxDate=pd.to_datetime(df['Datetime'].max(), format='%Y-%m-%d %H:%M:%S').date(),
+                        minDate=min_date,
+                        maxDate=max_date,
                         placeholder='Select a Date',
                         clearable=True,
-                        value=pd.to_datetime(df['Datetime'].min()).date(),
+                        value=min_date,
                         dropdownType="modal",
                         style={"maxWidth": '50%'},
                     ),
@@ -321,6 +293,22 @@ def get_observatory_plot(session_store, dataset_id=None):
         ], align='stretch')
 
 
+@callback(
+    Output({'type': 'plotly-plot', 'idx': 'residual-plot'}, 'figure', allow_duplicate=True),
+    Input({'type': 'plotly-plot', 'idx': 'residual-plot'}, 'relayoutData'),
+    State({'type': 'plotly-plot', 'idx': 'residual-plot'}, 'figure'),
+    prevent_initial_call=True
+)
+def load_survey_plot_range(relayout_data, figure):
+    plot_range = DecimatedLinePlot.get_relayout_range(relayout_data)
+    patch = DecimatedLinePlot.patch_figure_range(figure, *plot_range) if plot_range else None
+
+    if patch is None:
+        raise PreventUpdate
+
+    return patch
+
+
 @callback(
     Output("diurnal-page-tags-div", "children"),
     Output("select-survey-data", "className"),
@@ -344,8 +332,6 @@ def update_tags(survey_data, observatory_data, session_store):
     else:
 
         if triggered == 'select-survey-data':
-            cache.delete_memoized(ResidualService.calculate_diurnal_correction)
-            cache.delete_memoized(perform_diurnal_correction)
             survey_data = DatasetService.get_dataset_by_id(dataset_id=survey_data, session_store=session_store)
 
             survey_dates, survey_plot = get_survey_plot(session_store=session_store, col_to_plot='Magnetic_Field',
@@ -372,8 +358,6 @@ def update_tags(survey_data, observatory_data, session_store):
                 ret_val = tags, no_update, no_update, no_update, survey_plot
             return ret_val
         else:
-            cache.delete_memoized(ResidualService.calculate_diurnal_correction)
-            cache.delete_memoized(perform_diurnal_correction)
 
             observatory_datasets = []
             for data in observatory_data:
@@ -426,24 +410,14 @@ def get_plots_callback(date_val, input_select, session_store):
                                                       project_id=session_store[
                                                           AppIDAuthProvider.CURRENT_ACTIVE_PROJECT])
 
-    obs_ids = session_store[AppConfig.OBS_DATA_SELECTED]
-    dfs = []
-    for d_id in obs_ids:
-        dfs.append(get_or_download_dataframe(session_store=session_store, project=active_project,
-                                             dataset_type='OBSERVATORY_DATA', dataset_id=d_id))
-
-    df = concat_dfs(dfs)
-
-    # df_surf_plot = get_survey_plot(session_store=session_store, col_to_plot='Magnetic_Field')
-    plot_df = df
-
-    min_date = date_val
-    max_date = (pd.to_datetime(date_val, format='%Y-%m-%d') + datetime.timedelta(days=1)).strftime('%Y-%m-%d')
-
-    plot_df = plot_df[(plot_df['Datetime'] >= min_date) & (plot_df['Datetime'] < max_date)]
+    if not date_val:
+        raise PreventUpdate
 
     y_plot = 'Magnetic_Field' if input_select == 'Raw Magnetic Field' else 'Baseline'
 
+    obs_paths = get_observatory_paths(active_project, session_store, session_store[AppConfig.OBS_DATA_SELECTED])
+    plot_df = ObservatoryStore.read_day(obs_paths, date_val, columns=['Datetime', y_plot])
+
     obs_plot = px.line(plot_df, x='Datetime', y=y_plot, hover_data={"Datetime": "|%B %d, %Y %I:%M"})
     obs_plot.update_layout(hovermode='x unified')
     obs_plot.update_layout(template='plotly_dark')
@@ -642,19 +616,30 @@ def generate_line_plot(surf_df_diurnal_computed):
     return fig
 
 
-@cache.memoize(timeout=50000, args_to_ignore=['session_store'])
 def perform_diurnal_correction(active_project, session_store):
+    survey_id = session_store[AppConfig.SURVEY_DATA_SELECTED]
+    observatory_ids = tuple(session_store[AppConfig.OBS_DATA_SELECTED])
+
+    # Keyed on the content of the inputs, a dataset saved over under the same id is computed again
+    versions = tuple(ColumnarCache.get_version(path)
+                     for path in get_observatory_paths(active_project, session_store, (survey_id, *observatory_ids)))
+
+    return get_diurnal_corrected_dataframe(active_project, session_store,
+                                           survey_id=survey_id,
+                                           observatory_ids=observatory_ids,
+                                           versions=versions)
+
+
+@cache.memoize(timeout=50000, args_to_ignore=['active_project', 'session_store'])
+def get_diurnal_corrected_dataframe(active_project, session_store, survey_id, observatory_ids, versions):
     obs_dfs = []
-    d_ids = session_store[AppConfig.OBS_DATA_SELECTED]
-    for d_id in d_ids:
+    for d_id in observatory_ids:
         obs_dfs.append(get_or_download_dataframe(session_store=session_store, project=active_project,
                                                  dataset_type='OBSERVATORY_DATA', dataset_id=d_id))
-    obs_df = concat_dfs(obs_dfs)
-    s_id = session_store[AppConfig.SURVEY_DATA_SELECTED]
     surf_df = get_or_download_dataframe(session_store=session_store, project=active_project,
-                                        dataset_type='SURVEY_DATA', dataset_id=s_id)
+                                        dataset_type='SURVEY_DATA', dataset_id=survey_id)
     surf_df_diurnal_computed = ResidualService \
-        .calculate_diurnal_correction(df_surf=surf_df, df_obs=obs_df, session_store=session_store)
+        .calculate_diurnal_correction(df_surf=surf_df, df_obs=obs_dfs)
 
     return surf_df_diurnal_computed
 
@@ -728,13 +713,6 @@ def set_data_for_mag_stage(skip_button, next_button, session_store):
         if triggered['action'] == 'next':
 
             if session_store[AppConfig.DIURNAL_COMPUTED]:
-                obs_ids = ';'.join(session_store[AppConfig.OBS_DATA_SELECTED])
-
-                durn_file_path = os.path.join(AppConfig.PROJECT_ROOT, "data",
-                                              session_store[AppIDAuthProvider.APPID_USER_NAME],
-                                              "processed",
-                                              f'{session_store[AppConfig.SURVEY_DATA_SELECTED]}_{obs_ids}_durn.csv')
-
                 project_id = session_store[AppIDAuthProvider.CURRENT_ACTIVE_PROJECT]
                 active_project = ProjectService.get_project_by_id(session=session_store,
                                                                   project_id=project_id)
@@ -761,7 +739,8 @@ def set_data_for_mag_stage(skip_button, next_button, session_store):
                                              f'{new_dataset_id}.csv'
                                              )
 
-                shutil.move(src=durn_file_path, dst=new_file_path)
+                # Saved from the memoized correction, the same frame the plots were drawn from
+                perform_diurnal_correction(active_project, session_store).to_csv(new_file_path)
                 azr_path = '{}.csv'.format(new_dataset_id)
 
                 try:
@@ -793,14 +772,10 @@ def set_data_for_mag_stage(skip_button, next_button, session_store):
                                                                         dataset_update_dto=DatasetUpdateDTO(
                                                                             tags=existing_tags))
 
-                    uploader_thread = threading.Thread(
-                        target=BlobConnector.upload_blob, kwargs={
-                            'blob_name': azr_path,
-                            'user_id': session_store[AppIDAuthProvider.APPID_USER_BACKEND_ID],
-                            'local_file_path': new_file_path,
-                            'linked': False
-                        })
-                    uploader_thread.start()
+                    UploadManager.submit(dataset_id=new_dataset_id,
+                                         blob_name=azr_path,
+                                         user_id=session_store[AppIDAuthProvider.APPID_USER_BACKEND_ID],
+                                         local_file_path=new_file_path)
 
                     cache.delete_memoized(DatasetService.get_dataset_by_id)
                     cache.delete_memoized(ProjectService.get_project_by_id)
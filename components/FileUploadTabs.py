@@ -1,6 +1,5 @@
 import os
 import shutil
-import threading
 import time
 import uuid
 from zipfile import ZipFile
@@ -25,7 +24,10 @@ from components import DashUploader, DataTableNative, Toast, DataUploadSummaryPa
     DatasetsComponent
 from utils import Consts
 from utils import Utils
-from utils.AzureContainerHelper import BlobConnector
+from utils.UploadManager import UploadManager
+from utils.ColumnarCache import ColumnarCache
+from utils.DatetimeUtils import DatetimeUtils
+from utils.SmoothingUtils import SmoothingUtils
 
 min_step = 0
 max_step = 3
@@ -343,7 +345,8 @@ def save_and_validate_survey_data(set_progress, session_store,
 
             df = df[df['Easting'] != '*']
             df['Magnetic_Field'] = df['Magnetic_Field'].astype(float)
-            df['Datetime'] = pd.to_datetime(df['Datetime'], format="mixed")
+            # Survey files have always been read month first
+            df = DatetimeUtils.normalize(df, dayfirst=False)
 
             observation_dates = f'{df["Datetime"].min().strftime("%m/%d/%Y")} - {df["Datetime"].max().strftime("%m/%d/%Y")}'
 
@@ -368,10 +371,14 @@ def save_and_validate_survey_data(set_progress, session_store,
             if not os.path.exists(save_path):
                 os.mkdir(save_path)
             df.to_csv(f'{save_path}\\{dataset_name}.csv')
+            # Built from the written file like every other user's copy, so all of them get the same version
+            ColumnarCache.build_from_csv(f'{save_path}\\{dataset_name}.csv')
 
-            BlobConnector.upload_blob(blob_name=f'{new_dataset_id}.csv',
-                                      user_id=session_store[AppIDAuthProvider.APPID_USER_BACKEND_ID],
-                                      local_file_path=f'{save_path}\\{dataset_name}.csv')
+            # Blocks as before, the dataset is in the store once this returns
+            UploadManager.submit(dataset_id=new_dataset_id,
+                                 blob_name=f'{new_dataset_id}.csv',
+                                 user_id=session_store[AppIDAuthProvider.APPID_USER_BACKEND_ID],
+                                 local_file_path=f'{save_path}\\{dataset_name}.csv').result()
 
             return f'{save_path}\\{dataset_name}.csv', None, observation_dates
         else:
@@ -441,7 +448,11 @@ def save_and_validate_observatory_data(set_progress,
                 NotificationProvider.notify(progress_message, action="update", notification_id='zip-processor'))
             time.sleep(1)
 
-            df = df.assign(Datetime=ddf.to_datetime(df['Datetime'], format='%d/%m/%Y %H:%M:%S'))
+            # Observatory files are written day first
+            datetime_format = DatetimeUtils.infer_format(df['Datetime'].head(DatetimeUtils.SAMPLE_SIZE),
+                                                         dayfirst=True) or '%d/%m/%Y %H:%M:%S'
+            df = df.assign(Datetime=ddf.to_datetime(df['Datetime'], format=datetime_format))
+            df = df.assign(Datetime_ns=df['Datetime'].astype('int64'))
             df = df.assign(Date=df['Datetime'].dt.date)
             print('Assigned Datetime')
 
@@ -452,8 +463,9 @@ def save_and_validate_observatory_data(set_progress,
                     NotificationProvider.notify(progress_message, action="update", notification_id='zip-processor'))
                 time.sleep(1)
                 df = df.assign(Magnetic_Field=da.sqrt(df['bx'] ** 2 + df['by'] ** 2 + df['bz'] ** 2))
-                df = df.assign(Magnetic_Field_Smoothed=df['Magnetic_Field']
-                               .rolling(window=100, win_type='boxcar', center=True, min_periods=1).mean())
+                df = df.assign(Magnetic_Field_Smoothed=SmoothingUtils.boxcar_dask_series(df['Magnetic_Field'],
+                                                                                         window=100, center=True,
+                                                                                         min_periods=1))
                 df = df.assign(Baseline=df['Magnetic_Field_Smoothed'] - df['Magnetic_Field_Smoothed'].mean())
 
         except Exception as e:
@@ -481,13 +493,10 @@ def save_and_validate_observatory_data(set_progress,
                 NotificationProvider.notify(progress_message, action="update", notification_id='zip-processor'))
             time.sleep(0.5)
 
-            uploader_thread = threading.Thread(
-                target=BlobConnector.upload_blob, kwargs={
-                    'blob_name': f'{new_dataset_id}.csv',
-                    'user_id': f'{session_store[AppIDAuthProvider.APPID_USER_BACKEND_ID]}',
-                    'local_file_path': f'{save_path}\\{dataset_name}.csv'
-                })
-            uploader_thread.start()
+            UploadManager.submit(dataset_id=new_dataset_id,
+                                 blob_name=f'{new_dataset_id}.csv',
+                                 user_id=f'{session_store[AppIDAuthProvider.APPID_USER_BACKEND_ID]}',
+                                 local_file_path=f'{save_path}\\{dataset_name}.csv')
 
             return f'{save_path}\\{dataset_name}.csv', None, observation_dates
         else:
@@ -1,19 +1,12 @@
-import base64
 import os
 import shutil
-import threading
 import uuid
-from io import BytesIO
 
 import dash_bootstrap_components as dbc
 import dash_mantine_components as dmc
-import pandas as pd
-import rasterio
 from dash import html, Input, Output, callback, callback_context, State
 from dash.exceptions import PreventUpdate
 from flask import session
-from matplotlib import pyplot as plt
-from rasterio.plot import show
 
 import AppConfig
 from Celery import background_callback_manager
@@ -24,8 +17,10 @@ from api.ProjectsService import ProjectService
 from api.dto import DatasetResponse, DatasetUpdateDTO, CreateNewDatasetDTO, CreateDatasetDTO
 from auth import AppIDAuthProvider
 from components import ResidualComponent
-from utils.AzureContainerHelper import BlobConnector
+from utils.UploadManager import UploadManager
+from utils.ColumnarCache import ColumnarCache
 from utils.ExportUtils import ExportUtils
+from utils.RasterRenderer import RasterRenderer
 
 
 def get_interpolation_page(session):
@@ -66,6 +61,9 @@ def get_interpolation_page(session):
                     dmc.Image(width='100%', withPlaceholder=True,
                               id='interpolated-raster-image', height='800px',
                               style={'minHeight': '650px'}),
+                    dmc.Image(width='100%', withPlaceholder=True,
+                              id='interpolated-raster-preview', height='800px',
+                              style={'display': 'none'}),
                     html.Br(),
                     dbc.Button('Export Raster',
                                color='success',
@@ -106,7 +104,7 @@ def get_interpolation_page(session):
 
 
 @cache.memoize(timeout=50000)
-def get_or_download_dataframe(session_store, dataset_id=None):
+def get_or_download_dataframe(session_store, dataset_id=None, columns=None):
     if not dataset_id:
         dataset_id = session_store[AppConfig.WORKING_DATASET]
 
@@ -119,7 +117,7 @@ def get_or_download_dataframe(session_store, dataset_id=None):
 
     if 'local_path' in dataset.tags and dataset_id in dataset.tags['local_path'] \
             and os.path.exists(dataset.tags['local_path'][dataset.id]):
-        ret_df = pd.read_csv(dataset.tags['local_path'][dataset.id])
+        ret_df = ColumnarCache.read(dataset.tags['local_path'][dataset.id], columns=columns)
 
         unnamed_cols = [col for col in ret_df.columns if 'unnamed' in col.lower()]
         ret_df = ret_df.drop(columns=unnamed_cols)
@@ -141,7 +139,7 @@ def get_or_download_dataframe(session_store, dataset_id=None):
     updated_dataset = DatasetService.update_dataset(dataset_id=dataset.id,
                                                     session_store=session_store,
                                                     dataset_update_dto=DatasetUpdateDTO(tags=dataset_tags))
-    ret_df = pd.read_csv(download_path)
+    ret_df = ColumnarCache.read(download_path, columns=columns)
     unnamed_cols = [col for col in ret_df.columns if 'unnamed' in col.lower()]
     ret_df = ret_df.drop(columns=unnamed_cols)
 
@@ -161,7 +159,7 @@ def get_cta_input_block(session):
                     dmc.Select(
                         label='Interpolation Type',
                         description="Select the Interpolation Type",
-                        data=['Linear', 'Cubic'],
+                        data=['Linear', 'Cubic', 'Nearest Neighbour', 'Inverse Distance', 'Minimum Curvature'],
                         value='Cubic',
                         required=False,
                         searchable=False,
@@ -191,6 +189,13 @@ def get_cta_input_block(session):
                         color='blue',
                         id='interpolate-btn',
                         disabled=True,
+                    ),
+                    dmc.Button(
+                        "Cancel",
+                        variant='outline',
+                        color='red',
+                        id='cancel-interpolation-btn',
+                        disabled=True,
                     )
 
                 ], grow=True, align='end'
@@ -203,6 +208,19 @@ def get_cta_input_block(session):
                         id='show-contours-checkbox',
                         color='green',
                         size='md'
+                    ),
+                    dmc.Checkbox(
+                        label='Tiled Gridding (Parallel)',
+                        id='tiled-gridding-checkbox',
+                        color='blue',
+                        size='md'
+                    ),
+                    dmc.Checkbox(
+                        label='Coarse Preview First',
+                        id='progressive-interpolation-checkbox',
+                        checked=True,
+                        color='blue',
+                        size='md'
                     )
                 ], grow=False
             )
@@ -234,37 +252,65 @@ def enable_interpolation_button(grid_spacing, col_to_interpolate, interpolation_
     State("grid-spacing-number-input", "value"),
     State("column-to-interpolate-select", "value"),
     State("interpolation-type-select", "value"),
+    State("tiled-gridding-checkbox", "checked"),
+    State("progressive-interpolation-checkbox", "checked"),
     State("interpolation-placeholder", "children"),
     State("local", "data"),
+    progress=Output("interpolated-raster-preview", "src"),
+    running=[
+        (Output("interpolated-raster-preview", "style"), {'minHeight': '650px'}, {'display': 'none'}),
+        (Output("interpolated-raster-image", "style"), {'display': 'none'}, {'minHeight': '650px'}),
+        (Output("cancel-interpolation-btn", "disabled"), False, True),
+    ],
+    cancel=[Input("cancel-interpolation-btn", "n_clicks")],
     background=True,
     manager=background_callback_manager,
     prevent_initial_call=True
 )
-def verde_interpolate(interpolation_button, spacing, col_to_interpolate, interpolation_type, id_placeholder,
-                      local_storage):
+def verde_interpolate(set_progress, interpolation_button, spacing, col_to_interpolate, interpolation_type, tiled,
+                      progressive, id_placeholder, local_storage):
     triggered = callback_context.triggered
     if not triggered:
         raise PreventUpdate
     if not interpolation_button:
         raise PreventUpdate
     else:
+        # A cancel left over from an earlier run must not stop this one
+        cancel_flag = InterpolationService.get_cancel_flag(id_placeholder)
+        cancel_flag.clear()
+
         working_dataset = id_placeholder.split('----')[2]
         df = get_or_download_dataframe(dataset_id=working_dataset, session_store=local_storage)
-        figure = InterpolationService.verde_interpolate(
+        src = InterpolationService.progressive_interpolate(
             df=df,
             col_to_interpolate=col_to_interpolate,
             interpolation_type=interpolation_type,
             tiff_name=id_placeholder,
-            spacing=spacing
+            spacing=spacing,
+            tiled=bool(tiled),
+            on_preview=set_progress if progressive else None,
+            is_cancelled=cancel_flag.is_set
         )
 
-        buf = BytesIO()
-        figure.savefig(buf, format="png")
-        # Embed the result in the html output.
-        fig_data = base64.b64encode(buf.getbuffer()).decode("ascii")
-        fig_bar_matplotlib = f'data:image/png;base64,{fig_data}'
+        if src is None:
+            raise PreventUpdate
+
+        return src
+
+
+@callback(
+    Output("cancel-interpolation-btn", "disabled", allow_duplicate=True),
+    Input("cancel-interpolation-btn", "n_clicks"),
+    State("interpolation-placeholder", "children"),
+    prevent_initial_call=True
+)
+def cancel_interpolation(cancel_clicks, id_placeholder):
+    if not cancel_clicks:
+        raise PreventUpdate
 
-        return fig_bar_matplotlib
+    # Revoking the job only takes effect once it's done on the solo worker, the job watches this flag instead
+    InterpolationService.get_cancel_flag(id_placeholder).set()
+    return True
 
 
 @callback(
@@ -298,29 +344,7 @@ def show_contours(checked, col_to_interpolate):
             'downloads',
             f'{session[AppIDAuthProvider.CURRENT_ACTIVE_PROJECT]}-{session[AppConfig.WORKING_DATASET]}.tiff'
         )
-        plt.style.use('dark_background')
-        fig = plt.figure()
-        ax = fig.gca()
-        if checked:
-            fig_raster = show(rasterio.open(save_path), with_bounds=True, contour=True,
-                              title=f'{col_to_interpolate} Raster', ax=ax, cmap='RdBu_r')
-            fig_raster.set_ylabel('Northing')
-            fig_raster.set_xlabel('Easting')
-        else:
-            fig_raster = show(rasterio.open(save_path), with_bounds=True, contour=False,
-                              title=f'{col_to_interpolate} Raster', ax=ax, cmap='RdBu_r')
-            fig_raster.set_ylabel('Northing')
-            fig_raster.set_xlabel('Easting')
-            im = fig_raster.get_images()[0]
-            fig.colorbar(im, ax=ax)
-
-        buf = BytesIO()
-        fig.savefig(buf, format="png")
-        # Embed the result in the html output.
-        fig_data = base64.b64encode(buf.getbuffer()).decode("ascii")
-        fig_bar_matplotlib = f'data:image/png;base64,{fig_data}'
-
-        return fig_bar_matplotlib
+        return RasterRenderer.render(save_path, f'{col_to_interpolate} Raster', contours=bool(checked))
 
 
 @callback(
@@ -433,14 +457,10 @@ def finish_interpolation(btn_clicked, tiff_name, local_storage):
                                                                 dataset_update_dto=DatasetUpdateDTO(
                                                                     tags=existing_tags))
 
-            uploader_thread = threading.Thread(
-                target=BlobConnector.upload_blob, kwargs={
-                    'blob_name': azr_path,
-                    'user_id': local_storage[AppIDAuthProvider.APPID_USER_BACKEND_ID],
-                    'local_file_path': df_destination_path,
-                    'linked': False
-                })
-            uploader_thread.start()
+            UploadManager.submit(dataset_id=new_dataset_id,
+                                 blob_name=azr_path,
+                                 user_id=local_storage[AppIDAuthProvider.APPID_USER_BACKEND_ID],
+                                 local_file_path=df_destination_path)
 
             cache.delete_memoized(DatasetService.get_dataset_by_id)
             cache.delete_memoized(ProjectService.get_project_by_id)
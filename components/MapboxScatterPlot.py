@@ -1,20 +1,16 @@
 import math
 
-import datashader as ds
-import datashader.transfer_functions as tf
 import numpy as np
 import pandas as pd
 import plotly.express as px
-from colorcet import fire
 from flask import session
 import plotly.graph_objects as go
 
 import AppConfig
-from FlaskCache import cache
-from api import ResidualService
+from FlaskCache import cache, memoize_frames
+from api.TileService import TileService
 
 
-@cache.memoize(timeout=5000000)
 def get_mapbox_plot(df,
                     df_name,
                     col_to_plot,
@@ -26,6 +22,29 @@ def get_mapbox_plot(df,
                     hover_name='Magnetic_Field',
                     hover_data='Magnetic_Field',
                     points_to_clip=None):
+    # Registered on every call, the figure below may come from the cache after its tile source was evicted
+    source_key = TileService.register_source(df, col_to_plot, latitude_col=latitude_col,
+                                             longitude_col=longitude_col, color_scale=color_scale)
+
+    return get_mapbox_figure(df,
+                             col_to_plot,
+                             tile_url=TileService.get_tile_url(source_key),
+                             color_span=TileService.get_source(source_key)['span'],
+                             color_scale=color_scale,
+                             latitude_col=latitude_col,
+                             longitude_col=longitude_col,
+                             hover_name=hover_name)
+
+
+@memoize_frames(timeout=5000000)
+def get_mapbox_figure(df,
+                      col_to_plot,
+                      tile_url,
+                      color_span,
+                      color_scale='icefire',
+                      latitude_col='Latitude',
+                      longitude_col='Longitude',
+                      hover_name='Magnetic_Field'):
     sampling_frequency = math.ceil(len(df) / 18000)
 
     print(f'Sampling at frequency: {sampling_frequency}')
@@ -42,17 +61,29 @@ def get_mapbox_plot(df,
                             color=col_to_plot,
                             custom_data='index',
                             color_continuous_scale=color_scale,
+                            range_color=color_span,
                             zoom=8
                             )
 
     print('GET MAPBOX PLOT GOT CALLED')
 
-    fig.update_layout(mapbox_style='open-street-map')
+    # The sampled markers stay for hovering and selecting, every reading is drawn underneath as tiles
+    fig.update_traces(marker={'size': 4})
+    fig.update_layout(mapbox_style='open-street-map',
+                      mapbox_layers=[get_tile_layer(tile_url)])
     fig.update_layout(margin={'r': 0, 't': 0, 'l': 0, 'b': 0})
     fig.update_layout(template='plotly_dark')
     return fig
 
 
+def get_tile_layer(tile_url):
+    return {
+        'sourcetype': 'raster',
+        'source': [tile_url],
+        'below': 'traces'
+    }
+
+
 @cache.memoize(timeout=5000000)
 def get_mapbox_plot_annotated(
         df,
@@ -133,38 +164,25 @@ def get_mapbox_plot_annotated(
     return fig
 
 
-def get_mapbox_plot_raster(selected_dataset):
-    df = ResidualService.ResidualService.calculate_residuals(selected_dataset).head(100000)
-
-    cvs = ds.Canvas(plot_width=1000, plot_height=1000)
-    agg = cvs.points(df, x='Longitude', y='Latitude')
-    # agg is an xarray object, see http://xarray.pydata.org/en/stable/ for more details
-    coords_lat, coords_lon = agg.coords['Latitude'].values, agg.coords['Longitude'].values
-    # Corners of the image, which need to be passed to mapbox
-    coordinates = [[coords_lon[0], coords_lat[0]],
-                   [coords_lon[-1], coords_lat[0]],
-                   [coords_lon[-1], coords_lat[-1]],
-                   [coords_lon[0], coords_lat[-1]]]
-
-    img = tf.shade(agg, cmap=fire)[::-1].to_pil()
-
-    fig = px.scatter_mapbox(df[:1],
-                            lat='Latitude',
-                            lon='Longitude',
-                            # hover_name='Magnetic_Field',
-                            # hover_data=['Magnetic_Field'],
-                            # color='Magnetic_Field',
-                            zoom=12
+def get_mapbox_plot_raster(df,
+                           col_to_plot,
+                           color_scale='icefire',
+                           latitude_col='Latitude',
+                           longitude_col='Longitude'):
+    source_key = TileService.register_source(df, col_to_plot, latitude_col=latitude_col,
+                                             longitude_col=longitude_col, color_scale=color_scale)
+
+    # Tiles only, the single marker just gives the map something to centre on
+    fig = px.scatter_mapbox(df[[latitude_col, longitude_col]].median().to_frame().T,
+                            lat=latitude_col,
+                            lon=longitude_col,
+                            zoom=8
                             )
+    fig.update_traces(marker={'opacity': 0}, hoverinfo='skip')
 
     fig.update_layout(mapbox_style="open-street-map",
-                      mapbox_layers=[
-                          {
-                              "sourcetype": "image",
-                              "source": img,
-                              "coordinates": coordinates
-                          }]
-                      )
+                      mapbox_layers=[get_tile_layer(TileService.get_tile_url(source_key))])
+    fig.update_layout(margin={'r': 0, 't': 0, 'l': 0, 'b': 0})
     fig.update_layout(template='plotly_dark')
 
     return fig
@@ -27,3 +27,12 @@ def notify(message: str, action='show', notification_id='my-notification'):
             action="update",
             icon=DashIconify(icon="akar-icons:circle-check"),
         )
+    elif children_content[0] == Consts.Consts.ERROR_DISPLAY_STATE:
+        return dmc.Notification(
+            id=notification_id,
+            title=children_content[1],
+            message=children_content[2],
+            color="red",
+            action="update",
+            icon=DashIconify(icon="akar-icons:circle-x"),
+        )
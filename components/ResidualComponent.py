@@ -1,6 +1,5 @@
 import os
 import shutil
-import threading
 import time
 import uuid
 
@@ -22,9 +21,10 @@ from api.DatasetService import DatasetService
 from api.ProjectsService import ProjectService
 from api.dto import DatasetResponse, DatasetUpdateDTO, CreateNewDatasetDTO, CreateDatasetDTO
 from auth import AppIDAuthProvider
-from components import ModalComponent, MapboxScatterPlot
+from components import ModalComponent, MapboxScatterPlot, DecimatedLinePlot
 from dataservices import InMermoryDataService
-from utils.AzureContainerHelper import BlobConnector
+from utils.UploadManager import UploadManager
+from utils.ColumnarCache import ColumnarCache
 from utils.ExportUtils import ExportUtils
 
 
@@ -458,19 +458,7 @@ def plot_dataset(previous_button, next_button, calc_residual_btn, show_residuals
         AppConfig.POINTS_TO_CLIP] \
         else no_update
 
-    dataset_level_clips = []
-
-    if local_storage[AppIDAuthProvider.CURRENT_ACTIVE_PROJECT] in local_storage[
-        AppConfig.POINTS_TO_CLIP] and triggered != 'reset-clp-btn':
-        if len(local_storage[AppConfig.POINTS_TO_CLIP][local_storage[AppIDAuthProvider.CURRENT_ACTIVE_PROJECT]]) > 0:
-            cp = local_storage[AppConfig.POINTS_TO_CLIP][local_storage[AppIDAuthProvider.CURRENT_ACTIVE_PROJECT]]
-            df.loc[cp, 'Magnetic_Field'] = np.nan
-
-            df['Magnetic_Field'] = df['Magnetic_Field'].interpolate(method='linear')
-
     if triggered == "reset-clp-btn":
-        cache.delete_memoized(ResidualService.ResidualService.calculate_residuals)
-        cache.delete_memoized(MapboxScatterPlot.get_mapbox_plot)
         if local_storage[AppIDAuthProvider.CURRENT_ACTIVE_PROJECT] in local_storage[AppConfig.POINTS_TO_CLIP]:
             del session_store_patch[AppConfig.POINTS_TO_CLIP][local_storage[AppIDAuthProvider.CURRENT_ACTIVE_PROJECT]]
         session['LAST_CLICKED'] = 'RESET_CLIP'
@@ -484,15 +472,6 @@ def plot_dataset(previous_button, next_button, calc_residual_btn, show_residuals
                 and not (triggered == 'reset-clp-btn' and reset_clip) \
                 and clip and session['LAST_CLICKED'] != 'RESET_CLIP'
 
-    if condition:
-        df['Magnetic_Field'] = df['Magnetic_Field'].mask(df['Magnetic_Field'].le(float(min_val)))
-
-        df['Magnetic_Field'] = df['Magnetic_Field'].mask(df['Magnetic_Field'].ge(float(max_val)))
-
-        dataset_level_clips = list(df[df['Magnetic_Field'].isna()].index)
-
-        df['Magnetic_Field'] = df['Magnetic_Field'].interpolate(method='linear')
-
     if triggered == 'calc-residuals-btn' or 'clip-button' or calc_residual_btn is not None:
         if triggered == 'clip-button' and not condition and clip:
             return no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update
@@ -502,19 +481,19 @@ def plot_dataset(previous_button, next_button, calc_residual_btn, show_residuals
             if local_storage[AppIDAuthProvider.CURRENT_ACTIVE_PROJECT] in local_storage[
             AppConfig.POINTS_TO_CLIP] else []
 
-        points_to_clip = points_to_clip + dataset_level_clips
-        df = ResidualService.ResidualService.calculate_residuals(df, df_name=None,
+        df = ResidualService.ResidualService.calculate_residuals(df, df_name=dataset_id,
                                                                  ambient_smoothing_constant=ambient,
                                                                  observed_smoothing_constant=observed,
                                                                  points_to_clip=points_to_clip,
-                                                                 session_store=session)
+                                                                 session_store=session,
+                                                                 min_val=min_val if condition else None,
+                                                                 max_val=max_val if condition else None)
 
     if not show_residuals:
         points_to_clip = local_storage[AppConfig.POINTS_TO_CLIP][
             local_storage[AppIDAuthProvider.CURRENT_ACTIVE_PROJECT]] \
             if local_storage[AppIDAuthProvider.CURRENT_ACTIVE_PROJECT] in local_storage[
             AppConfig.POINTS_TO_CLIP] else []
-        points_to_clip = points_to_clip + dataset_level_clips
 
         scatter_plot_df = df[(abs(df['Baseline']) >= min_residual) & (abs(df['Baseline']) <= max_residual)] if \
             triggered == 'filter-residual-button' and show_filtered_residuals else df
@@ -527,7 +506,6 @@ def plot_dataset(previous_button, next_button, calc_residual_btn, show_residuals
             local_storage[AppIDAuthProvider.CURRENT_ACTIVE_PROJECT]] \
             if local_storage[AppIDAuthProvider.CURRENT_ACTIVE_PROJECT] in local_storage[
             AppConfig.POINTS_TO_CLIP] else []
-        points_to_clip = points_to_clip + dataset_level_clips
 
         scatter_plot_df = df[(abs(df['Baseline']) >= min_residual) & (abs(df['Baseline']) <= max_residual)] if \
             triggered == 'filter-residual-button' and show_filtered_residuals else df
@@ -545,51 +523,55 @@ def plot_dataset(previous_button, next_button, calc_residual_btn, show_residuals
         session[AppIDAuthProvider.PLOTLY_SCATTER_PLOT_SUBSET] = \
             max(session[AppIDAuthProvider.PLOTLY_SCATTER_PLOT_SUBSET] - 50000, 0)
 
-    start = int(session[AppIDAuthProvider.PLOTLY_SCATTER_PLOT_SUBSET])
-    end = min(start + 50000, len(df))
+    # The whole survey is drawn from the decimation pyramid, the paging buttons still narrow it to one page
+    paged = triggered in ('show-next-residual-plot', 'show-previous-residual-plot')
+    start = int(session[AppIDAuthProvider.PLOTLY_SCATTER_PLOT_SUBSET]) if paged else 0
 
     if start == len(df):
         start = session[AppIDAuthProvider.PLOTLY_SCATTER_PLOT_SUBSET] = 0
 
-    custom_data = 'id' if 'id' in df.columns else None
+    end = min(start + 50000, len(df)) if paged else len(df)
+
+    plot_col = 'Baseline' if show_residuals else 'Magnetic_Field'
+    plot_points, pyramid_key = DecimatedLinePlot.get_plot_points(df[plot_col], start, end)
 
     if not show_residuals:
-        fig_residual = px.scatter(df.reset_index().iloc[start:end], x='index', y='Magnetic_Field',
-                                  custom_data=custom_data,
+        fig_residual = px.scatter(plot_points, x='index', y='Magnetic_Field',
                                   labels={
                                       "index": "Index",
                                       "Magnetic_Field": "Magnetic Field",
                                   }, title="Magnetic Field vs Recording Index"
                                   )
     else:
-        fig_residual = px.scatter(df.reset_index().iloc[start:end], x='index', y='Baseline', custom_data=custom_data,
+        fig_residual = px.scatter(plot_points, x='index', y='Baseline',
                                   labels={
                                       "index": "Index",
                                       "Baseline": "Residuals",
                                   }, title="Residuals vs Recording Index")
 
+    fig_residual.data[0].update(meta={'pyramid': pyramid_key, 'color_by_value': bool(show_residuals)})
+
     if not show_residuals:
-        colors = ['blue'] * 50000
+        colors = 'blue'
     else:
-        colors = df.reset_index().loc[start:end, 'Baseline']
+        colors = plot_points['Baseline']
 
     if 'Baseline' in df.columns and not show_residuals and triggered != 'dropdown-dataset':
-        fig_residual.add_scatter(x=df.reset_index().loc[start:end, 'index'],
-                                 y=df.reset_index().loc[start:end, 'Magnetic_Field_Ambient'],
-                                 mode='lines', name='Ambient Smoothing')
-        fig_residual.add_scatter(x=df.reset_index().loc[start:end, 'index'],
-                                 y=df.reset_index().loc[start:end, 'Magnetic_Field_Smoothed'],
-                                 mode='lines', name='Observed Smoothing')
+        for col, name in (('Magnetic_Field_Ambient', 'Ambient Smoothing'),
+                          ('Magnetic_Field_Smoothed', 'Observed Smoothing')):
+            line_points, line_key = DecimatedLinePlot.get_plot_points(df[col], start, end)
+            fig_residual.add_scatter(x=line_points['index'], y=line_points[col], mode='lines', name=name,
+                                     meta={'pyramid': line_key})
 
     show_scale = False if not show_residuals else True
     color_scale = None if not show_residuals else 'Viridis'
 
     fig_residual.data[0].update(mode='lines+markers')
-    fig_residual.update_layout(template='plotly_dark')
-    fig_residual.update_traces(marker={'size': 2,
-                                       'color': colors,
-                                       'showscale': show_scale,
-                                       'colorscale': color_scale})
+    fig_residual.update_layout(template='plotly_dark', uirevision=f'{dataset_id}_{plot_col}_{start}_{end}')
+    fig_residual.data[0].update(marker={'size': 2,
+                                        'color': colors,
+                                        'showscale': show_scale,
+                                        'colorscale': color_scale})
 
     t_end = time.time()
     print(t_end - t_start)
@@ -664,16 +646,29 @@ def set_data_for_interpolation_state(
     if not next_btn:
         raise PreventUpdate
 
-    df = get_or_download_dataframe(session_store=session, dataset_id=session[AppConfig.WORKING_DATASET])
     points_to_clip = []
     if AppConfig.POINTS_TO_CLIP in session_store and session_store[AppIDAuthProvider.CURRENT_ACTIVE_PROJECT] in \
             session_store[AppConfig.POINTS_TO_CLIP]:
         points_to_clip = points_to_clip + session_store[AppConfig.POINTS_TO_CLIP][
             session_store[AppIDAuthProvider.CURRENT_ACTIVE_PROJECT]]
 
-    if session['LAST_CLICKED'] != 'RESET_CLIP':
+    if session['LAST_CLICKED'] == 'RESET_CLIP':
+        clip_min, clip_max = None, None
+
+    resid_file_path = ResidualService.ResidualService \
+        .calculate_residuals_streaming(ExportUtils.download_data_if_not_exists(
+                                           dataset_id=session[AppConfig.WORKING_DATASET], session=session),
+                                       observed_smoothing_constant=observed_smoothing_constant,
+                                       ambient_smoothing_constant=ambient_smoothing_constant,
+                                       session_store=session,
+                                       points_to_clip=points_to_clip,
+                                       min_val=clip_min,
+                                       max_val=clip_max)
+
+    if not resid_file_path:
+        df = get_or_download_dataframe(session_store=session, dataset_id=session[AppConfig.WORKING_DATASET])
         resid_file_path = ResidualService.ResidualService \
-            .calculate_residuals_with_clip(df, df_name=None,
+            .calculate_residuals_with_clip(df, df_name=session[AppConfig.WORKING_DATASET],
                                            observed_smoothing_constant=observed_smoothing_constant,
                                            ambient_smoothing_constant=ambient_smoothing_constant,
                                            session_store=session,
@@ -681,16 +676,6 @@ def set_data_for_interpolation_state(
                                            min_val=clip_min,
                                            max_val=clip_max,
                                            purpose='save')
-    else:
-        resid_file_path = ResidualService.ResidualService \
-            .calculate_residuals_with_clip(df, df_name=None,
-                                           observed_smoothing_constant=observed_smoothing_constant,
-                                           ambient_smoothing_constant=ambient_smoothing_constant,
-                                           session_store=session,
-                                           points_to_clip=points_to_clip,
-                                           purpose='save')
-
-    cache.delete_memoized(ResidualService.ResidualService.calculate_residuals)
 
     parent_dataset_id = session[AppConfig.WORKING_DATASET]
     existing_dataset = DatasetService.get_dataset_by_id(parent_dataset_id,
@@ -752,14 +737,10 @@ def set_data_for_interpolation_state(
                                                             dataset_update_dto=DatasetUpdateDTO(
                                                                 tags=existing_tags))
 
-        uploader_thread = threading.Thread(
-            target=BlobConnector.upload_blob, kwargs={
-                'blob_name': azr_path,
-                'user_id': session_store[AppIDAuthProvider.APPID_USER_BACKEND_ID],
-                'local_file_path': new_file_path,
-                'linked': False
-            })
-        uploader_thread.start()
+        UploadManager.submit(dataset_id=new_dataset_id,
+                             blob_name=azr_path,
+                             user_id=session_store[AppIDAuthProvider.APPID_USER_BACKEND_ID],
+                             local_file_path=new_file_path)
 
         cache.delete_memoized(DatasetService.get_dataset_by_id)
         cache.delete_memoized(ProjectService.get_project_by_id)
@@ -779,8 +760,11 @@ def set_data_for_interpolation_state(
     prevent_initial_call=True
 )
 def manage_sidebar_button_state(selected_data, local_storage):
-    if selected_data and len(selected_data['points']) > 0:
-        points_to_clip = [sd['x'] for sd in selected_data['points']]
+    # Every index is kept in the browser's storage, a selection over most of a long survey would not fit
+    points_to_clip = DecimatedLinePlot.get_selected_indices(selected_data,
+                                                            max_points=AppConfig.CLIP_SELECTION_MAX_POINTS)
+
+    if points_to_clip:
         patch = Patch()
 
         if AppConfig.POINTS_TO_CLIP not in local_storage:
@@ -831,6 +815,22 @@ def manage_sidebar_button_state(selected_data):
         return patch, True, "gray"
 
 
+@callback(
+    Output("grap2", "figure", allow_duplicate=True),
+    Input("grap2", "relayoutData"),
+    State("grap2", "figure"),
+    prevent_initial_call=True
+)
+def load_residual_plot_range(relayout_data, figure):
+    plot_range = DecimatedLinePlot.get_relayout_range(relayout_data)
+    patch = DecimatedLinePlot.patch_figure_range(figure, *plot_range) if plot_range else None
+
+    if patch is None:
+        raise PreventUpdate
+
+    return patch
+
+
 @callback(
     Output("grap2", "figure", allow_duplicate=True),
     Input("jump-plot-side-panel", "n_clicks"),
@@ -838,11 +838,13 @@ def manage_sidebar_button_state(selected_data):
     State('observed-smoothing-slider', 'value'),
     State('ambient-smoothing-slider', 'value'),
     State('show-residuals-switch', 'checked'),
+    State('clip-min', 'value'),
+    State('clip-max', 'value'),
     State('local', 'data'),
     prevent_initial_call=True
 )
 def print_selected_data(btn_clicked, selected_data, observed_smoothing, ambient_smoothing,
-                        show_residuals,
+                        show_residuals, min_val, max_val,
                         local_storage):
     if selected_data and len(selected_data) > 0 and btn_clicked:
         mod_dict = {sd['customdata'][0]: sd['customdata'][1] for sd in selected_data['points']}
@@ -857,11 +859,16 @@ def print_selected_data(btn_clicked, selected_data, observed_smoothing, ambient_
             local_storage[AppIDAuthProvider.CURRENT_ACTIVE_PROJECT]] \
             if local_storage[AppIDAuthProvider.CURRENT_ACTIVE_PROJECT] in local_storage[
             AppConfig.POINTS_TO_CLIP] else []
-        df_resid = ResidualService.ResidualService.calculate_residuals(df, None,
+
+        clip_range = session.get('LAST_CLICKED') == 'CLIP'
+
+        df_resid = ResidualService.ResidualService.calculate_residuals(df, session[AppConfig.WORKING_DATASET],
                                                                        observed_smoothing_constant=observed_smoothing,
                                                                        ambient_smoothing_constant=ambient_smoothing,
                                                                        points_to_clip=points_to_clip,
-                                                                       session_store=session)
+                                                                       session_store=session,
+                                                                       min_val=min_val if clip_range else None,
+                                                                       max_val=max_val if clip_range else None)
 
         min_index = max(0, sorted_dict[0] - 25000)
         max_index = min(len(df_resid), min_index + 50000)
@@ -872,10 +879,14 @@ def print_selected_data(btn_clicked, selected_data, observed_smoothing, ambient_
 
         data_col = 'Baseline' if show_residuals else 'Magnetic_Field'
 
-        patch['data'][0]['x'] = df_resid.reset_index().loc[min_index:max_index, 'index'].to_numpy()
-        patch['data'][0]['y'] = df_resid.reset_index().loc[min_index:max_index, data_col].to_numpy()
-        patch['data'][0]['marker']['color'] = df_resid.reset_index().loc[min_index:max_index, data_col].to_numpy()
+        plot_points, pyramid_key = DecimatedLinePlot.get_plot_points(df_resid[data_col], min_index, max_index + 1)
+
+        patch['data'][0]['x'] = plot_points['index'].to_numpy()
+        patch['data'][0]['y'] = plot_points[data_col].to_numpy()
+        patch['data'][0]['meta'] = {'pyramid': pyramid_key, 'color_by_value': True}
+        patch['data'][0]['marker']['color'] = plot_points[data_col].to_numpy()
         patch['data'][0]['marker']['showscale'] = True
+        patch['layout']['xaxis']['range'] = [min_index, max_index]
 
         patch['layout']['annotations'] = [dict(
             x=sorted_dict[0],
@@ -894,7 +905,7 @@ def print_selected_data(btn_clicked, selected_data, observed_smoothing, ambient_
 
 
 @cache.memoize(timeout=50000)
-def get_or_download_dataframe(session_store, dataset_id, start_idx=None, end_idx=None):
+def get_or_download_dataframe(session_store, dataset_id, start_idx=None, end_idx=None, columns=None):
     if not dataset_id:
         dataset_id = session_store[AppConfig.WORKING_DATASET]
 
@@ -905,17 +916,12 @@ def get_or_download_dataframe(session_store, dataset_id, start_idx=None, end_idx
 
     dataset: DatasetResponse = [d.dataset for d in project.datasets if d.dataset.id == dataset_id][0]
 
-    if 'local_path' in dataset.tags and dataset_id in dataset.tags['local_path']:
-        if start_idx is not None and end_idx is not None:
-
-            ret_df = pd.read_csv(dataset.tags['local_path'][dataset.id],
-                                 skiprows=lambda x: x > end_idx or x < start_idx)
-        else:
-            ret_df = pd.read_csv(dataset.tags['local_path'][dataset.id])
+    if 'local_path' in dataset.tags and dataset_id in dataset.tags['local_path'] \
+            and os.path.exists(dataset.tags['local_path'][dataset.id]):
+        ret_df = ColumnarCache.read(dataset.tags['local_path'][dataset.id], columns=columns,
+                                    start_idx=start_idx, end_idx=end_idx)
 
         if 'Observation Dates' not in dataset.tags:
-            ret_df['Datetime'] = pd.to_datetime(ret_df['Datetime'])
-
             min_date = ret_df['Datetime'].min().strftime("%m/%d/%Y")
             max_date = ret_df['Datetime'].max().strftime("%m/%d/%Y")
 
@@ -944,14 +950,9 @@ def get_or_download_dataframe(session_store, dataset_id, start_idx=None, end_idx
                                                     session_store=session_store,
                                                     dataset_update_dto=DatasetUpdateDTO(tags=dataset_tags))
 
-    if start_idx is not None and end_idx is not None:
-        ret_df = pd.read_csv(download_path, skiprows=lambda x: x > end_idx or x < start_idx)
-    else:
-        ret_df = pd.read_csv(download_path)
+    ret_df = ColumnarCache.read(download_path, columns=columns, start_idx=start_idx, end_idx=end_idx)
 
     if 'Observation Dates' not in updated_dataset.tags:
-        ret_df['Datetime'] = pd.to_datetime(ret_df['Datetime'])
-
         min_date = ret_df['Datetime'].min().strftime("%m/%d/%Y")
         max_date = ret_df['Datetime'].max().strftime("%m/%d/%Y")
 
@@ -976,22 +977,18 @@ def get_residual_scatter_plot(session_store, col_to_plot):
                                                    col_to_plot=col_to_plot,
                                                    points_to_clip=[])
 
-    start = int(session_store[AppIDAuthProvider.PLOTLY_SCATTER_PLOT_SUBSET]) \
-        if AppIDAuthProvider.PLOTLY_SCATTER_PLOT_SUBSET in session_store else 0
-    end = min(start + 50000, len(df))
+    plot_points, pyramid_key = DecimatedLinePlot.get_plot_points(df[col_to_plot])
 
-    custom_data = 'id' if 'id' in df.columns else None
-
-    fig_residual = px.scatter(df.reset_index().iloc[start:end], x='index', y=col_to_plot, custom_data=custom_data,
+    fig_residual = px.scatter(plot_points, x='index', y=col_to_plot,
                               labels={
                                   "index": "Index",
                                   col_to_plot: col_to_plot.replace('_', ' '),
                               }, title="Magnetic Field vs Recording Index"
                               )
-    colors = ['blue'] * 50000
+    colors = 'blue'
 
-    fig_residual.data[0].update(mode='lines+markers')
-    fig_residual.update_layout(template='plotly_dark')
+    fig_residual.data[0].update(mode='lines+markers', meta={'pyramid': pyramid_key})
+    fig_residual.update_layout(template='plotly_dark', uirevision=f'{df_id}_{col_to_plot}')
     fig_residual.update_traces(marker={'size': 2, 'color': colors})
 
     dcc.Graph(id='map_plot', figure=fig_mapbox, style={'width': '100%'})
@@ -0,0 +1,22 @@
+import redis
+
+
+class RedisFlag(object):
+    """Flag shared by every worker, held under a Redis key that expires so a forgotten one never sticks"""
+
+    def __init__(self, name, timeout, namespace='flag'):
+        self.__db = redis.Redis(host='localhost', port=6379, db=5, decode_responses=True)
+        self.key = '%s:%s' % (namespace, name)
+        self.timeout = timeout
+
+    def set(self):
+        self.__db.set(self.key, 1, ex=self.timeout)
+
+    def clear(self):
+        self.__db.delete(self.key)
+
+    def is_set(self):
+        return self.__db.exists(self.key) > 0
+
+    def close_connection(self):
+        self.__db.close()
@@ -0,0 +1,30 @@
+import uuid
+
+import redis
+
+
+class RedisLock(object):
+    """Lock shared by every worker, held under a Redis key that expires if its holder dies"""
+
+    # Deletes the key only while it still holds this lock's token, so an expired lock taken over by another
+    # worker is never released from under it
+    RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+
+    def __init__(self, name, timeout, namespace='lock'):
+        self.__db = redis.Redis(host='localhost', port=6379, db=5, decode_responses=True)
+        self.key = '%s:%s' % (namespace, name)
+        self.timeout = timeout
+        self.token = uuid.uuid4().hex
+
+    def acquire(self):
+        """Takes the lock if nobody holds it, never blocks"""
+        return bool(self.__db.set(self.key, self.token, nx=True, ex=self.timeout))
+
+    def release(self):
+        return bool(self.__db.eval(self.RELEASE_SCRIPT, 1, self.key, self.token))
+
+    def is_locked(self):
+        return self.__db.exists(self.key) > 0
+
+    def close_connection(self):
+        self.__db.close()
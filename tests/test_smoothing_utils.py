@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.SmoothingUtils import SmoothingUtils
+
+
+def make_readings(n=5000, nan_fraction=0.05, seed=0):
+    rng = np.random.default_rng(seed)
+    values = 50000 + np.cumsum(rng.normal(0, 0.5, n)) + rng.normal(0, 2, n)
+    values[rng.random(n) < nan_fraction] = np.nan
+    # A gap longer than the smaller windows, so some of them see no reading at all
+    values[1000:1120] = np.nan
+    return values
+
+
+def rolling_boxcar(values, window, center, min_periods):
+    return pd.Series(values).rolling(window, center=center, min_periods=min_periods, win_type='boxcar').mean()
+
+
+@pytest.mark.parametrize('center', [True, False])
+@pytest.mark.parametrize('window', [1, 2, 7, 100, 501])
+@pytest.mark.parametrize('min_periods', [1, 5, 50])
+def test_boxcar_mean_matches_pandas_rolling(center, window, min_periods):
+    values = make_readings()
+    min_periods = min(min_periods, window)
+
+    expected = rolling_boxcar(values, window, center, min_periods).to_numpy()
+    actual = SmoothingUtils.boxcar_mean(values, window, center=center, min_periods=min_periods)
+
+    np.testing.assert_array_equal(np.isnan(actual), np.isnan(expected))
+    np.testing.assert_allclose(actual, expected, rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize('center', [True, False])
+def test_boxcar_mean_window_longer_than_series(center):
+    values = make_readings(n=50, nan_fraction=0.2)
+
+    expected = rolling_boxcar(values, 200, center, 1).to_numpy()
+    actual = SmoothingUtils.boxcar_mean(values, 200, center=center, min_periods=1)
+
+    np.testing.assert_allclose(actual, expected, rtol=0, atol=1e-9)
+
+
+def test_boxcar_mean_all_missing():
+    values = np.full(20, np.nan)
+
+    assert np.isnan(SmoothingUtils.boxcar_mean(values, 5, center=True)).all()
+    assert len(SmoothingUtils.boxcar_mean(np.array([]), 5)) == 0
+
+
+def test_boxcar_series_keeps_index_and_name():
+    series = pd.Series(make_readings(n=300), index=np.arange(1000, 1300), name='Magnetic_Field')
+
+    smoothed = SmoothingUtils.boxcar_series(series, 25, center=True)
+
+    assert smoothed.index.equals(series.index)
+    assert smoothed.name == 'Magnetic_Field'
+    np.testing.assert_allclose(smoothed.to_numpy(), rolling_boxcar(series.to_numpy(), 25, True, 1).to_numpy(),
+                               rtol=0, atol=1e-9)
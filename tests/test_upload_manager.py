@@ -0,0 +1,151 @@
+import base64
+import hashlib
+import os
+import threading
+import time
+
+import pytest
+
+import AppConfig
+from utils.LocalBlobBackend import LocalBlobBackend
+from utils.UploadManager import UploadManager
+
+BLOCK_SIZE = 1024
+
+
+class RecordingBackend(LocalBlobBackend):
+    """Local backend that records every call and can fail the first attempts at a block or commit"""
+
+    def __init__(self, root, stage_failures=None, commit_failures=0, delay=None):
+        super().__init__(root)
+        self.stage_failures = dict(stage_failures or {})
+        self.commit_failures = commit_failures
+        self.delay = delay
+        self.staged = []
+        self.committed = []
+        self.lock = threading.Lock()
+
+    def stage_block(self, container, blob_name, block_id, data):
+        if self.delay is not None:
+            time.sleep(self.delay(block_id))
+        with self.lock:
+            self.staged.append(block_id)
+            if self.stage_failures.get(block_id, 0) > 0:
+                self.stage_failures[block_id] -= 1
+                raise IOError(f'Transient failure staging {block_id}')
+        super().stage_block(container, blob_name, block_id, data)
+
+    def commit_blocks(self, container, blob_name, block_ids, content_md5=None):
+        with self.lock:
+            self.committed.append(list(block_ids))
+            if self.commit_failures > 0:
+                self.commit_failures -= 1
+                raise IOError('Transient failure committing')
+        super().commit_blocks(container, blob_name, block_ids, content_md5)
+
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+    backend = RecordingBackend(str(tmp_path / 'blobs'))
+
+    monkeypatch.setattr(AppConfig, 'BLOB_BACKEND', 'local')
+    monkeypatch.setattr(AppConfig, 'LOCAL_BLOB_ROOT', backend.root)
+    monkeypatch.setattr(UploadManager, 'BLOCK_SIZE', BLOCK_SIZE)
+    monkeypatch.setattr(UploadManager, 'RETRY_DELAY', 0)
+    monkeypatch.setattr(UploadManager, 'get_backend', classmethod(lambda cls: backend))
+    monkeypatch.setattr(UploadManager, 'notify', classmethod(lambda cls, dataset_id, action, message: None))
+    return backend
+
+
+def write_file(path, size, seed=0):
+    data = bytes((i * 31 + seed) % 251 for i in range(size))
+    with open(path, 'wb') as f:
+        f.write(data)
+    return data
+
+
+def read_blob(backend, user_id, blob_name):
+    with open(backend.get_blob_location(AppConfig.DATASETS_CONTAINER, f'datasets/{user_id}/{blob_name}'), 'rb') as f:
+        return f.read()
+
+
+def upload(path, dataset_id='dataset', blob_name='dataset.csv', user_id='user'):
+    return UploadManager.submit(dataset_id=dataset_id, blob_name=blob_name, local_file_path=str(path),
+                                user_id=user_id).result(timeout=30)
+
+
+def test_blocks_are_committed_in_file_order(backend, tmp_path):
+    path = tmp_path / 'dataset.csv'
+    data = write_file(path, 10 * BLOCK_SIZE + 100)
+    # Later blocks finish staging first
+    backend.delay = lambda block_id: 0.005 * (10 - int(base64.b64decode(block_id)))
+
+    uploaded = upload(path)
+
+    assert uploaded == f'{AppConfig.DATASETS_CONTAINER}/datasets/user/dataset.csv'
+    assert backend.committed == [[UploadManager.get_block_id(i) for i in range(11)]]
+    assert read_blob(backend, 'user', 'dataset.csv') == data
+
+    properties = backend.get_blob_properties(AppConfig.DATASETS_CONTAINER, 'datasets/user/dataset.csv')
+    assert properties['size'] == len(data)
+    assert properties['content_md5'] == hashlib.md5(data).digest()
+    assert not os.path.exists(os.path.join(backend.root, '.blocks', AppConfig.DATASETS_CONTAINER, 'datasets',
+                                           'user', 'dataset.csv'))
+    assert UploadManager.get_status('dataset') == UploadManager.UPLOADED
+
+
+def test_transient_failures_are_retried(backend, tmp_path):
+    path = tmp_path / 'dataset.csv'
+    data = write_file(path, 3 * BLOCK_SIZE)
+    backend.stage_failures = {UploadManager.get_block_id(1): 2}
+    backend.commit_failures = 1
+
+    upload(path, dataset_id='retried')
+
+    assert backend.staged.count(UploadManager.get_block_id(1)) == 3
+    assert backend.staged.count(UploadManager.get_block_id(0)) == 1
+    assert len(backend.committed) == 2
+    assert read_blob(backend, 'user', 'dataset.csv') == data
+    assert UploadManager.get_status('retried') == UploadManager.UPLOADED
+
+
+def test_upload_fails_once_retries_are_spent(backend, tmp_path):
+    path = tmp_path / 'dataset.csv'
+    write_file(path, 2 * BLOCK_SIZE)
+    backend.stage_failures = {UploadManager.get_block_id(0): UploadManager.MAX_RETRIES}
+
+    with pytest.raises(IOError):
+        upload(path, dataset_id='failed')
+
+    assert backend.committed == []
+    assert not os.path.exists(backend.get_blob_location(AppConfig.DATASETS_CONTAINER, 'datasets/user/dataset.csv'))
+    assert UploadManager.get_status('failed') == UploadManager.FAILED
+
+
+@pytest.mark.parametrize('size, n_blocks', [(0, 0), (1, 1), (BLOCK_SIZE - 1, 1), (BLOCK_SIZE, 1),
+                                            (BLOCK_SIZE + 1, 2)])
+def test_small_files(backend, tmp_path, size, n_blocks):
+    path = tmp_path / 'dataset.csv'
+    data = write_file(path, size)
+
+    upload(path, dataset_id=f'small-{size}')
+
+    assert backend.committed == [[UploadManager.get_block_id(i) for i in range(n_blocks)]]
+    assert read_blob(backend, 'user', 'dataset.csv') == data
+    assert backend.get_blob_properties(AppConfig.DATASETS_CONTAINER, 'datasets/user/dataset.csv')['content_md5'] \
+        == hashlib.md5(data).digest()
+
+
+def test_uploads_of_a_dataset_land_in_submission_order(backend, tmp_path):
+    paths = [tmp_path / f'version-{i}.csv' for i in range(4)]
+    versions = [write_file(path, (4 - i) * BLOCK_SIZE, seed=i) for i, path in enumerate(paths)]
+    # Older versions are bigger and slower, they would land last if uploads of a dataset overlapped
+    backend.delay = lambda block_id: 0.01
+
+    futures = [UploadManager.submit(dataset_id='ordered', blob_name='dataset.csv', local_file_path=str(path),
+                                    user_id='user') for path in paths]
+    for future in futures:
+        future.result(timeout=30)
+
+    assert [len(block_ids) for block_ids in backend.committed] == [4, 3, 2, 1]
+    assert read_blob(backend, 'user', 'dataset.csv') == versions[-1]
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+
+from utils.DatetimeUtils import DatetimeUtils
+
+
+class AlignmentUtils:
+    """Linear interpolation of a reference time series onto another series' timestamps, in O(n log m)."""
+
+    @classmethod
+    def to_nanoseconds(cls, times) -> np.ndarray:
+        return pd.DatetimeIndex(times).as_unit('ns').asi8
+
+    @classmethod
+    def merge_sources(cls, frames, value_col='Magnetic_Field', start=None, end=None):
+        """Sorted, de-duplicated (time, value) arrays of several frames, optionally limited to [start, end]"""
+        times, values = [], []
+
+        for frame in frames:
+            frame_times = DatetimeUtils.get_epoch_ns(frame)
+            frame_values = frame[value_col].to_numpy(dtype=np.float64, na_value=np.nan)
+
+            keep = ~np.isnan(frame_values) & (frame_times != pd.NaT.value)
+            if start is not None:
+                keep &= frame_times >= start
+            if end is not None:
+                keep &= frame_times <= end
+
+            times.append(frame_times[keep])
+            values.append(frame_values[keep])
+
+        times = np.concatenate(times) if times else np.array([], dtype=np.int64)
+        values = np.concatenate(values) if values else np.array([], dtype=np.float64)
+
+        # Where sources overlap the first one listed wins, as drop_duplicates(keep='first') would
+        order = np.argsort(times, kind='stable')
+        times, values = times[order], values[order]
+        first = np.concatenate(([True], times[1:] != times[:-1])) if len(times) else np.array([], dtype=bool)
+
+        return times[first], values[first]
+
+    @classmethod
+    def interpolate_at(cls, target_times, source_times, source_values, tolerance) -> np.ndarray:
+        """
+        Source values at every target time. Targets between two source samples are interpolated linearly,
+        targets before the first or after the last sample take that sample. Targets whose nearest source
+        sample is further away than the tolerance are NaN.
+        """
+        target_times = np.asarray(target_times, dtype=np.int64)
+        tolerance = pd.Timedelta(tolerance).value
+
+        aligned = np.full(len(target_times), np.nan)
+        if len(source_times) == 0 or len(target_times) == 0:
+            return aligned
+
+        right = np.searchsorted(source_times, target_times, side='left')
+        left = right - 1
+
+        right_idx = np.minimum(right, len(source_times) - 1)
+        left_idx = np.maximum(left, 0)
+
+        has_right = right < len(source_times)
+        has_left = left >= 0
+
+        # Exact matches land on the right neighbour, so they never need a left one
+        exact = has_right & (source_times[right_idx] == target_times)
+        has_left &= ~exact
+
+        right_dist = np.where(has_right, source_times[right_idx] - target_times, np.iinfo(np.int64).max)
+        left_dist = np.where(has_left, target_times - source_times[left_idx], np.iinfo(np.int64).max)
+
+        within = np.minimum(left_dist, right_dist) <= tolerance
+        both = has_left & has_right & within
+
+        span = (source_times[right_idx] - source_times[left_idx]).astype(np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = np.where(both, left_dist / np.where(both, span, 1.0), 0.0)
+
+        interpolated = source_values[left_idx] + (source_values[right_idx] - source_values[left_idx]) * weight
+
+        aligned[both] = interpolated[both]
+        only_right = within & ~both & has_right
+        only_left = within & ~both & has_left & ~has_right
+        aligned[only_right] = source_values[right_idx][only_right]
+        aligned[only_left] = source_values[left_idx][only_left]
+
+        return aligned
@@ -1,6 +1,7 @@
 import os
 
-from azure.storage.blob import BlobClient, BlobServiceClient
+from azure.core import MatchConditions
+from azure.storage.blob import BlobBlock, BlobClient, BlobServiceClient, ContentSettings
 from azure.identity import DefaultAzureCredential
 
 import AppConfig
@@ -28,6 +29,30 @@ class BlobConnector:
             blob_client = cls.blob_service_client.get_container_client(container=container)
             blob_client.upload_blob(name=blob_name, data=data, overwrite=True)
 
+    @classmethod
+    def stage_block(cls, container, blob_name, block_id, data):
+        cls.blob_service_client.get_blob_client(container, blob_name).stage_block(block_id=block_id, data=data)
+
+    @classmethod
+    def commit_blocks(cls, container, blob_name, block_ids, content_md5=None):
+        blob_client = cls.blob_service_client.get_blob_client(container, blob_name)
+        blob_client.commit_block_list([BlobBlock(block_id=block_id) for block_id in block_ids],
+                                      content_settings=ContentSettings(content_md5=content_md5))
+
+    @classmethod
+    def get_blob_properties(cls, container, blob_name):
+        properties = cls.blob_service_client.get_blob_client(container, blob_name).get_blob_properties()
+        return {'size': properties.size,
+                'etag': properties.etag,
+                'content_md5': properties.content_settings.content_md5}
+
+    @classmethod
+    def download_range(cls, container, blob_name, offset, length, etag):
+        """Bytes of the range, refused if the blob is no longer the version with the etag"""
+        blob_client = cls.blob_service_client.get_blob_client(container, blob_name)
+        return blob_client.download_blob(offset=offset, length=length, etag=etag,
+                                         match_condition=MatchConditions.IfNotModified).readall()
+
     @classmethod
     def download_blob(cls,
                       blob_name: str,
@@ -0,0 +1,270 @@
+import csv
+import hashlib
+import itertools
+import os
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from utils.DatetimeUtils import DatetimeUtils
+
+
+class ColumnarCache:
+    """Typed parquet copy of a dataset CSV, written once and read by every processing stage."""
+
+    CACHE_FORMAT = 'parquet'
+    # Chunked readers decode a whole row group at a time, so this bounds their memory
+    ROW_GROUP_SIZE = 100000
+    DATETIME_COL = DatetimeUtils.DATETIME_COL
+    DATETIME_NS_COL = DatetimeUtils.DATETIME_NS_COL
+
+    # Column types are inferred from the head of the file, the rest is streamed in blocks with those types. The
+    # reader runs dozens of blocks ahead, so they're kept small
+    CSV_SAMPLE_SIZE = 16 * 1024 ** 2
+    CSV_BLOCK_SIZE = 1024 ** 2
+    # What pandas reads as missing by default
+    NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>',
+                 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+
+    @classmethod
+    def get_cache_path(cls, source_path):
+        return f'{os.path.splitext(source_path)[0]}.{cls.CACHE_FORMAT}'
+
+    @classmethod
+    def is_fresh(cls, source_path):
+        cache_path = cls.get_cache_path(source_path)
+        if not os.path.exists(cache_path):
+            return False
+        if not os.path.exists(source_path):
+            return True
+        return os.path.getmtime(cache_path) >= os.path.getmtime(source_path)
+
+    @classmethod
+    def write(cls, df: pd.DataFrame, source_path):
+        cache_path = cls.get_cache_path(source_path)
+        tmp_path = f'{cache_path}.{uuid.uuid4().hex}.tmp'
+
+        try:
+            df.to_parquet(tmp_path, index=False, row_group_size=cls.ROW_GROUP_SIZE)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # Columns holding a mix of numbers and strings can't be typed, keep them as text
+            df = df.copy()
+            for col in df.columns[df.dtypes == object]:
+                df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+            df.to_parquet(tmp_path, index=False, row_group_size=cls.ROW_GROUP_SIZE)
+
+        os.replace(tmp_path, cache_path)
+        return cache_path
+
+    @classmethod
+    def get_csv_column_names(cls, source_path):
+        """Header names as pandas gives them, blank ones as 'Unnamed: i' and repeats suffixed '.1', '.2'..."""
+        with open(source_path, newline='') as f:
+            header = next(csv.reader(f), [])
+
+        names, seen = [], {}
+        for i, name in enumerate(header):
+            name = name or f'Unnamed: {i}'
+            if name in seen:
+                seen[name] += 1
+                name = f'{name}.{seen[name]}'
+            else:
+                seen[name] = 0
+            names.append(name)
+        return names
+
+    @classmethod
+    def get_convert_options(cls, column_types):
+        return pa_csv.ConvertOptions(column_types=column_types, null_values=cls.NA_VALUES, strings_can_be_null=True)
+
+    @classmethod
+    def open_csv(cls, source_path, names, column_types):
+        return pa_csv.open_csv(
+            source_path,
+            read_options=pa_csv.ReadOptions(column_names=names, skip_rows=1, block_size=cls.CSV_BLOCK_SIZE),
+            convert_options=cls.get_convert_options(column_types)
+        )
+
+    @classmethod
+    def read_csv_sample(cls, source_path, names) -> pa.Table:
+        """Whole lines from the head of the file, the datetime column kept as text"""
+        with open(source_path, 'rb') as f:
+            sample = f.read(cls.CSV_SAMPLE_SIZE)
+            if f.read(1):
+                # A row cut in two could be typed wrong
+                sample = sample[:sample.rfind(b'\n') + 1]
+
+        return pa_csv.read_csv(
+            pa.py_buffer(sample),
+            read_options=pa_csv.ReadOptions(column_names=names, skip_rows=1),
+            convert_options=cls.get_convert_options({cls.DATETIME_COL: pa.string()})
+        )
+
+    @classmethod
+    def get_csv_column_types(cls, sample: pa.Table):
+        """Sample's types with the differences to pandas taken out: dates stay text and empty columns are floats"""
+        column_types = {}
+        for field in sample.schema:
+            if field.name == cls.DATETIME_COL or pa.types.is_temporal(field.type):
+                column_types[field.name] = pa.string()
+            elif pa.types.is_null(field.type):
+                column_types[field.name] = pa.float64()
+            else:
+                column_types[field.name] = field.type
+        return column_types
+
+    @classmethod
+    def get_datetime_format(cls, sample: pa.Table):
+        """Format every block's datetimes are parsed with, None to take them from the stored epoch-ns column"""
+        if cls.DATETIME_NS_COL in sample.column_names:
+            return None
+        return DatetimeUtils.infer_format(sample.column(cls.DATETIME_COL).to_pandas()) or 'mixed'
+
+    @classmethod
+    def normalize_datetime(cls, table: pa.Table, datetime_format) -> pa.Table:
+        if datetime_format is None:
+            values = pd.to_datetime(table.column(cls.DATETIME_NS_COL).to_pandas(), unit='ns')
+        else:
+            values = pd.to_datetime(table.column(cls.DATETIME_COL).to_pandas(), format=datetime_format)
+
+        table = table.set_column(table.column_names.index(cls.DATETIME_COL), cls.DATETIME_COL, pa.array(values))
+        if cls.DATETIME_NS_COL not in table.column_names:
+            table = table.append_column(cls.DATETIME_NS_COL,
+                                        pa.array(DatetimeUtils.to_epoch_ns(values), type=pa.int64()))
+        return table
+
+    @classmethod
+    def stream_from_csv(cls, source_path, tmp_path):
+        """
+        Converts the CSV one block at a time, only a few blocks and a row group are in memory. False when the CSV
+        has no rows, nothing is written then.
+        """
+        names = cls.get_csv_column_names(source_path)
+        sample = cls.read_csv_sample(source_path, names)
+        if sample.num_rows == 0:
+            return False
+
+        parse_datetime = cls.DATETIME_COL in names
+        if parse_datetime:
+            try:
+                datetime_format = cls.get_datetime_format(sample)
+            except (ValueError, TypeError) as e:
+                print(f'Could not parse {cls.DATETIME_COL} for {source_path}: {e}')
+                parse_datetime = False
+
+        reader = cls.open_csv(source_path, names, cls.get_csv_column_types(sample))
+        del sample
+
+        writer, pending, pending_rows = None, [], 0
+        try:
+            for batch in itertools.chain(reader, [None]):
+                if batch is not None:
+                    pending.append(batch)
+                    pending_rows += batch.num_rows
+                    if pending_rows < cls.ROW_GROUP_SIZE:
+                        continue
+                elif not pending:
+                    break
+
+                # Blocks are gathered into whole row groups, the chunked readers decode one at a time
+                table = pa.Table.from_batches(pending)
+                if batch is not None:
+                    full_rows = pending_rows - pending_rows % cls.ROW_GROUP_SIZE
+                    pending = table.slice(full_rows).to_batches()
+                    pending_rows -= full_rows
+                    table = table.slice(0, full_rows)
+                else:
+                    pending, pending_rows = [], 0
+                if parse_datetime:
+                    table = cls.normalize_datetime(table, datetime_format)
+
+                if writer is None:
+                    writer = pq.ParquetWriter(tmp_path, table.schema)
+                writer.write_table(table, row_group_size=cls.ROW_GROUP_SIZE)
+        finally:
+            if writer is not None:
+                writer.close()
+
+        return writer is not None
+
+    @classmethod
+    def build_from_csv(cls, source_path):
+        cache_path = cls.get_cache_path(source_path)
+        tmp_path = f'{cache_path}.{uuid.uuid4().hex}.tmp'
+
+        try:
+            streamed = cls.stream_from_csv(source_path, tmp_path)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, ValueError, TypeError) as e:
+            # A column changing type past the first block needs the whole file to type it, as pandas does
+            print(f'Streaming {source_path} into parquet failed, reading it whole: {e}')
+            streamed = False
+
+        if not streamed:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return cls.build_from_frame(source_path)
+
+        os.replace(tmp_path, cache_path)
+        return cache_path
+
+    @classmethod
+    def build_from_frame(cls, source_path):
+        df = pd.read_csv(source_path)
+
+        if cls.DATETIME_COL in df.columns:
+            try:
+                df = DatetimeUtils.normalize(df)
+            except (ValueError, TypeError) as e:
+                print(f'Could not parse {cls.DATETIME_COL} for {source_path}: {e}')
+
+        return cls.write(df, source_path)
+
+    @classmethod
+    def ensure(cls, source_path):
+        if not cls.is_fresh(source_path):
+            cls.build_from_csv(source_path)
+        return cls.get_cache_path(source_path)
+
+    @classmethod
+    def get_columns(cls, source_path):
+        return list(pq.read_schema(cls.ensure(source_path)).names)
+
+    @classmethod
+    def get_row_count(cls, source_path):
+        return pq.read_metadata(cls.ensure(source_path)).num_rows
+
+    @classmethod
+    def get_version(cls, source_path):
+        """Content version of the dataset from the parquet footer, its row counts, sizes and column statistics"""
+        metadata = pq.read_metadata(cls.ensure(source_path)).to_dict()
+        metadata.pop('created_by', None)
+        return hashlib.md5(repr(metadata).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def read(cls, source_path, columns=None, start_idx=None, end_idx=None) -> pd.DataFrame:
+        cache_path = cls.ensure(source_path)
+
+        if columns is not None:
+            available = set(pq.read_schema(cache_path).names)
+            columns = [col for col in dict.fromkeys(columns) if col in available]
+
+        df = pd.read_parquet(cache_path, columns=columns)
+
+        if start_idx is not None and end_idx is not None:
+            df = df.iloc[start_idx:end_idx + 1].reset_index(drop=True)
+
+        return df
+
+    @classmethod
+    def iter_chunks(cls, source_path, columns=None, chunk_size=500000):
+        cache_path = cls.ensure(source_path)
+
+        if columns is not None:
+            available = set(pq.read_schema(cache_path).names)
+            columns = [col for col in dict.fromkeys(columns) if col in available]
+
+        for batch in pq.ParquetFile(cache_path).iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
@@ -4,4 +4,5 @@ class Consts:
     PROCESSING_DISPLAY_STATE = "PROCESSING"
     SAVING_DISPLAY_STATE = "SAVING"
     FINISHED_DISPLAY_STATE = "FINISHED"
+    ERROR_DISPLAY_STATE = "ERROR"
     APP_NAME = "ucc-mag-processor"
\ No newline at end of file
@@ -0,0 +1,175 @@
+import base64
+import glob
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import AppConfig
+from utils.ColumnarCache import ColumnarCache
+from utils.ObservatoryStore import ObservatoryStore
+from utils.UploadManager import UploadManager
+
+
+class DatasetCache:
+    """
+    Local copies of dataset blobs under every user's downloads directory, bounded by a disk budget shared by all of
+    them. Blobs come down as ranges fetched in parallel straight into the file, and are checked against the blob's
+    size and checksum before they're used. Each download has a sidecar whose mtime is the last time it was read,
+    the least recently read ones are evicted first, together with the columnar copy and day partitions built from
+    them. Nothing read or rebuilt within the grace window is evicted, a reader may still be going through it.
+    """
+
+    RANGE_SIZE = AppConfig.DOWNLOAD_RANGE_SIZE
+    META_SUFFIX = '.meta'
+
+    _executor = ThreadPoolExecutor(max_workers=AppConfig.DOWNLOAD_MAX_WORKERS, thread_name_prefix='download-range')
+
+    @classmethod
+    def get_meta_path(cls, file_path):
+        return f'{file_path}{cls.META_SUFFIX}'
+
+    @classmethod
+    def write_range(cls, backend, container, blob_name, etag, tmp_path, offset):
+        data = UploadManager.retry(backend.download_range, container, blob_name, offset, cls.RANGE_SIZE, etag)
+        with open(tmp_path, 'r+b') as f:
+            f.seek(offset)
+            f.write(data)
+        return len(data)
+
+    @classmethod
+    def verify(cls, tmp_path, properties):
+        size = os.path.getsize(tmp_path)
+        if size != properties['size']:
+            raise IOError(f'Downloaded {size} bytes of a {properties["size"]} byte blob')
+
+        # Blobs uploaded before checksums were set have none to check against
+        if properties['content_md5']:
+            md5 = hashlib.md5()
+            with open(tmp_path, 'rb') as f:
+                for data in iter(lambda: f.read(cls.RANGE_SIZE), b''):
+                    md5.update(data)
+            if md5.digest() != bytes(properties['content_md5']):
+                raise IOError('Checksum of the download does not match the blob')
+
+    @classmethod
+    def download(cls, blob_name, file_path, linked=False):
+        backend = UploadManager.get_backend()
+        container = AppConfig.DATASETS_CONTAINER if not linked else AppConfig.PROJECTS_CONTAINER
+        properties = UploadManager.retry(backend.get_blob_properties, container, blob_name)
+
+        tmp_path = f'{file_path}.{uuid.uuid4().hex}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.truncate(properties['size'])
+
+            # Every range is pinned to the etag, a blob overwritten mid-download fails rather than mixing versions
+            futures = [cls._executor.submit(cls.write_range, backend, container, blob_name, properties['etag'],
+                                            tmp_path, offset)
+                       for offset in range(0, properties['size'], cls.RANGE_SIZE)]
+            try:
+                for future in futures:
+                    future.result()
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                # Ranges already running still write to the file, it's removed once they're done
+                wait(futures)
+                raise
+
+            cls.verify(tmp_path, properties)
+            os.replace(tmp_path, file_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        content_md5 = properties['content_md5']
+        with open(cls.get_meta_path(file_path), 'w') as f:
+            json.dump({'blob': blob_name,
+                       'size': properties['size'],
+                       'md5': base64.b64encode(content_md5).decode() if content_md5 else None,
+                       'mtime_ns': os.stat(file_path).st_mtime_ns}, f)
+
+        print(f'Downloaded {properties["size"]} bytes of {blob_name}')
+        return file_path
+
+    @classmethod
+    def fetch(cls, blob_name, file_path, linked=False):
+        """Local path of the blob, downloaded unless a copy is already there"""
+        if not os.path.exists(file_path):
+            return cls.download(blob_name, file_path, linked)
+
+        try:
+            os.utime(cls.get_meta_path(file_path))
+        except FileNotFoundError:
+            # Written locally rather than downloaded, it isn't the cache's to manage
+            pass
+        return file_path
+
+    @classmethod
+    def get_size(cls, path):
+        if not os.path.isdir(path):
+            return os.path.getsize(path)
+        return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+    @classmethod
+    def remove(cls, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    @classmethod
+    def get_entries(cls):
+        entries = []
+        for meta_path in glob.glob(os.path.join(AppConfig.PROJECT_ROOT, 'data', '*', 'downloads',
+                                                f'*{cls.META_SUFFIX}')):
+            file_path = meta_path[:-len(cls.META_SUFFIX)]
+            try:
+                with open(meta_path) as f:
+                    meta = json.load(f)
+
+                # A dataset saved over its download is the only copy until its upload lands, it's never evicted
+                if os.stat(file_path).st_mtime_ns != meta['mtime_ns']:
+                    continue
+
+                paths = [path for path in (file_path, ColumnarCache.get_cache_path(file_path),
+                                           ObservatoryStore.get_store_path(file_path)) if os.path.exists(path)]
+                # Rebuilding the columnar copy or the day partitions counts as a use too
+                last_used = max([os.path.getmtime(meta_path)] + [os.path.getmtime(path) for path in paths])
+                entries.append((last_used, sum(cls.get_size(path) for path in paths), meta_path, paths))
+            except (FileNotFoundError, ValueError, KeyError):
+                continue
+        return entries
+
+    @classmethod
+    def evict(cls, keep=None, max_bytes=None):
+        """
+        Removes the least recently read downloads, with their columnar copies and day partitions, until the rest fit
+        the budget. Those read within DOWNLOAD_CACHE_GRACE seconds stay even over it.
+        """
+        max_bytes = AppConfig.DOWNLOAD_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        entries = sorted(cls.get_entries())
+        total = sum(size for _, size, _, _ in entries)
+        used_since = time.time() - AppConfig.DOWNLOAD_CACHE_GRACE
+
+        for last_used, size, meta_path, paths in entries:
+            if total <= max_bytes or last_used > used_since:
+                break
+            if keep in paths:
+                continue
+
+            # The sidecar goes first, a file left behind by a failed removal is no longer tracked but still valid
+            try:
+                os.remove(meta_path)
+                for path in paths:
+                    cls.remove(path)
+            except OSError as e:
+                print(f'Could not evict {paths[0]}: {e}')
+                continue
+            total -= size
+
+        return total
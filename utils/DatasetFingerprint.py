@@ -0,0 +1,59 @@
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+
+class DatasetFingerprint:
+    """Cheap content hash of a DataFrame, used in place of the frame itself in cache keys."""
+
+    SAMPLE_ROWS = 1024
+
+    @classmethod
+    def of_frame(cls, df: pd.DataFrame) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f'{len(df)}|{list(df.columns)}|{[str(d) for d in df.dtypes]}'.encode('utf-8'))
+
+        if len(df) > 0:
+            # Evenly strided rows always include the first and last one
+            sample_idx = np.unique(np.linspace(0, len(df) - 1, num=min(cls.SAMPLE_ROWS, len(df)), dtype=np.int64))
+            sample = df.iloc[sample_idx]
+            digest.update(pd.util.hash_pandas_object(sample, index=False).to_numpy().tobytes())
+
+            # Column totals catch edits between the sampled rows, such as clipped and interpolated points
+            numeric = df.select_dtypes(include='number')
+            if len(numeric.columns) > 0:
+                digest.update(numeric.sum().to_numpy(dtype=np.float64).tobytes())
+
+        return digest.hexdigest()
+
+    @classmethod
+    def of_array(cls, values: np.ndarray) -> str:
+        """Hash of every element, arrays are cheap enough to hash whole"""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f'{values.dtype}|{values.shape}'.encode('utf-8'))
+
+        if values.dtype == object:
+            # The raw bytes of an object array are pointers, its elements are hashed by value instead
+            digest.update(pd.util.hash_array(values.ravel()).tobytes())
+        else:
+            digest.update(np.ascontiguousarray(values).tobytes())
+
+        return digest.hexdigest()
+
+    @classmethod
+    def of_value(cls, value) -> str:
+        """Cache key part of an argument. repr is only used for values whose repr is never cut short with '...'"""
+        if isinstance(value, pd.DataFrame):
+            return f'DataFrame({cls.of_frame(value)})'
+        if isinstance(value, pd.Series):
+            return f'Series({cls.of_frame(value.to_frame())})'
+        if isinstance(value, pd.Index):
+            return f'Index({cls.of_frame(value.to_frame(index=False))})'
+        if isinstance(value, np.ndarray):
+            return f'ndarray({cls.of_array(value)})'
+        if isinstance(value, (list, tuple)):
+            return f'{type(value).__name__}({",".join(cls.of_value(v) for v in value)})'
+        if isinstance(value, dict):
+            return f'dict({",".join(f"{cls.of_value(k)}:{cls.of_value(v)}" for k, v in value.items())})'
+        return repr(value)
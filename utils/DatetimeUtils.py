@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+
+
+class DatetimeUtils:
+    """
+    Timestamp parsing done once at ingest. The format is inferred from a sample and the column parsed with it in
+    one vectorized pass, then kept as epoch nanoseconds so later stages never parse text again.
+    """
+
+    DATETIME_COL = 'Datetime'
+    DATETIME_NS_COL = 'Datetime_ns'
+    SAMPLE_SIZE = 1000
+
+    # Formats with the day before the month, each also tried with the two swapped
+    DAY_FIRST_FORMATS = [
+        '%d/%m/%Y %H:%M:%S',
+        '%d/%m/%Y %H:%M:%S.%f',
+        '%d/%m/%Y %H:%M',
+    ]
+
+    OTHER_FORMATS = [
+        '%Y/%m/%d %H:%M:%S',
+        '%Y/%m/%d %H:%M:%S.%f',
+        '%d-%m-%Y %H:%M:%S',
+        '%d-%m-%Y %H:%M:%S.%f',
+        '%d.%m.%Y %H:%M:%S',
+    ]
+
+    @classmethod
+    def get_sample(cls, values: pd.Series) -> pd.Series:
+        values = values.dropna()
+        if len(values) <= cls.SAMPLE_SIZE:
+            return values.astype(str)
+
+        sample_idx = np.unique(np.linspace(0, len(values) - 1, num=cls.SAMPLE_SIZE, dtype=np.int64))
+        return values.iloc[sample_idx].astype(str)
+
+    @staticmethod
+    def swap_day_month(fmt):
+        if fmt.startswith('%d/%m'):
+            return fmt.replace('%d/%m', '%m/%d', 1)
+        if fmt.startswith('%m/%d'):
+            return fmt.replace('%m/%d', '%d/%m', 1)
+        return None
+
+    @classmethod
+    def get_candidate_formats(cls, dayfirst=None):
+        """Candidates in the order they are tried, month first unless told otherwise, as pandas reads dates"""
+        month_first = [cls.swap_day_month(fmt) for fmt in cls.DAY_FIRST_FORMATS]
+        ordered = cls.DAY_FIRST_FORMATS + month_first if dayfirst else month_first + cls.DAY_FIRST_FORMATS
+
+        # ISO8601 also takes readings with and without fractional seconds in one column
+        return ['ISO8601', *ordered, *cls.OTHER_FORMATS]
+
+    @classmethod
+    def try_format(cls, sample: pd.Series, fmt):
+        try:
+            return pd.to_datetime(sample, format=fmt)
+        except (ValueError, TypeError):
+            return None
+
+    @classmethod
+    def infer_format(cls, values: pd.Series, dayfirst=None):
+        """
+        First candidate format that parses every sampled value, None if there is none. A sample that reads as
+        different dates with the day and month swapped takes the order given by dayfirst, and raises without one.
+        """
+        sample = cls.get_sample(values)
+
+        for fmt in cls.get_candidate_formats(dayfirst):
+            parsed = cls.try_format(sample, fmt)
+            if parsed is None:
+                continue
+
+            swapped = cls.swap_day_month(fmt)
+            swapped_parsed = cls.try_format(sample, swapped) if swapped else None
+            if swapped_parsed is not None and not parsed.equals(swapped_parsed):
+                if dayfirst is None:
+                    raise ValueError(f'Datetime values read as different dates with {fmt} and {swapped}, '
+                                     f'the day/month order has to be given')
+                print(f'Datetime values fit both {fmt} and {swapped}, reading them as {fmt}')
+
+            return fmt
+
+        return None
+
+    @classmethod
+    def parse(cls, values: pd.Series, dayfirst=None) -> pd.Series:
+        if pd.api.types.is_datetime64_any_dtype(values):
+            return values
+
+        fmt = cls.infer_format(values, dayfirst)
+        if fmt is not None:
+            try:
+                return pd.to_datetime(values, format=fmt)
+            except (ValueError, TypeError) as e:
+                print(f'Inferred datetime format {fmt} does not fit every row: {e}')
+
+        print('Falling back to per-row datetime parsing')
+        return pd.to_datetime(values, format='mixed', dayfirst=bool(dayfirst))
+
+    @classmethod
+    def to_epoch_ns(cls, values: pd.Series) -> np.ndarray:
+        return pd.DatetimeIndex(values).as_unit('ns').asi8
+
+    @classmethod
+    def normalize(cls, df: pd.DataFrame, dayfirst=None) -> pd.DataFrame:
+        """Typed datetime column plus its int64 epoch-ns copy, which survives CSV round trips exactly"""
+        df = cls.restore(df, dayfirst)
+        if cls.DATETIME_NS_COL not in df.columns:
+            df[cls.DATETIME_NS_COL] = cls.to_epoch_ns(df[cls.DATETIME_COL])
+        return df
+
+    @classmethod
+    def get_epoch_ns(cls, df: pd.DataFrame) -> np.ndarray:
+        if cls.DATETIME_NS_COL in df.columns:
+            return df[cls.DATETIME_NS_COL].to_numpy(dtype=np.int64)
+        return cls.to_epoch_ns(cls.parse(df[cls.DATETIME_COL]))
+
+    @classmethod
+    def restore(cls, df: pd.DataFrame, dayfirst=None) -> pd.DataFrame:
+        """Typed datetime column of a loaded frame, taken from the stored epoch-ns column when there is one"""
+        if cls.DATETIME_COL not in df.columns or pd.api.types.is_datetime64_any_dtype(df[cls.DATETIME_COL]):
+            return df
+
+        if cls.DATETIME_NS_COL in df.columns:
+            df[cls.DATETIME_COL] = pd.to_datetime(df[cls.DATETIME_NS_COL], unit='ns')
+        else:
+            df[cls.DATETIME_COL] = cls.parse(df[cls.DATETIME_COL], dayfirst)
+
+        return df
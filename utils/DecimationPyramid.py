@@ -0,0 +1,114 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from utils.DatasetFingerprint import DatasetFingerprint
+
+
+class DecimationPyramid:
+    """
+    Min/max buckets of a series at several zoom levels. Any index range can be drawn with a bounded number of
+    points, and spikes survive decimation because every bucket keeps both of its extremes
+    """
+
+    FACTOR = 4
+    TARGET_POINTS = 4000
+
+    # Kept as live objects in this worker, the Flask cache would pickle the whole series in and out on every zoom
+    PYRAMIDS = OrderedDict()
+    PYRAMIDS_SIZE = 16
+    LOCK = threading.Lock()
+
+    def __init__(self, values, factor=FACTOR, target_points=TARGET_POINTS):
+        self.values = np.asarray(values, dtype=np.float64)
+        self.length = len(self.values)
+        self.factor = factor
+        self.target_points = target_points
+        self.levels = []
+
+        bucket = 1
+        min_idx = max_idx = np.arange(self.length)
+        min_val = max_val = self.values
+
+        while 2 * len(min_val) > target_points:
+            bucket *= factor
+            min_idx, min_val = self.reduce(min_idx, min_val, np.inf, np.argmin)
+            max_idx, max_val = self.reduce(max_idx, max_val, -np.inf, np.argmax)
+            self.levels.append((bucket, *self.merge(min_idx, min_val, max_idx, max_val)))
+
+    def reduce(self, idx, val, fill, arg_func):
+        pad = (-len(val)) % self.factor
+        val = np.concatenate((val, np.full(pad, np.nan))).reshape(-1, self.factor)
+        idx = np.concatenate((idx, np.full(pad, -1))).reshape(-1, self.factor)
+
+        # All-NaN buckets land on a NaN value and are dropped when merged
+        picked = arg_func(np.where(np.isnan(val), fill, val), axis=1)
+        rows = np.arange(len(val))
+        return idx[rows, picked], val[rows, picked]
+
+    @staticmethod
+    def merge(min_idx, min_val, max_idx, max_val):
+        idx = np.stack((min_idx, max_idx), axis=1)
+        val = np.stack((min_val, max_val), axis=1)
+
+        order = np.argsort(idx, axis=1)
+        rows = np.arange(len(idx))[:, None]
+        idx, val = idx[rows, order], val[rows, order]
+
+        keep = ~np.isnan(val)
+        keep[:, 1] &= idx[:, 1] != idx[:, 0]
+        return idx[keep], val[keep]
+
+    def get_range(self, start=0, end=None, target_points=None):
+        target_points = target_points or self.target_points
+        start = int(min(max(start, 0), self.length))
+        end = self.length if end is None else int(min(max(end, start), self.length))
+
+        span = end - start
+
+        # Narrow enough to draw every reading
+        if span <= target_points:
+            idx = np.arange(start, end)
+            val = self.values[start:end]
+            keep = ~np.isnan(val)
+            return idx[keep], val[keep]
+
+        # Finest level that fits, the coarsest level always fits the whole series
+        level = next((lvl for lvl in self.levels if 2 * span / lvl[0] <= target_points), self.levels[-1])
+        _, idx, val = level
+
+        lo, hi = np.searchsorted(idx, [start, end])
+        return idx[lo:hi], val[lo:hi]
+
+    @classmethod
+    def for_series(cls, series: pd.Series):
+        """Key and pyramid of the series, built unless this worker already has it"""
+        key = f'decimation_pyramid_{DatasetFingerprint.of_frame(series.to_frame())}'
+
+        with cls.LOCK:
+            if key in cls.PYRAMIDS:
+                cls.PYRAMIDS.move_to_end(key)
+                return key, cls.PYRAMIDS[key]
+
+        pyramid = cls(series.to_numpy(dtype=np.float64, na_value=np.nan))
+
+        with cls.LOCK:
+            cls.PYRAMIDS[key] = pyramid
+            cls.PYRAMIDS.move_to_end(key)
+            while len(cls.PYRAMIDS) > cls.PYRAMIDS_SIZE:
+                cls.PYRAMIDS.popitem(last=False)
+
+        return key, pyramid
+
+    @classmethod
+    def get_cached(cls, key):
+        if not key:
+            return None
+
+        with cls.LOCK:
+            pyramid = cls.PYRAMIDS.get(key)
+            if pyramid is not None:
+                cls.PYRAMIDS.move_to_end(key)
+            return pyramid
@@ -0,0 +1,119 @@
+import hashlib
+import os
+import re
+import shutil
+import uuid
+
+
+class DiskCache:
+    """
+    Size-bounded LRU of file artifacts on disk, shared by every process on the machine. Each entry is a
+    directory of named files and its mtime is the last time it was used.
+    """
+
+    KEY_PATTERN = re.compile(r'[0-9a-f]{32}')
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        return hashlib.md5(repr(parts).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def is_key(cls, key) -> bool:
+        """Whether the key has the form make_key gives, anything else could name a path outside the cache"""
+        return isinstance(key, str) and cls.KEY_PATTERN.fullmatch(key) is not None
+
+    def get_entry_path(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key):
+        """Paths of the files cached under the key, None on a miss"""
+        entry_path = self.get_entry_path(key)
+        if not os.path.isdir(entry_path):
+            return None
+
+        try:
+            os.utime(entry_path)
+            return {name: os.path.join(entry_path, name) for name in os.listdir(entry_path)}
+        except FileNotFoundError:
+            # Evicted by another process in the meantime
+            return None
+
+    def fetch(self, key, destinations) -> bool:
+        """Copies the cached files to the given destinations, False unless every one of them is cached"""
+        cached = self.get(key)
+        if cached is None or not all(name in cached for name in destinations):
+            return False
+
+        try:
+            for name, destination in destinations.items():
+                shutil.copyfile(cached[name], destination)
+        except FileNotFoundError:
+            return False
+
+        return True
+
+    def get_bytes(self, key, name):
+        cached = self.get(key)
+        if cached is None or name not in cached:
+            return None
+
+        try:
+            with open(cached[name], 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, sources):
+        """Stores the named source files, or raw bytes, as one entry, replacing any entry already under the key"""
+        entry_path = self.get_entry_path(key)
+        tmp_path = f'{entry_path}.{uuid.uuid4().hex}.tmp'
+        os.makedirs(tmp_path)
+
+        for name, source in sources.items():
+            if isinstance(source, bytes):
+                with open(os.path.join(tmp_path, name), 'wb') as f:
+                    f.write(source)
+            else:
+                shutil.copyfile(source, os.path.join(tmp_path, name))
+
+        if os.path.isdir(entry_path):
+            shutil.rmtree(entry_path, ignore_errors=True)
+        try:
+            os.replace(tmp_path, entry_path)
+        except OSError:
+            # Another process stored the same entry first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+        self.evict()
+        return entry_path
+
+    def get_entries(self):
+        entries = []
+        for key in os.listdir(self.root):
+            entry_path = self.get_entry_path(key)
+            if key.endswith('.tmp') or not os.path.isdir(entry_path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry_path, name)) for name in os.listdir(entry_path))
+                entries.append((os.path.getmtime(entry_path), size, entry_path))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def evict(self):
+        entries = sorted(self.get_entries())
+        total = sum(size for _, size, _ in entries)
+
+        # Least recently used first, but an entry written this instant is never the one to go
+        for _, size, entry_path in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_path, ignore_errors=True)
+            total -= size
+
+        return total
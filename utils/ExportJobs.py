@@ -0,0 +1,83 @@
+import os
+import time
+
+import AppConfig
+from dataservices.RedisLock import RedisLock
+from utils.ColumnarCache import ColumnarCache
+from utils.Consts import Consts
+from utils.DiskCache import DiskCache
+from utils.ExportUtils import ExportUtils
+
+
+class ExportJobs:
+    """
+    Exports keyed on (dataset version, format, columns). Finished files are kept in a size-bounded cache shared by
+    every user, and a request for an export already running elsewhere waits for it instead of repeating the work.
+    """
+
+    # Bumped whenever an exporter's output changes, so older cache entries are never served
+    FORMAT_VERSION = 1
+    ARTIFACT = 'artifact'
+    POLL_INTERVAL = 1
+
+    @classmethod
+    def get_cache(cls):
+        return DiskCache(AppConfig.EXPORT_CACHE_DIR, AppConfig.EXPORT_CACHE_MAX_BYTES)
+
+    @classmethod
+    def get_job_key(cls, dataset_id, file_path, export_format, columns):
+        # Column order is kept, it's the order the columns are written in
+        return DiskCache.make_key('export', cls.FORMAT_VERSION, dataset_id, ColumnarCache.get_version(file_path),
+                                  export_format, tuple(dict.fromkeys(columns)))
+
+    @classmethod
+    def run_export(cls, dataset_id, session, export_format, columns, redis_queue):
+        if export_format == 'csv':
+            return ExportUtils.export_csv(dataset_id=dataset_id, session=session, cols_to_export=list(columns),
+                                          redis_queue=redis_queue)
+
+        return ExportUtils.export_vector_file(dataset_id=dataset_id, session=session, cols_to_export=list(columns),
+                                              redis_queue=redis_queue, export_format=export_format)
+
+    @classmethod
+    def notify(cls, redis_queue, title, message):
+        if redis_queue:
+            redis_queue.put(f'data-export;update__{Consts.LOADING_DISPLAY_STATE};{title};{message}')
+
+    @classmethod
+    def submit(cls, dataset_id, session, export_format, columns, redis_queue=None):
+        """Export path under the user's export directory, copied from the cache when the same export exists"""
+        file_path = ExportUtils.download_data_if_not_exists(dataset_id=dataset_id, session=session)
+        job_key = cls.get_job_key(dataset_id, file_path, export_format, columns)
+
+        relative_path, exported_path = ExportUtils.get_export_path(dataset_id, session, export_format)
+        os.makedirs(os.path.dirname(exported_path), exist_ok=True)
+
+        cache = cls.get_cache()
+        lock = RedisLock(f'export:{job_key}', timeout=AppConfig.EXPORT_LOCK_TIMEOUT)
+        waiting = False
+
+        try:
+            while True:
+                if cache.fetch(job_key, {cls.ARTIFACT: exported_path}):
+                    cls.notify(redis_queue, 'Reusing Export', 'Copied the file of an identical earlier export')
+                    return relative_path
+
+                if lock.acquire():
+                    try:
+                        # The job holding the lock before us may have finished between the lookup and the lock
+                        if cache.fetch(job_key, {cls.ARTIFACT: exported_path}):
+                            return relative_path
+
+                        relative_path = cls.run_export(dataset_id, session, export_format, columns, redis_queue)
+                        cache.put(job_key, {cls.ARTIFACT: exported_path})
+                        return relative_path
+                    finally:
+                        lock.release()
+
+                if not waiting:
+                    cls.notify(redis_queue, 'Waiting', 'The same export is already running, waiting for it to finish')
+                    waiting = True
+                time.sleep(cls.POLL_INTERVAL)
+        finally:
+            lock.close_connection()
@@ -1,39 +1,99 @@
 import os.path
-import threading
-import time
 import uuid
 import shutil
+import zipfile
 
 import geopandas as gpd
 import pandas as pd
-from shapely.geometry import Point
 
 import AppConfig
 from api.DatasetService import DatasetService
 from components import NotificationProvider
-from utils.AzureContainerHelper import BlobConnector
+from utils.ColumnarCache import ColumnarCache
+from utils.DatasetCache import DatasetCache
 from auth import AppIDAuthProvider
 from utils.Consts import Consts
+from utils.DatetimeUtils import DatetimeUtils
 
 
 class ExportUtils:
 
+    EXPORT_CHUNK_SIZE = 100000
+
+    # Shapefiles are zipped with their sidecar files, the other formats are a single file without its limits
+    VECTOR_FORMATS = {
+        'shp': ('ESRI Shapefile', 'shp'),
+        'gpkg': ('GPKG', 'gpkg'),
+        'fgb': ('FlatGeobuf', 'fgb')
+    }
+
+    # FlatGeobuf's spatial index sorts the features, without it rows keep the dataset's order like the other formats
+    VECTOR_LAYER_OPTIONS = {
+        'fgb': {'SPATIAL_INDEX': 'NO'}
+    }
+
+    @classmethod
+    def get_export_columns(cls, file_path):
+        """Columns a user can export, read from the columnar cache's schema rather than the data"""
+        return [col for col in ColumnarCache.get_columns(file_path)
+                if 'unnamed' not in col.lower() and col != DatetimeUtils.DATETIME_NS_COL]
+
+    @classmethod
+    def get_export_path(cls, dataset_id, session, export_format):
+        """(path under the user's export directory, absolute path) of the dataset's export in the format"""
+        if export_format == 'csv':
+            relative_path = f"{dataset_id}_exported.csv"
+        else:
+            extension = 'zip' if export_format == 'shp' else cls.VECTOR_FORMATS[export_format][1]
+            relative_path = os.path.join(dataset_id, f"{dataset_id}.{extension}")
+
+        return relative_path, os.path.join(AppConfig.PROJECT_ROOT,
+                                           "data",
+                                           session[AppIDAuthProvider.APPID_USER_NAME],
+                                           "exported",
+                                           relative_path
+                                           )
+
+    @classmethod
+    def report_progress(cls, redis_queue, written, total):
+        if redis_queue:
+            redis_queue.put(
+                f'data-export;update__{Consts.LOADING_DISPLAY_STATE};Writing;Written {written} of {total} rows')
+
     @classmethod
-    def export_csv(cls, dataset_id, session, cols_to_export):
+    def write_csv_chunks(cls, file_path, columns, exported_path, chunk_size=EXPORT_CHUNK_SIZE, redis_queue=None):
+        """
+        Streams the projected columns to a CSV one chunk at a time, so memory stays flat in the dataset size. A cold
+        columnar cache is built block by block from the source CSV first, which is flat as well.
+        """
+        available = set(ColumnarCache.get_columns(file_path))
+        columns = [col for col in dict.fromkeys(columns) if col in available]
+        total = ColumnarCache.get_row_count(file_path)
+
+        tmp_path = f'{exported_path}.{uuid.uuid4().hex}.tmp'
+        written = 0
+        with open(tmp_path, 'w', newline='') as f:
+            for chunk in ColumnarCache.iter_chunks(file_path, columns=columns, chunk_size=chunk_size):
+                # Row labels carry on across chunks, as if the whole frame had been written at once
+                chunk.index = pd.RangeIndex(written, written + len(chunk))
+                chunk[columns].to_csv(f, header=written == 0)
+                written += len(chunk)
+                cls.report_progress(redis_queue, written, total)
+
+            if written == 0:
+                pd.DataFrame(columns=columns).to_csv(f)
+
+        os.replace(tmp_path, exported_path)
+        return exported_path
+
+    @classmethod
+    def export_csv(cls, dataset_id, session, cols_to_export, redis_queue=None):
         file_path = cls.download_data_if_not_exists(dataset_id=dataset_id, session=session)
-        df = pd.read_csv(file_path)
-        df = df[cols_to_export]
 
-        exported_path = os.path.join(
-            AppConfig.PROJECT_ROOT,
-            "data",
-            session[AppIDAuthProvider.APPID_USER_NAME],
-            "exported",
-            f"{dataset_id}_exported.csv"
-        )
-        df.to_csv(exported_path)
+        relative_path, exported_path = cls.get_export_path(dataset_id, session, 'csv')
+        cls.write_csv_chunks(file_path, cols_to_export, exported_path, redis_queue=redis_queue)
 
-        return f"{dataset_id}_exported.csv"
+        return relative_path
 
     @classmethod
     def download_data_if_not_exists(cls, dataset_id, session, dataset_path=None):
@@ -51,60 +111,76 @@ class ExportUtils:
         if not os.path.exists(file_dir):
             os.mkdir(file_dir)
 
-        if not os.path.exists(file_path):
-            file_path = os.path.join(file_dir, f'{dataset_id}.{dataset_format}')
-            BlobConnector.download_blob(blob_name=dataset.path, download_location=file_path, linked=False)
+        DatasetCache.fetch(blob_name=dataset.path, file_path=file_path, linked=False)
+
+        if dataset_format == 'csv':
+            ColumnarCache.ensure(file_path)
+        DatasetCache.evict(keep=file_path)
         return file_path
 
     @classmethod
-    def export_shp_file(cls, dataset_id, cols_to_export, session, redis_queue=None):
-
-        file_path = cls.download_data_if_not_exists(dataset_id=dataset_id, session=session)
-
-        export_path = os.path.join(AppConfig.PROJECT_ROOT,
-                                   "data",
-                                   session[AppIDAuthProvider.APPID_USER_NAME],
-                                   "exported",
-                                   dataset_id
-                                   )
-        export_file_path = os.path.join(export_path, f"{dataset_id}.shp")
-        zip_path = os.path.join(dataset_id, f"{dataset_id}.zip")
-
-        # if os.path.exists(os.path.join(export_path, f"{dataset_id}.zip")):
-        #     return zip_path
-
-        if 'Latitude' not in cols_to_export:
-            cols_to_export.append('Latitude')
-
-        if 'Longitude' not in cols_to_export:
-            cols_to_export.append('Longitude')
-
-        redis_queue.put(f'data-export;update__{Consts.LOADING_DISPLAY_STATE};Generating Geometry;Converting csv to GeoPandas Dataframe!')
-
-        time.sleep(2)
-
-        df = pd.read_csv(file_path, usecols=cols_to_export)
-
-        df['Latitude'] = df['Latitude'].astype('float')
-        df['Longitude'] = df['Longitude'].astype('float')
-
-        geometry = [Point(xy) for xy in zip(df['Longitude'], df['Latitude'])]
-        gdf = gpd.GeoDataFrame(df, crs="EPSG:4326", geometry=geometry)
-
-
-        redis_queue.put(f'data-export;update__{Consts.LOADING_DISPLAY_STATE};Writing; Writing shape file to disk')
-
-        time.sleep(2)
-
-        if not os.path.exists(export_path):
-            os.mkdir(export_path)
-
-        gdf.to_file(export_file_path)
-
-        redis_queue.put(f'data-export;update__{Consts.LOADING_DISPLAY_STATE};Archiving; Creating archive from shape file')
-        time.sleep(2)
-
-        file_name = shutil.make_archive(dataset_id, 'zip', export_path, export_path)
-        shutil.move(file_name, os.path.join(export_path, f'{dataset_id}.zip'))
+    def get_shapefile_names(cls, columns):
+        """Column names cut to the shapefile's 10 characters up front, so every appended chunk has the same schema"""
+        names = {}
+        for col in columns:
+            name, suffix = col[:10], 1
+            while name in names.values():
+                name = f'{col[:10 - len(str(suffix))]}{suffix}'
+                suffix += 1
+            names[col] = name
+        return names
 
+    @classmethod
+    def zip_files(cls, paths, zip_path):
+        """Archives the files side by side, each one streamed into the zip rather than read into memory"""
+        tmp_path = f'{zip_path}.{uuid.uuid4().hex}.tmp'
+        with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+            for path in paths:
+                zf.write(path, arcname=os.path.basename(path))
+
+        os.replace(tmp_path, zip_path)
         return zip_path
+
+    @classmethod
+    def export_vector_file(cls, dataset_id, cols_to_export, session, redis_queue=None, export_format='shp'):
+        file_path = cls.download_data_if_not_exists(dataset_id=dataset_id, session=session)
+        driver, extension = cls.VECTOR_FORMATS[export_format]
+
+        relative_path, exported_path = cls.get_export_path(dataset_id, session, export_format)
+        export_path = os.path.dirname(exported_path)
+        # Written aside and moved into place at the end, appending to an earlier export would duplicate it
+        tmp_path = os.path.join(export_path, f'.{uuid.uuid4().hex}.tmp')
+        os.makedirs(tmp_path)
+        tmp_file_path = os.path.join(tmp_path, f"{dataset_id}.{extension}")
+
+        columns = list(dict.fromkeys([*cols_to_export, 'Latitude', 'Longitude']))
+        names = cls.get_shapefile_names(columns) if export_format == 'shp' else {}
+
+        if redis_queue:
+            redis_queue.put(f'data-export;update__{Consts.LOADING_DISPLAY_STATE};Writing; Writing {driver} file to disk')
+
+        try:
+            written, total = 0, ColumnarCache.get_row_count(file_path)
+            for chunk in ColumnarCache.iter_chunks(file_path, columns=columns, chunk_size=cls.EXPORT_CHUNK_SIZE):
+                geometry = gpd.points_from_xy(chunk['Longitude'].astype('float'), chunk['Latitude'].astype('float'),
+                                              crs="EPSG:4326")
+                gdf = gpd.GeoDataFrame(chunk[columns].rename(columns=names), geometry=geometry)
+                # pyogrio writes each chunk in bulk, fiona would build and write a record per row
+                gdf.to_file(tmp_file_path, driver=driver, engine='pyogrio', mode='w' if written == 0 else 'a',
+                            layer_options=cls.VECTOR_LAYER_OPTIONS.get(export_format))
+                written += len(gdf)
+                cls.report_progress(redis_queue, written, total)
+
+            if export_format == 'shp':
+                if redis_queue:
+                    redis_queue.put(
+                        f'data-export;update__{Consts.LOADING_DISPLAY_STATE};Archiving; Creating archive from shape file')
+
+                cls.zip_files([os.path.join(tmp_path, name) for name in sorted(os.listdir(tmp_path))], exported_path)
+            else:
+                os.replace(tmp_file_path, exported_path)
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+        print(f'Exported {written} rows of {dataset_id} as {driver}')
+        return relative_path
@@ -0,0 +1,157 @@
+from abc import ABC, abstractmethod
+
+import numpy as np
+import scipy.sparse as sp
+import verde as vd
+from scipy.interpolate import RegularGridInterpolator
+from scipy.sparse.linalg import cg
+from scipy.spatial import cKDTree
+from sklearn.utils.validation import check_is_fitted
+from verde.base import BaseGridder, check_fit_input, n_1d_arrays
+
+
+class KDTreeGridder(BaseGridder, ABC):
+    """Shared fit of the KD-tree gridders, queries are made in chunks of nodes on every core"""
+
+    CHUNK_SIZE = 2 ** 18
+
+    def fit(self, coordinates, data, weights=None):
+        coordinates, data, weights = check_fit_input(coordinates, data, weights)
+        self.region_ = vd.get_region(coordinates[:2])
+        self.tree_ = cKDTree(np.transpose(n_1d_arrays(coordinates, 2)))
+        self.data_ = np.ravel(data).astype(np.float64)
+        return self
+
+    def predict(self, coordinates):
+        check_is_fitted(self, ["tree_"])
+        shape = np.broadcast(*coordinates[:2]).shape
+        nodes = np.transpose(n_1d_arrays(coordinates, 2))
+
+        data = np.empty(len(nodes))
+        for start in range(0, len(nodes), self.CHUNK_SIZE):
+            data[start:start + self.CHUNK_SIZE] = self.predict_nodes(nodes[start:start + self.CHUNK_SIZE])
+
+        return data.reshape(shape)
+
+    @abstractmethod
+    def predict_nodes(self, nodes):
+        """Values at an (n, 2) array of nodes"""
+
+
+class NearestNeighbour(KDTreeGridder):
+    """Value of the closest data point"""
+
+    def __init__(self, workers=-1):
+        self.workers = workers
+
+    def predict_nodes(self, nodes):
+        _, indices = self.tree_.query(nodes, k=1, workers=self.workers)
+        return self.data_[indices]
+
+
+class InverseDistance(KDTreeGridder):
+    """Inverse distance weighted mean of the k closest data points"""
+
+    def __init__(self, k=12, power=2, workers=-1):
+        self.k = k
+        self.power = power
+        self.workers = workers
+
+    def predict_nodes(self, nodes):
+        k = min(self.k, len(self.data_))
+        distances, indices = self.tree_.query(nodes, k=k, workers=self.workers)
+        if k == 1:
+            return self.data_[indices]
+
+        values = self.data_[indices]
+        with np.errstate(divide='ignore'):
+            weights = 1 / distances ** self.power
+
+        # A node sitting on a data point takes its value
+        exact = np.isinf(weights)
+        weights[exact.any(axis=1)] = exact[exact.any(axis=1)]
+
+        return (weights * values).sum(axis=1) / weights.sum(axis=1)
+
+
+class MinimumCurvature(BaseGridder):
+    """
+    Smoothest surface through the data on a lattice at the given spacing, found with conjugate gradients. Each
+    lattice is started from the solution at twice its spacing, so the solver only has to refine the detail.
+    Predictions are bilinear reads of the solved lattice.
+    """
+
+    # The coarsest lattice is solved from a flat start
+    COARSEST_NODES = 32
+
+    def __init__(self, spacing, data_weight=10.0, max_iterations=500):
+        self.spacing = spacing
+        self.data_weight = data_weight
+        self.max_iterations = max_iterations
+
+    @staticmethod
+    def get_laplacian(n_rows, n_cols):
+        """5-point Laplacian over a (rows, cols) lattice with free edges"""
+        def second_difference(n):
+            if n == 1:
+                return sp.csr_matrix((1, 1))
+            diagonal = np.full(n, -2.0)
+            diagonal[[0, -1]] = -1.0
+            return sp.diags([np.ones(n - 1), diagonal, np.ones(n - 1)], [-1, 0, 1])
+
+        return (sp.kron(sp.identity(n_rows), second_difference(n_cols)) +
+                sp.kron(second_difference(n_rows), sp.identity(n_cols))).tocsr()
+
+    def solve(self, easting, northing, data, spacing):
+        grid_easting, grid_northing = vd.grid_coordinates(self.region_, spacing=spacing)
+        lattice_easting, lattice_northing = grid_easting[0, :], grid_northing[:, 0]
+        shape = grid_easting.shape
+
+        # Points are attached to their closest node, nodes with several points take their mean
+        step_easting = lattice_easting[1] - lattice_easting[0] if shape[1] > 1 else 1
+        step_northing = lattice_northing[1] - lattice_northing[0] if shape[0] > 1 else 1
+        cols = np.clip(np.rint((easting - lattice_easting[0]) / step_easting).astype(np.int64), 0, shape[1] - 1)
+        rows = np.clip(np.rint((northing - lattice_northing[0]) / step_northing).astype(np.int64), 0, shape[0] - 1)
+        nodes = rows * shape[1] + cols
+
+        counts = np.bincount(nodes, minlength=grid_easting.size)
+        sums = np.bincount(nodes, weights=data, minlength=grid_easting.size)
+        constrained = counts > 0
+        target = np.zeros(grid_easting.size)
+        target[constrained] = sums[constrained] / counts[constrained]
+
+        if min(shape) > self.COARSEST_NODES:
+            coarse_easting, coarse_northing, coarse = self.solve(easting, northing, data, spacing * 2)
+            start = RegularGridInterpolator((coarse_northing, coarse_easting), coarse, bounds_error=False,
+                                            fill_value=None)((grid_northing, grid_easting)).ravel()
+        else:
+            start = np.full(grid_easting.size, data.mean())
+
+        laplacian = self.get_laplacian(*shape)
+        weights = sp.diags(constrained * self.data_weight)
+        system = (laplacian.T @ laplacian + weights).tocsr()
+
+        # Jacobi preconditioning, the diagonal is positive everywhere
+        preconditioner = sp.diags(1 / system.diagonal())
+        solution, info = cg(system, weights @ target, x0=start, M=preconditioner, maxiter=self.max_iterations)
+        if info > 0:
+            print(f'Minimum curvature stopped after {info} iterations at spacing {spacing}')
+
+        return lattice_easting, lattice_northing, solution.reshape(shape)
+
+    def fit(self, coordinates, data, weights=None):
+        coordinates, data, weights = check_fit_input(coordinates, data, weights)
+        easting, northing = (np.ravel(c).astype(np.float64) for c in n_1d_arrays(coordinates, 2))
+        self.region_ = vd.get_region((easting, northing))
+
+        lattice_easting, lattice_northing, lattice = self.solve(easting, northing,
+                                                                np.ravel(data).astype(np.float64), self.spacing)
+        self.interpolator_ = RegularGridInterpolator((lattice_northing, lattice_easting), lattice,
+                                                     bounds_error=False, fill_value=None)
+        return self
+
+    def predict(self, coordinates):
+        check_is_fitted(self, ["interpolator_"])
+        shape = np.broadcast(*coordinates[:2]).shape
+        easting, northing = n_1d_arrays(coordinates, 2)
+        return self.interpolator_((northing, easting)).reshape(shape)
@@ -0,0 +1,78 @@
+import numpy as np
+from scipy.spatial import ConvexHull, Delaunay, QhullError, cKDTree
+
+
+class GridMasking:
+    """Masks of grid nodes computed on the grid arrays directly, without converting the grid to a DataFrame."""
+
+    # Grid rows whose node coordinates are materialized at once
+    CHUNK_ROWS = 256
+
+    @classmethod
+    def map_candidates(cls, easting, northing, candidates, test, chunk_rows=CHUNK_ROWS) -> np.ndarray:
+        """
+        Mask of the (northing, easting) grid with test applied to the (n, 2) coordinates of the candidate nodes,
+        a band of grid rows at a time so the full grid is never meshed out in memory. Other nodes stay False.
+        """
+        easting = np.asarray(easting, dtype=np.float64)
+        northing = np.asarray(northing, dtype=np.float64)
+
+        mask = np.zeros(candidates.shape, dtype=bool)
+        for start in range(0, candidates.shape[0], chunk_rows):
+            rows = slice(start, start + chunk_rows)
+            row_idx, col_idx = np.nonzero(candidates[rows])
+            if len(row_idx) == 0:
+                continue
+
+            mask[rows][row_idx, col_idx] = test(np.column_stack((easting[col_idx], northing[rows][row_idx])))
+
+        return mask
+
+    @classmethod
+    def convexhull_mask(cls, coordinates, easting, northing, candidates=None) -> np.ndarray:
+        """True for every node of the (northing, easting) grid inside the convex hull of the survey points"""
+        shape = (len(northing), len(easting))
+        candidates = np.ones(shape, dtype=bool) if candidates is None else np.asarray(candidates)
+
+        if not candidates.any() or len(coordinates[0]) < 3:
+            return np.zeros(shape, dtype=bool)
+
+        points = np.column_stack((np.asarray(coordinates[0], dtype=np.float64),
+                                  np.asarray(coordinates[1], dtype=np.float64)))
+        # Normalized as verde does, qhull loses precision on raw UTM coordinates
+        mean, std = points.mean(axis=0), points.std(axis=0)
+
+        try:
+            # Only the hull's vertices are triangulated, which covers the same area as the whole survey
+            points = (points - mean) / std
+            triangulation = Delaunay(points[ConvexHull(points).vertices])
+        except QhullError as e:
+            # Collinear or repeated points have no hull to speak of
+            print(f'No convex hull for the survey points: {e}')
+            return np.zeros(shape, dtype=bool)
+
+        return cls.map_candidates(easting, northing, candidates,
+                                  lambda nodes: triangulation.find_simplex((nodes - mean) / std) >= 0)
+
+    @classmethod
+    def distance_mask(cls, coordinates, easting, northing, max_distance, candidates=None, workers=-1) -> np.ndarray:
+        """
+        True for every node of the (northing, easting) grid with a survey point within max_distance. Only the
+        candidate nodes are queried, the rest stay False.
+        """
+        shape = (len(northing), len(easting))
+        candidates = np.ones(shape, dtype=bool) if candidates is None else np.asarray(candidates)
+
+        if not candidates.any() or len(coordinates[0]) == 0:
+            return np.zeros(shape, dtype=bool)
+
+        tree = cKDTree(np.column_stack((np.asarray(coordinates[0], dtype=np.float64),
+                                        np.asarray(coordinates[1], dtype=np.float64))))
+
+        # Nodes with nothing inside the bound come back as inf, which also lets the search stop early
+        def within_distance(nodes):
+            distance, _ = tree.query(nodes, k=1, distance_upper_bound=np.nextafter(max_distance, np.inf),
+                                     workers=workers)
+            return np.isfinite(distance)
+
+        return cls.map_candidates(easting, northing, candidates, within_distance)
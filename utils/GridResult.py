@@ -0,0 +1,43 @@
+import numpy as np
+
+
+class GridResult:
+    """
+    A gridded column as one 2D array over the (northing, easting) axes, plus a mask of the nodes that survived
+    masking. Masks and the range clamp only narrow the mask, exporters read views of the array.
+    """
+
+    def __init__(self, easting, northing, values, mask=None):
+        self.easting = np.asarray(easting)
+        self.northing = np.asarray(northing)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.mask = np.isfinite(self.values) if mask is None else np.asarray(mask, dtype=bool)
+
+    @classmethod
+    def from_xarray(cls, grid, data_name):
+        return cls(grid['Easting'].values, grid['Northing'].values, grid[data_name].values)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def count(self) -> int:
+        return int(np.count_nonzero(self.mask))
+
+    def restrict(self, mask):
+        self.mask &= mask
+        return self
+
+    def clamp(self, lower, upper):
+        with np.errstate(invalid='ignore'):
+            return self.restrict((self.values >= lower) & (self.values <= upper))
+
+    def get_raster(self) -> np.ndarray:
+        """North-up view of the values with every masked node set to NaN in place"""
+        np.putmask(self.values, ~self.mask, np.nan)
+        return self.values[::-1]
+
+    def get_nodes(self, rows=slice(None)):
+        """(northing, easting, values) of the unmasked nodes in the given grid rows, row by row"""
+        row_idx, col_idx = np.nonzero(self.mask[rows])
+        return self.northing[rows][row_idx], self.easting[col_idx], self.values[rows][row_idx, col_idx]
@@ -0,0 +1,73 @@
+import os
+import shutil
+import uuid
+
+
+class LocalBlobBackend:
+    """
+    Stand-in for the block API of the blob store, kept under a local directory so uploads can be run offline.
+    Blobs land at <root>/<container>/<blob name>, staged blocks wait under <root>/.blocks until committed.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def get_blob_location(self, container, blob_name):
+        return os.path.join(self.root, container, *blob_name.split('/'))
+
+    def get_block_location(self, container, blob_name, block_id):
+        # Block ids are base64, which may hold a '/'
+        return os.path.join(self.root, '.blocks', container, *blob_name.split('/'), block_id.encode().hex())
+
+    def stage_block(self, container, blob_name, block_id, data):
+        block_path = self.get_block_location(container, blob_name, block_id)
+        os.makedirs(os.path.dirname(block_path), exist_ok=True)
+
+        tmp_path = f'{block_path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, block_path)
+
+    def get_md5_location(self, container, blob_name):
+        return os.path.join(self.root, '.md5', container, *blob_name.split('/'))
+
+    def commit_blocks(self, container, blob_name, block_ids, content_md5=None):
+        blob_path = self.get_blob_location(container, blob_name)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+        # Readers see the previous blob until the new one is whole
+        tmp_path = f'{blob_path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            for block_id in block_ids:
+                with open(self.get_block_location(container, blob_name, block_id), 'rb') as block:
+                    shutil.copyfileobj(block, f)
+        os.replace(tmp_path, blob_path)
+
+        shutil.rmtree(os.path.join(self.root, '.blocks', container, *blob_name.split('/')), ignore_errors=True)
+
+        md5_path = self.get_md5_location(container, blob_name)
+        if content_md5 is None:
+            if os.path.exists(md5_path):
+                os.remove(md5_path)
+        else:
+            os.makedirs(os.path.dirname(md5_path), exist_ok=True)
+            with open(md5_path, 'wb') as f:
+                f.write(content_md5)
+
+    def get_blob_properties(self, container, blob_name):
+        stat = os.stat(self.get_blob_location(container, blob_name))
+        md5_path = self.get_md5_location(container, blob_name)
+
+        content_md5 = None
+        if os.path.exists(md5_path):
+            with open(md5_path, 'rb') as f:
+                content_md5 = f.read()
+        return {'size': stat.st_size, 'etag': f'{stat.st_mtime_ns}-{stat.st_size}', 'content_md5': content_md5}
+
+    def download_range(self, container, blob_name, offset, length, etag):
+        if self.get_blob_properties(container, blob_name)['etag'] != etag:
+            raise IOError(f'{blob_name} changed while it was being downloaded')
+
+        with open(self.get_blob_location(container, blob_name), 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
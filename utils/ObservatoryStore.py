@@ -0,0 +1,134 @@
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from utils.ColumnarCache import ColumnarCache
+from utils.DatetimeUtils import DatetimeUtils
+
+
+class ObservatoryStore:
+    """
+    Observatory readings split into one time-sorted parquet file per day, next to the dataset CSV, with a
+    summary of every day. The date picker reads a single day and its bounds come from the summary.
+    """
+
+    DATETIME_COL = 'Datetime'
+    VALUE_COL = 'Magnetic_Field'
+    SUMMARY_FILE = 'summary.json'
+
+    # A step longer than this many sample intervals counts as a gap in the recording
+    GAP_FACTOR = 2
+
+    @classmethod
+    def get_store_path(cls, source_path):
+        return f'{os.path.splitext(source_path)[0]}_days'
+
+    @classmethod
+    def get_partition_path(cls, store_path, day):
+        return os.path.join(store_path, f'{day}.parquet')
+
+    @classmethod
+    def is_fresh(cls, source_path):
+        summary_path = os.path.join(cls.get_store_path(source_path), cls.SUMMARY_FILE)
+        cache_path = ColumnarCache.get_cache_path(source_path)
+        if not os.path.exists(summary_path):
+            return False
+        if not os.path.exists(cache_path):
+            return True
+        return os.path.getmtime(summary_path) >= os.path.getmtime(cache_path)
+
+    @classmethod
+    def summarize_day(cls, day, df: pd.DataFrame):
+        steps = np.diff(df[cls.DATETIME_COL].to_numpy().astype('datetime64[ns]').astype(np.int64)) / 1e9
+        sample_rate = float(np.median(steps)) if len(steps) > 0 else None
+        values = df[cls.VALUE_COL].to_numpy(dtype=np.float64, na_value=np.nan) \
+            if cls.VALUE_COL in df.columns else np.array([np.nan])
+
+        return {
+            'date': day,
+            'rows': int(len(df)),
+            'start': df[cls.DATETIME_COL].iloc[0].isoformat(),
+            'end': df[cls.DATETIME_COL].iloc[-1].isoformat(),
+            'min': float(np.nanmin(values)) if np.isfinite(values).any() else None,
+            'max': float(np.nanmax(values)) if np.isfinite(values).any() else None,
+            'sample_rate': sample_rate,
+            'gaps': int((steps > cls.GAP_FACTOR * sample_rate).sum()) if sample_rate else 0
+        }
+
+    @classmethod
+    def build(cls, source_path):
+        df = ColumnarCache.read(source_path)
+        df = DatetimeUtils.restore(df)
+        df = df.dropna(subset=[cls.DATETIME_COL]).sort_values(cls.DATETIME_COL, kind='stable')
+        df = df.reset_index(drop=True)
+
+        store_path = cls.get_store_path(source_path)
+        tmp_path = f'{store_path}.{uuid.uuid4().hex}.tmp'
+        os.makedirs(tmp_path)
+
+        days = df[cls.DATETIME_COL].dt.normalize()
+        boundaries = np.flatnonzero(days.to_numpy()[1:] != days.to_numpy()[:-1]) + 1
+        starts = np.concatenate(([0], boundaries)) if len(df) > 0 else np.array([], dtype=np.int64)
+        ends = np.concatenate((boundaries, [len(df)])) if len(df) > 0 else np.array([], dtype=np.int64)
+
+        summary = []
+        for start, end in zip(starts, ends):
+            day_df = df.iloc[start:end]
+            day = days.iloc[start].strftime('%Y-%m-%d')
+            day_df.to_parquet(cls.get_partition_path(tmp_path, day), index=False)
+            summary.append(cls.summarize_day(day, day_df))
+
+        with open(os.path.join(tmp_path, cls.SUMMARY_FILE), 'w') as f:
+            json.dump({'columns': list(df.columns), 'days': summary}, f)
+
+        # Swapped in whole, a reader never sees half a store
+        if os.path.exists(store_path):
+            shutil.rmtree(store_path, ignore_errors=True)
+        os.replace(tmp_path, store_path)
+
+        return store_path
+
+    @classmethod
+    def ensure(cls, source_path):
+        if not cls.is_fresh(source_path):
+            print(f'Partitioning observatory data by day for {source_path}')
+            cls.build(source_path)
+        return cls.get_store_path(source_path)
+
+    @classmethod
+    def get_summary(cls, source_path):
+        with open(os.path.join(cls.ensure(source_path), cls.SUMMARY_FILE)) as f:
+            return json.load(f)
+
+    @classmethod
+    def get_date_range(cls, source_paths):
+        days = [day['date'] for path in source_paths for day in cls.get_summary(path)['days']]
+        if not days:
+            return None, None
+        return pd.to_datetime(min(days)).date(), pd.to_datetime(max(days)).date()
+
+    @classmethod
+    def read_day(cls, source_paths, day, columns=None) -> pd.DataFrame:
+        day = pd.to_datetime(day).strftime('%Y-%m-%d')
+
+        dfs = []
+        for path in source_paths:
+            partition_path = cls.get_partition_path(cls.ensure(path), day)
+            if not os.path.exists(partition_path):
+                continue
+
+            available = cls.get_summary(path)['columns']
+            day_columns = None if columns is None else [col for col in dict.fromkeys(columns) if col in available]
+            dfs.append(pd.read_parquet(partition_path, columns=day_columns))
+
+        if not dfs:
+            return pd.DataFrame(columns=columns or [cls.DATETIME_COL, cls.VALUE_COL])
+
+        if len(dfs) == 1:
+            return dfs[0]
+
+        return pd.concat(dfs).sort_values(cls.DATETIME_COL, kind='stable').reset_index(drop=True)
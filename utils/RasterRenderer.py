@@ -0,0 +1,130 @@
+import base64
+import io
+import os
+
+import contourpy
+import numpy as np
+import rasterio
+from matplotlib import pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.ticker import MaxNLocator
+from rasterio.plot import plotting_extent
+
+import AppConfig
+from utils.DiskCache import DiskCache
+
+
+class RasterRenderer:
+    """
+    PNG previews of interpolated rasters, cached on disk per raster version, contour flag, colormap and size.
+    Contour lines are traced once per raster version and drawn over the image as plain line segments.
+    """
+
+    VERSION_TAG = 'RASTER_VERSION'
+    MAX_PIXELS = 1024
+    CONTOUR_LEVELS = 10
+
+    @classmethod
+    def get_cache(cls):
+        return DiskCache(AppConfig.RENDER_CACHE_DIR, AppConfig.RENDER_CACHE_MAX_BYTES)
+
+    @classmethod
+    def get_version(cls, src):
+        # Rasters carry the key they were cached under, anything else falls back to the file's identity
+        version = src.tags().get(cls.VERSION_TAG)
+        if version:
+            return version
+
+        stat = os.stat(src.name)
+        return f'{os.path.abspath(src.name)}-{stat.st_mtime_ns}-{stat.st_size}'
+
+    @classmethod
+    def read_preview(cls, src, max_pixels=MAX_PIXELS):
+        """First band at no more than max_pixels a side, read from the overviews when the raster has them"""
+        scale = max(src.height / max_pixels, src.width / max_pixels, 1)
+        out_shape = (max(int(src.height / scale), 1), max(int(src.width / scale), 1))
+
+        data = src.read(1, out_shape=out_shape, masked=True).astype(np.float64).filled(np.nan)
+        return data, plotting_extent(src)
+
+    @classmethod
+    def trace_contours(cls, data, extent, levels=CONTOUR_LEVELS):
+        """Contour lines of the preview array as (points, offsets), points of line i are points[offsets[i]:offsets[i+1]]"""
+        if not np.isfinite(data).any():
+            return np.empty((0, 2)), np.array([0])
+
+        height, width = data.shape
+        # Pixel centres, row 0 is the northern edge
+        x = np.linspace(extent[0], extent[1], width, endpoint=False) + (extent[1] - extent[0]) / width / 2
+        y = np.linspace(extent[3], extent[2], height, endpoint=False) - (extent[3] - extent[2]) / height / 2
+
+        generator = contourpy.contour_generator(x, y, np.ma.masked_invalid(data))
+
+        lines = []
+        for level in MaxNLocator(nbins=levels).tick_values(np.nanmin(data), np.nanmax(data)):
+            lines.extend(line for line in generator.lines(level) if len(line) > 1)
+
+        if not lines:
+            return np.empty((0, 2)), np.array([0])
+
+        offsets = np.concatenate(([0], np.cumsum([len(line) for line in lines])))
+        return np.concatenate(lines), offsets
+
+    @classmethod
+    def get_contours(cls, data, extent, version, max_pixels):
+        cache = cls.get_cache()
+        key = DiskCache.make_key('contours', version, max_pixels, cls.CONTOUR_LEVELS)
+
+        cached = cache.get_bytes(key, 'contours.npz')
+        if cached is not None:
+            arrays = np.load(io.BytesIO(cached))
+            return arrays['points'], arrays['offsets']
+
+        points, offsets = cls.trace_contours(data, extent)
+
+        buffer = io.BytesIO()
+        np.savez(buffer, points=points, offsets=offsets)
+        cache.put(key, {'contours.npz': buffer.getvalue()})
+
+        return points, offsets
+
+    @classmethod
+    def draw(cls, data, extent, title, cmap, contours=None):
+        plt.style.use('dark_background')
+        fig = plt.figure()
+        ax = fig.gca()
+
+        im = ax.imshow(data, extent=extent, cmap=cmap)
+        fig.colorbar(im, ax=ax)
+
+        if contours is not None:
+            points, offsets = contours
+            segments = [points[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+            ax.add_collection(LineCollection(segments, colors='white', linewidths=0.6, alpha=0.8))
+
+        ax.set_title(title)
+        ax.set_ylabel('Northing')
+        ax.set_xlabel('Easting')
+
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format='png')
+        plt.close(fig)
+        return buffer.getvalue()
+
+    @classmethod
+    def render(cls, raster_path, title, contours=False, cmap='RdBu_r', max_pixels=MAX_PIXELS):
+        """The raster as an embeddable PNG data URI"""
+        with rasterio.open(raster_path) as src:
+            version = cls.get_version(src)
+            cache = cls.get_cache()
+            key = DiskCache.make_key('png', version, title, bool(contours), cmap, max_pixels)
+
+            png = cache.get_bytes(key, 'render.png')
+            if png is None:
+                data, extent = cls.read_preview(src, max_pixels)
+                contour_lines = cls.get_contours(data, extent, version, max_pixels) if contours else None
+
+                png = cls.draw(data, extent, title, cmap, contour_lines)
+                cache.put(key, {'render.png': png})
+
+        return f'data:image/png;base64,{base64.b64encode(png).decode("ascii")}'
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+
+
+class SmoothingUtils:
+    """Prefix-sum boxcar smoothing, matching pandas rolling(win_type='boxcar').mean() in O(n)."""
+
+    @classmethod
+    def get_window_offsets(cls, window, center=False):
+        # pandas centres a window of size w by looking (w - 1) // 2 samples ahead
+        ahead = (window - 1) // 2 if center else 0
+        behind = window - 1 - ahead
+        return behind, ahead
+
+    @classmethod
+    def boxcar_mean(cls, values, window, center=False, min_periods=1) -> np.ndarray:
+        x = np.asarray(values, dtype=np.float64)
+        n = len(x)
+        window = int(window)
+
+        if n == 0 or window < 1:
+            return np.full(n, np.nan)
+
+        valid = ~np.isnan(x)
+
+        # Subtracting a representative value keeps the running sum small, so the differences
+        # below don't lose precision on long surveys of ~50000 nT readings
+        shift = x[valid][0] if valid.any() else 0.0
+
+        sums = np.concatenate(([0.0], np.cumsum(np.where(valid, x - shift, 0.0))))
+        counts = np.concatenate(([0], np.cumsum(valid)))
+
+        behind, ahead = cls.get_window_offsets(window, center)
+        positions = np.arange(n)
+        ends = np.minimum(positions + ahead + 1, n)
+        starts = np.maximum(positions - behind, 0)
+
+        window_counts = counts[ends] - counts[starts]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = (sums[ends] - sums[starts]) / window_counts + shift
+
+        means[window_counts < max(min_periods, 1)] = np.nan
+        return means
+
+    @classmethod
+    def boxcar_series(cls, series: pd.Series, window, center=False, min_periods=1) -> pd.Series:
+        return pd.Series(cls.boxcar_mean(series.to_numpy(dtype=np.float64, na_value=np.nan),
+                                         window, center=center, min_periods=min_periods),
+                         index=series.index, name=series.name)
+
+    @classmethod
+    def boxcar_dask_series(cls, series, window, center=False, min_periods=1):
+        behind, ahead = cls.get_window_offsets(window, center)
+        return series.map_overlap(cls.boxcar_series, before=behind, after=ahead,
+                                  window=window, center=center, min_periods=min_periods,
+                                  meta=(series.name, 'f8'))
@@ -0,0 +1,130 @@
+import numpy as np
+
+from utils.SmoothingUtils import SmoothingUtils
+
+
+class BoxcarStream:
+    """
+    Chunked counterpart of SmoothingUtils.boxcar_mean. Prefix sums are carried across chunks and only a halo of
+    window size is kept, so the output is bit-identical to smoothing the whole series at once
+    """
+
+    def __init__(self, window, center=False, min_periods=1):
+        self.window = int(window)
+        self.min_periods = max(min_periods, 1)
+        self.behind, self.ahead = SmoothingUtils.get_window_offsets(self.window, center)
+
+        self.shift = None
+        self.sums = np.array([0.0])
+        self.counts = np.array([0], dtype=np.int64)
+        self.base = 0
+        self.received = 0
+        self.emitted = 0
+
+    def push(self, values) -> np.ndarray:
+        x = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(x)
+
+        if self.shift is None and valid.any():
+            self.shift = x[valid][0]
+
+        filled = np.where(valid, x - (self.shift if self.shift is not None else 0.0), 0.0)
+
+        self.sums = np.concatenate((self.sums, np.cumsum(np.concatenate(([self.sums[-1]], filled)))[1:]))
+        self.counts = np.concatenate((self.counts, np.cumsum(np.concatenate(([self.counts[-1]], valid)))[1:]))
+        self.received += len(x)
+
+        return self.emit(final=False)
+
+    def finish(self) -> np.ndarray:
+        return self.emit(final=True)
+
+    def emit(self, final) -> np.ndarray:
+        available = self.received if final else max(self.received - self.ahead, self.emitted)
+        positions = np.arange(self.emitted, available)
+
+        if self.window < 1:
+            means = np.full(len(positions), np.nan)
+        else:
+            ends = np.minimum(positions + self.ahead + 1, self.received) - self.base
+            starts = np.maximum(positions - self.behind, 0) - self.base
+
+            window_counts = self.counts[ends] - self.counts[starts]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                means = (self.sums[ends] - self.sums[starts]) / window_counts + \
+                        (self.shift if self.shift is not None else 0.0)
+            means[window_counts < self.min_periods] = np.nan
+
+        self.emitted = available
+
+        # Only the prefix sums still reachable by the next window are kept
+        new_base = max(self.emitted - self.behind, 0)
+        self.sums = self.sums[new_base - self.base:]
+        self.counts = self.counts[new_base - self.base:]
+        self.base = new_base
+
+        return means
+
+
+class LinearGapStream:
+    """
+    Chunked counterpart of Series.interpolate(method='linear'). Gaps are held back until the next valid reading
+    arrives; leading gaps stay empty and trailing gaps take the last valid reading, as pandas does
+    """
+
+    def __init__(self, interpolate=True):
+        self.interpolate = interpolate
+        self.last_pos = None
+        self.last_val = None
+        self.pending = np.array([])
+        self.received = 0
+
+    def push(self, values) -> np.ndarray:
+        x = np.asarray(values, dtype=np.float64)
+        start = self.received
+        self.received += len(x)
+
+        if not self.interpolate:
+            return x
+
+        valid_idx = np.flatnonzero(~np.isnan(x))
+
+        if len(valid_idx) == 0:
+            if self.last_pos is None:
+                return x
+            self.pending = np.concatenate((self.pending, x))
+            return np.array([])
+
+        resolved = np.concatenate((self.pending, x[:valid_idx[-1] + 1]))
+        resolved_start = start - len(self.pending)
+        gaps = np.flatnonzero(np.isnan(resolved))
+
+        if len(gaps) > 0:
+            xp = start + valid_idx
+            fp = x[valid_idx]
+            if self.last_pos is not None:
+                xp = np.concatenate(([self.last_pos], xp))
+                fp = np.concatenate(([self.last_val], fp))
+
+            gap_pos = resolved_start + gaps
+            filled = np.interp(gap_pos, xp, fp)
+
+            # Gaps before the first valid reading of the series are left as they are
+            if self.last_pos is None:
+                filled[gap_pos < xp[0]] = np.nan
+            resolved[gaps] = filled
+
+        self.last_pos = start + valid_idx[-1]
+        self.last_val = x[valid_idx[-1]]
+        self.pending = x[valid_idx[-1] + 1:]
+
+        return resolved
+
+    def finish(self) -> np.ndarray:
+        if not self.interpolate or len(self.pending) == 0:
+            return np.array([])
+
+        if self.last_pos is None:
+            return self.pending
+
+        return np.full(len(self.pending), self.last_val)
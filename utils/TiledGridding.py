@@ -0,0 +1,109 @@
+import numpy as np
+import verde as vd
+from joblib import Parallel, delayed
+from sklearn.base import clone
+
+
+class TiledGridding:
+    """
+    Grids a survey as overlapping tiles of the global grid, each fitted on its own points in a separate process.
+    Tiles are blended across their overlap with linear feathering, so the seams don't show.
+    """
+
+    TILE_NODES = 256
+    OVERLAP_NODES = 16
+    # Points this many nodes beyond a tile still feed its fit, so its edges aren't extrapolated
+    FIT_MARGIN_NODES = 8
+    N_JOBS = -1
+
+    @classmethod
+    def get_tiles(cls, shape, tile_nodes=TILE_NODES, overlap_nodes=OVERLAP_NODES):
+        """(core, extended) row and column slices of every tile, the extended slices include the overlap"""
+        tiles = []
+        for row_start in range(0, shape[0], tile_nodes):
+            for col_start in range(0, shape[1], tile_nodes):
+                core = (slice(row_start, min(row_start + tile_nodes, shape[0])),
+                        slice(col_start, min(col_start + tile_nodes, shape[1])))
+                extended = (slice(max(core[0].start - overlap_nodes, 0), min(core[0].stop + overlap_nodes, shape[0])),
+                            slice(max(core[1].start - overlap_nodes, 0), min(core[1].stop + overlap_nodes, shape[1])))
+                tiles.append((core, extended))
+        return tiles
+
+    @classmethod
+    def get_feather(cls, core: slice, extended: slice) -> np.ndarray:
+        """1 over the core, falling linearly towards 0 across the overlap on either side"""
+        positions = np.arange(extended.start, extended.stop)
+        weights = np.ones(len(positions))
+
+        before = positions < core.start
+        weights[before] = (positions[before] - extended.start + 1) / (core.start - extended.start + 1)
+
+        after = positions >= core.stop
+        weights[after] = (extended.stop - positions[after]) / (extended.stop - core.stop + 1)
+
+        return weights
+
+    @classmethod
+    def grid_tile(cls, interpolator, easting, northing, coordinates, values):
+        if len(values) < 3:
+            return np.full((len(northing), len(easting)), np.nan)
+
+        try:
+            fitted = clone(interpolator).fit(coordinates, values)
+        except Exception as e:
+            # Too few or degenerate points in this tile, its neighbours cover the overlap
+            print(f'Skipping interpolation tile: {e}')
+            return np.full((len(northing), len(easting)), np.nan)
+
+        grid_easting, grid_northing = np.meshgrid(easting, northing)
+        return fitted.predict((grid_easting, grid_northing))
+
+    @classmethod
+    def grid(cls, interpolator, coordinates, values, region, spacing, data_name,
+             tile_nodes=TILE_NODES, overlap_nodes=OVERLAP_NODES, n_jobs=N_JOBS, is_cancelled=None):
+        """Gridded values as an xarray Dataset, None when is_cancelled turns true before every tile is in"""
+        grid_easting, grid_northing = vd.grid_coordinates(region, spacing=spacing)
+        easting, northing = grid_easting[0, :], grid_northing[:, 0]
+
+        # The lattice spacing can differ slightly from the requested one once fitted to the region
+        spacing_easting = easting[1] - easting[0] if len(easting) > 1 else spacing
+        spacing_northing = northing[1] - northing[0] if len(northing) > 1 else spacing
+
+        point_easting, point_northing = np.asarray(coordinates[0]), np.asarray(coordinates[1])
+        values = np.asarray(values, dtype=np.float64)
+
+        tiles = cls.get_tiles(grid_easting.shape, tile_nodes, overlap_nodes)
+        jobs = []
+        for _, (rows, cols) in tiles:
+            margin_easting = cls.FIT_MARGIN_NODES * spacing_easting
+            margin_northing = cls.FIT_MARGIN_NODES * spacing_northing
+            in_tile = (point_easting >= easting[cols.start] - margin_easting) & \
+                      (point_easting <= easting[cols.stop - 1] + margin_easting) & \
+                      (point_northing >= northing[rows.start] - margin_northing) & \
+                      (point_northing <= northing[rows.stop - 1] + margin_northing)
+
+            jobs.append(delayed(cls.grid_tile)(interpolator, easting[cols], northing[rows],
+                                               (point_easting[in_tile], point_northing[in_tile]), values[in_tile]))
+
+        print(f'Gridding {len(jobs)} tiles')
+        # Tiles come back one at a time, so a cancelled grid stops without waiting on the ones still queued
+        tile_grids = Parallel(n_jobs=n_jobs, backend='loky', return_as='generator')(jobs)
+
+        weighted_sum = np.zeros(grid_easting.shape)
+        weight_total = np.zeros(grid_easting.shape)
+        for (core, extended), tile_grid in zip(tiles, tile_grids):
+            if is_cancelled is not None and is_cancelled():
+                tile_grids.close()
+                print('Tiled gridding cancelled')
+                return None
+
+            weights = np.outer(cls.get_feather(core[0], extended[0]), cls.get_feather(core[1], extended[1]))
+            valid = ~np.isnan(tile_grid)
+            weighted_sum[extended] += np.where(valid, tile_grid * weights, 0.0)
+            weight_total[extended] += np.where(valid, weights, 0.0)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            data = np.where(weight_total > 0, weighted_sum / weight_total, np.nan)
+
+        return vd.make_xarray_grid((grid_easting, grid_northing), data, data_names=data_name,
+                                   dims=("Northing", "Easting"))
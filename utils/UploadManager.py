@@ -0,0 +1,179 @@
+import base64
+import hashlib
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import AppConfig
+from dataservices.RedisQueue import RedisQueue
+from utils.Consts import Consts
+from utils.LocalBlobBackend import LocalBlobBackend
+
+
+class UploadManager:
+    """
+    Uploads files to the blob store in the background on bounded pools. A file is cut into blocks which are staged
+    in parallel, each retried on its own, and committed once all of them are in. Uploads of the same dataset run one
+    after the other in the order they were submitted, so an older save never lands over a newer one.
+    """
+
+    BLOCK_SIZE = AppConfig.UPLOAD_BLOCK_SIZE
+    MAX_RETRIES = 3
+    RETRY_DELAY = 1
+
+    QUEUED = 'queued'
+    UPLOADING = 'uploading'
+    UPLOADED = 'uploaded'
+    FAILED = 'failed'
+
+    # Files and blocks get separate pools, a file waiting on its blocks never holds a worker they need
+    _file_executor = ThreadPoolExecutor(max_workers=AppConfig.UPLOAD_MAX_FILES, thread_name_prefix='upload-file')
+    _block_executor = ThreadPoolExecutor(max_workers=AppConfig.UPLOAD_MAX_WORKERS, thread_name_prefix='upload-block')
+
+    _lock = threading.Lock()
+    _queues = {}
+    _statuses = {}
+
+    @classmethod
+    def get_backend(cls):
+        if AppConfig.BLOB_BACKEND == 'local':
+            return LocalBlobBackend(AppConfig.LOCAL_BLOB_ROOT)
+
+        # Imported here, the connector sets up its Azure clients as soon as its module loads
+        from utils.AzureContainerHelper import BlobConnector
+        return BlobConnector
+
+    @classmethod
+    def get_blob_path(cls, blob_name, state=None, linked=False, user_id=None, project_id=None):
+        container = AppConfig.DATASETS_CONTAINER if not linked else AppConfig.PROJECTS_CONTAINER
+        if linked:
+            blob_name = f"{project_id}/{blob_name}/{state}/{blob_name}"
+        else:
+            blob_name = f"datasets/{user_id}/{blob_name}"
+        return container, blob_name
+
+    @classmethod
+    def get_status(cls, dataset_id):
+        """State of the dataset's latest upload, None if nothing was uploaded in this process"""
+        with cls._lock:
+            return cls._statuses.get(dataset_id)
+
+    @classmethod
+    def get_block_id(cls, index):
+        # Every id of a blob has to be the same length
+        return base64.b64encode(f'{index:08d}'.encode()).decode()
+
+    @classmethod
+    def retry(cls, func, *args):
+        for attempt in range(cls.MAX_RETRIES):
+            try:
+                return func(*args)
+            except Exception as e:
+                if attempt == cls.MAX_RETRIES - 1:
+                    raise
+                print(f'Attempt {attempt + 1} failed, retrying: {e}')
+                time.sleep(cls.RETRY_DELAY * 2 ** attempt)
+
+    @classmethod
+    def get_md5(cls, local_file_path):
+        md5 = hashlib.md5()
+        with open(local_file_path, 'rb') as f:
+            for data in iter(lambda: f.read(cls.BLOCK_SIZE), b''):
+                md5.update(data)
+        return md5.digest()
+
+    @classmethod
+    def stage_block(cls, backend, container, blob_name, local_file_path, index):
+        with open(local_file_path, 'rb') as f:
+            f.seek(index * cls.BLOCK_SIZE)
+            data = f.read(cls.BLOCK_SIZE)
+
+        block_id = cls.get_block_id(index)
+        cls.retry(backend.stage_block, container, blob_name, block_id, data)
+        return block_id
+
+    @classmethod
+    def upload_file(cls, blob_name, local_file_path, state=None, linked=False, user_id=None, project_id=None):
+        backend = cls.get_backend()
+        container, blob_name = cls.get_blob_path(blob_name, state, linked, user_id, project_id)
+
+        n_blocks = -(-os.path.getsize(local_file_path) // cls.BLOCK_SIZE)
+        futures = [cls._block_executor.submit(cls.stage_block, backend, container, blob_name, local_file_path, index)
+                   for index in range(n_blocks)]
+        try:
+            # Block uploads get no checksum of the whole blob, it's hashed here while the blocks go out
+            content_md5 = cls.get_md5(local_file_path)
+            block_ids = [future.result() for future in futures]
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+
+        cls.retry(backend.commit_blocks, container, blob_name, block_ids, content_md5)
+        return f'{container}/{blob_name}'
+
+    @classmethod
+    def notify(cls, dataset_id, action, message):
+        # The upload is what matters, a notification lost with Redis down must not fail it
+        try:
+            redis_queue = RedisQueue(name='app-notifications')
+            redis_queue.put(f'upload-{dataset_id};{action}__{message}')
+        except Exception as e:
+            print(f'Could not send the upload notification of {dataset_id}: {e}')
+
+    @classmethod
+    def run(cls, dataset_id, job):
+        future, blob_name, local_file_path, kwargs = job
+
+        if future.set_running_or_notify_cancel():
+            with cls._lock:
+                cls._statuses[dataset_id] = cls.UPLOADING
+            cls.notify(dataset_id, 'show', f'{Consts.LOADING_DISPLAY_STATE};Uploading;Saving {blob_name} to the cloud')
+
+            try:
+                uploaded = cls.upload_file(blob_name, local_file_path, **kwargs)
+            except Exception as e:
+                print(f'Upload of {local_file_path} failed: {e}')
+                with cls._lock:
+                    cls._statuses[dataset_id] = cls.FAILED
+                cls.notify(dataset_id, 'update',
+                           f'{Consts.ERROR_DISPLAY_STATE};Upload Failed;{blob_name} could not be saved to the cloud')
+                future.set_exception(e)
+            else:
+                print(f'Uploaded {local_file_path} to {uploaded}')
+                with cls._lock:
+                    cls._statuses[dataset_id] = cls.UPLOADED
+                cls.notify(dataset_id, 'update', f'{Consts.FINISHED_DISPLAY_STATE};Uploaded;Saved {blob_name}')
+                future.set_result(uploaded)
+
+        with cls._lock:
+            queue = cls._queues[dataset_id]
+            queue.popleft()
+            next_job = queue[0] if queue else None
+            if next_job is None:
+                del cls._queues[dataset_id]
+
+        if next_job is not None:
+            cls._file_executor.submit(cls.run, dataset_id, next_job)
+
+    @classmethod
+    def submit(cls, dataset_id, blob_name, local_file_path, state=None, linked=False, user_id=None, project_id=None):
+        """
+        Queues the file behind the dataset's earlier uploads and returns at once. The returned future resolves to
+        the uploaded blob's path, or raises the upload's error once the retries are spent.
+        """
+        future = Future()
+        job = (future, blob_name, local_file_path,
+               dict(state=state, linked=linked, user_id=user_id, project_id=project_id))
+
+        with cls._lock:
+            queue = cls._queues.setdefault(dataset_id, deque())
+            queue.append(job)
+            cls._statuses[dataset_id] = cls.QUEUED
+            start = len(queue) == 1
+
+        if start:
+            cls._file_executor.submit(cls.run, dataset_id, job)
+        return future